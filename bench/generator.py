@@ -0,0 +1,288 @@
+#!/usr/bin/env python
+
+# Benchmark of the qcow2 image generator
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import getopt
+import random
+import shutil
+import resource
+import tempfile
+import multiprocessing
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..'))
+from qcow2 import layout
+
+# Phases of image generation in the order of their execution
+PHASES = ['init', 'extensions', 'l_tables', 'refcounts', 'fuzz', 'write']
+# Backing file name and format written to every image as by the runner
+BACKING_FILE = ('backing_img.raw', 'raw')
+
+
+class FixedImage(layout.Image):
+
+    """Image with the specified cluster size and virtual disk size instead of
+    random ones.
+    """
+
+    def __init__(self, cluster_bits, image_size, backing_file_name=None):
+        self.size_params = (cluster_bits, image_size)
+        layout.Image.__init__(self, backing_file_name)
+
+    def _size_params(self):
+        return self.size_params
+
+
+def bench_cell(args):
+    """Generate images of one cell of the benchmark matrix and return its
+    results.
+
+    'args' is a tuple of cluster bits, a virtual disk size, a number of
+    images, the seed of the first image and a directory for images.
+    Every cell is executed in its own process, so the peak resident set size
+    of the process belongs to the cell.
+    """
+    cluster_bits, image_size, images, seed, work_dir = args
+    phases = dict([(x, 0.0) for x in PHASES])
+    fields = 0
+    written = 0
+    path = os.path.join(work_dir, 'test-%d-%d.img' % (cluster_bits,
+                                                      image_size))
+    for i in range(images):
+        random.seed(seed + i)
+        start = time.time()
+        image = FixedImage(cluster_bits, image_size, BACKING_FILE[0])
+        now = time.time()
+        phases['init'] += now - start
+        start = now
+        image.set_backing_file_format(BACKING_FILE[1])
+        image.create_feature_name_table()
+        image.set_end_of_extension_area()
+        now = time.time()
+        phases['extensions'] += now - start
+        start = now
+        image.create_l_structures()
+        now = time.time()
+        phases['l_tables'] += now - start
+        start = now
+        image.create_refcount_structures()
+        now = time.time()
+        phases['refcounts'] += now - start
+        start = now
+        image.fuzz()
+        now = time.time()
+        phases['fuzz'] += now - start
+        start = now
+        image.write(path)
+        phases['write'] += time.time() - start
+        fields += sum([len(getattr(image, x)) for x in image.ELEMENTS])
+        written += os.path.getsize(path)
+        os.remove(path)
+    total = sum(phases.values())
+    return {'cluster_bits': cluster_bits,
+            'image_size': image_size,
+            'images': images,
+            'seconds': total,
+            'phases': phases,
+            'images_per_second': images / total,
+            'fields_per_second': fields / total,
+            'mb_per_second': written / total / (1 << 20),
+            'peak_rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def cell_key(cell):
+    """Return a key of the cell in the baseline."""
+    return '%d:%d' % (cell['cluster_bits'], cell['image_size'])
+
+
+def compare(cell, baseline, threshold):
+    """Return a change of the image rate of the cell in percents relative to
+    the baseline and True if it's a regression over 'threshold' percents.
+
+    None is returned as a change if the cell is not in the baseline.
+    """
+    old = baseline.get(cell_key(cell))
+    if old is None:
+        return None, False
+    change = 100.0 * (cell['images_per_second'] /
+                      old['images_per_second'] - 1)
+    return change, change < -threshold
+
+
+def parse_range(text):
+    """Return a list of integers from the 'A-B' or 'A,B,...' string."""
+    if '-' in text:
+        low, high = text.split('-', 1)
+        return range(int(low), int(high) + 1)
+    return [int(x) for x in text.split(',')]
+
+
+if __name__ == '__main__':
+
+    def usage():
+        print """
+        Usage: generator.py [OPTION...]
+
+        Measure time of phases of qcow2 image generation, throughput and
+        peak memory usage of the generator for a matrix of cluster sizes
+        and virtual disk sizes.
+
+        Example:
+          generator.py --cluster_bits 9-16 --sizes 10,128 --baseline b.json
+
+        Optional arguments:
+          -h, --help                    display this help and exit
+          --cluster_bits=RANGE          cluster bits of images as 'A-B' or
+                                        a comma separated list, 9-20
+                                        by default
+          --sizes=LIST                  comma separated virtual disk sizes of
+                                        images in MB, '1,10,128' by default
+          -n, --images=NUMBER           number of images per cell of
+                                        the matrix, 5 by default
+          -s, --seed=NUMBER             seed of the first image of every cell,
+                                        following images take next seeds,
+                                        0 by default
+          --save=PATH                   save results as a baseline to
+                                        the JSON file
+          --baseline=PATH               compare results with the baseline
+                                        from the JSON file and exit with
+                                        the code 1 if any cell is slower
+          --threshold=PERCENT           slowdown of the image rate not
+                                        reported as a regression, 10 by
+                                        default
+        """
+
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'hn:s:',
+                                       ['help', 'cluster_bits=', 'sizes=',
+                                        'images=', 'seed=', 'save=',
+                                        'baseline=', 'threshold='])
+    except getopt.error, e:
+        print >>sys.stderr, \
+            "Error: %s\n\nTry 'generator.py --help' for more information" % e
+        sys.exit(1)
+
+    bits = range(9, 21)
+    sizes = [1, 10, 128]
+    images = 5
+    seed = 0
+    save_path = None
+    baseline_path = None
+    threshold = 10.0
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt == '--cluster_bits':
+            bits = parse_range(arg)
+        elif opt == '--sizes':
+            sizes = [float(x) for x in arg.split(',')]
+        elif opt in ('-n', '--images'):
+            images = int(arg)
+        elif opt in ('-s', '--seed'):
+            seed = int(arg)
+        elif opt == '--save':
+            save_path = arg
+        elif opt == '--baseline':
+            baseline_path = arg
+        elif opt == '--threshold':
+            threshold = float(arg)
+
+    if len(args) != 0:
+        print >>sys.stderr, \
+            "Unexpected parameters\nTry 'generator.py --help'" \
+            " for more information."
+        sys.exit(1)
+    if [x for x in bits if x < 9 or x > 20]:
+        print >>sys.stderr, "Error: Cluster bits should be from 9 to 20."
+        sys.exit(1)
+    if json is None and (save_path is not None or
+                         baseline_path is not None):
+        print >>sys.stderr, "Error: The 'json' module is not found."
+        sys.exit(1)
+
+    baseline = {}
+    if baseline_path is not None:
+        baseline_file = open(baseline_path)
+        try:
+            baseline = json.load(baseline_file)['cells']
+        finally:
+            baseline_file.close()
+
+    work_dir = tempfile.mkdtemp(prefix='qcow2-bench-')
+    # Every cell is measured by a new process
+    pool = multiprocessing.Pool(1, maxtasksperchild=1)
+    cells = []
+    regressions = 0
+    print "bits  size,MB  images/s   fields/s     MB/s  peak,KB " + \
+        " ".join(["%10s" % x for x in PHASES]) + "  (ms per image)"
+    try:
+        for cluster_bits in bits:
+            for size in sizes:
+                # The virtual disk size is aligned to the cluster size
+                image_size = int(size * (1 << 20)) >> cluster_bits << \
+                    cluster_bits
+                cell = pool.apply(bench_cell, ((cluster_bits, image_size,
+                                                images, seed, work_dir),))
+                cells.append(cell)
+                line = "%4d %8.2f %9.2f %10.0f %8.2f %8d " % \
+                    (cluster_bits, float(image_size) / (1 << 20),
+                     cell['images_per_second'], cell['fields_per_second'],
+                     cell['mb_per_second'], cell['peak_rss']) + \
+                    " ".join(["%10.2f" % (1000 * cell['phases'][x] / images)
+                              for x in PHASES])
+                if baseline_path is not None:
+                    change, regression = compare(cell, baseline, threshold)
+                    if change is None:
+                        line += "  new"
+                    else:
+                        line += "  %+.1f%%" % change
+                    if regression:
+                        line += " REGRESSION"
+                        regressions += 1
+                print line
+                sys.stdout.flush()
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(work_dir, True)
+
+    if save_path is not None:
+        save_file = open(save_path, 'w')
+        try:
+            json.dump({'images': images, 'seed': seed,
+                       'cells': dict([(cell_key(x), x) for x in cells])},
+                      save_file, indent=1, sort_keys=True)
+        finally:
+            save_file.close()
+    if regressions:
+        print "%d of %d cells are slower than the baseline by more than " \
+            "%g%%" % (regressions, len(cells), threshold)
+        sys.exit(1)
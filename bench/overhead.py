@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+
+# Benchmark of the test runner overhead
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import getopt
+import shutil
+import tempfile
+import subprocess
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+RUNNER = os.path.join(ROOT, 'runner', 'runner.py')
+GENERATOR = os.path.join(ROOT, 'qcow2')
+
+# Bodies of stub applications under test, 'qemu-img create' creating backing
+# files is handled by all stubs
+STUBS = {
+    'exit': 'exit 0',
+    'sleep': 'sleep %(sleep)s',
+    'crash': 'kill -SEGV $$',
+    'output': "yes 'Output of the stub application under test' | "
+              "head -c %(output)d; exit 0",
+}
+STUB_TEMPLATE = """#!/bin/sh
+if [ "$1" = create ]; then
+    : > "$4" && truncate -s "$5" "$4"
+    exit $?
+fi
+%s
+"""
+# Number of direct executions of a stub measuring its own time
+DIRECT_RUNS = 20
+# Stages of usage records executing applications under test
+EXEC_STAGES = ['command', 'session']
+
+
+def write_stub(directory, name, params):
+    """Create an executable stub application and return its path."""
+    path = os.path.join(directory, name)
+    stub = open(path, 'w')
+    try:
+        stub.write(STUB_TEMPLATE % (STUBS[name] % params))
+    finally:
+        stub.close()
+    os.chmod(path, 0755)
+    return path
+
+
+def direct_exec_time(path):
+    """Return mean wall time of the stub executed directly with its output
+    read from a pipe.
+    """
+    start = time.time()
+    for i in range(DIRECT_RUNS):
+        process = subprocess.Popen([path, 'info', 'test.img'],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT)
+        process.communicate()
+    return (time.time() - start) / DIRECT_RUNS
+
+
+def read_usage(path):
+    """Return numbers of tests and executions, the total wall time of all
+    stages and of executions from the 'usage.log' file of a run.
+    """
+    tests = execs = 0
+    stages = exec_time = 0.0
+    if not os.path.exists(path):
+        return tests, execs, stages, exec_time
+    usage_log = open(path)
+    try:
+        for line in usage_log:
+            tests += 1
+            for record in json.loads(line)['stages']:
+                stages += record['wall']
+                if record['stage'] in EXEC_STAGES:
+                    execs += 1
+                    exec_time += record['wall']
+    finally:
+        usage_log.close()
+    return tests, execs, stages, exec_time
+
+
+def bench_stub(name, stub, duration, jobs, run_seed, runner_args, work_dir):
+    """Run tests with the stub as qemu-img and qemu-io for 'duration' seconds
+    and return results of the run.
+
+    The overhead of a test is the time of the run per test not spent in
+    stages of tests (creation of backing files and images, executions of
+    applications). The overhead of an execution is its time measured by
+    the runner exceeding the time of the stub executed directly.
+    """
+    env = dict(os.environ)
+    env['QEMU_IMG'] = stub
+    env['QEMU_IO'] = stub
+    test_dir = os.path.join(work_dir, name)
+    command = [sys.executable, RUNNER, '-d', str(duration), '-j', str(jobs),
+               '--run_seed', str(run_seed)] + runner_args + \
+              [test_dir, GENERATOR]
+    devnull = open(os.devnull, 'w')
+    try:
+        start = time.time()
+        retcode = subprocess.call(command, env=env, stdout=devnull,
+                                  stderr=subprocess.STDOUT)
+        wall = time.time() - start
+    finally:
+        devnull.close()
+    if retcode != 0:
+        raise OSError("The runner exited with the code %d for the '%s' stub"
+                      % (retcode, name))
+    tests, execs, stages, exec_time = read_usage(os.path.join(test_dir,
+                                                              'usage.log'))
+    direct = direct_exec_time(stub)
+    result = {'stub': name, 'wall': wall, 'tests': tests, 'execs': execs,
+              'direct_exec': direct}
+    if tests == 0 or execs == 0:
+        result['test_overhead'] = result['exec_overhead'] = None
+    else:
+        result['test_overhead'] = (wall * jobs - stages) / tests
+        result['exec_overhead'] = exec_time / execs - direct
+    shutil.rmtree(test_dir, True)
+    return result
+
+
+def compare(result, baseline, threshold):
+    """Return changes of the test and execution overheads of the stub in
+    percents relative to the baseline and True if any of them grew over
+    'threshold' percents.
+
+    None is returned as a change if the stub or its overhead is not in
+    the baseline.
+    """
+    old = baseline.get(result['stub'])
+    changes = []
+    regression = False
+    for key in ('test_overhead', 'exec_overhead'):
+        if old is None or not old.get(key) or result[key] is None:
+            changes.append(None)
+            continue
+        change = 100.0 * (result[key] / old[key] - 1)
+        changes.append(change)
+        if change > threshold:
+            regression = True
+    return changes[0], changes[1], regression
+
+
+def percent(change):
+    """Return the change formatted as percents."""
+    if change is None:
+        return 'new'
+    return '%+.1f%%' % change
+
+
+def ms(value):
+    """Return the number of seconds formatted as milliseconds."""
+    if value is None:
+        return '-'
+    return '%.2f' % (1000 * value)
+
+
+if __name__ == '__main__':
+
+    def usage():
+        print """
+        Usage: overhead.py [OPTION...] [-- RUNNER_OPTION...]
+
+        Measure overhead of the test runner per test and per execution of
+        an application under test. Tests are run with stub applications
+        instead of qemu-img and qemu-io, every stub is run for the same
+        duration. Runner options after '--' are passed to the runner.
+
+        Example:
+          overhead.py -d 20 --stubs exit,output -- --qemu_io_sessions
+          overhead.py --baseline base.json
+
+        Optional arguments:
+          -h, --help                    display this help and exit
+          -d, --duration=NUMBER         run tests with every stub for NUMBER
+                                        of seconds (10 by default)
+          -j, --jobs=NUMBER             run NUMBER of tests in parallel
+          --stubs=LIST                  comma separated stubs: 'exit' exits
+                                        immediately, 'sleep' sleeps, 'crash'
+                                        is killed by SIGSEGV, 'output' writes
+                                        a lot to the standard output (all by
+                                        default)
+          --sleep=SECONDS               time of the 'sleep' stub (0.01 by
+                                        default)
+          --output=NUMBER               number of KB written by the 'output'
+                                        stub (1024 by default)
+          --run_seed=STRING             seed for the sequence of test seeds
+                                        (0 by default)
+          --save=PATH                   save results as a baseline to
+                                        the JSON file
+          --baseline=PATH               compare results with the baseline
+                                        from the JSON file and exit with
+                                        the code 1 if any overhead grew
+          --threshold=PERCENT           growth of an overhead per test or per
+                                        execution not reported as
+                                        a regression, 20 by default
+        """
+
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'hd:j:',
+                                       ['help', 'duration=', 'jobs=',
+                                        'stubs=', 'sleep=', 'output=',
+                                        'run_seed=', 'save=', 'baseline=',
+                                        'threshold='])
+    except getopt.error, e:
+        print >>sys.stderr, \
+            "Error: %s\n\nTry 'overhead.py --help' for more information" % e
+        sys.exit(1)
+
+    duration = 10
+    jobs = 1
+    stubs = ['exit', 'sleep', 'crash', 'output']
+    params = {'sleep': '0.01', 'output': 1024 * 1024}
+    run_seed = '0'
+    save_path = None
+    baseline_path = None
+    threshold = 20.0
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-d', '--duration'):
+            duration = int(arg)
+        elif opt in ('-j', '--jobs'):
+            jobs = int(arg)
+        elif opt == '--stubs':
+            stubs = arg.split(',')
+        elif opt == '--sleep':
+            params['sleep'] = str(float(arg))
+        elif opt == '--output':
+            params['output'] = int(arg) * 1024
+        elif opt == '--run_seed':
+            run_seed = arg
+        elif opt == '--save':
+            save_path = arg
+        elif opt == '--baseline':
+            baseline_path = arg
+        elif opt == '--threshold':
+            threshold = float(arg)
+
+    unknown = [x for x in stubs if x not in STUBS]
+    if unknown:
+        print >>sys.stderr, \
+            "Error: Unknown stubs: %s\nTry 'overhead.py --help' for more " \
+            "information" % ', '.join(unknown)
+        sys.exit(1)
+    if json is None:
+        print >>sys.stderr, "Error: The 'json' module is not found."
+        sys.exit(1)
+
+    baseline = {}
+    if baseline_path is not None:
+        baseline_file = open(baseline_path)
+        try:
+            baseline = json.load(baseline_file)['stubs']
+        finally:
+            baseline_file.close()
+
+    work_dir = tempfile.mkdtemp(prefix='runner-bench-')
+    stub_dir = os.path.join(work_dir, 'stubs')
+    os.mkdir(stub_dir)
+    results = []
+    regressions = 0
+    header = "stub      tests    execs   tests/s   execs/s" \
+        "  test overhead,ms  exec overhead,ms  direct exec,ms"
+    if baseline_path is not None:
+        header += "   test    exec"
+    print header
+    try:
+        for name in stubs:
+            stub = write_stub(stub_dir, name, params)
+            try:
+                result = bench_stub(name, stub, duration, jobs, run_seed,
+                                    args, work_dir)
+            except OSError, e:
+                print >>sys.stderr, "Error: %s" % e
+                sys.exit(1)
+            results.append(result)
+            line = "%-8s %6d %8d %9.2f %9.2f %17s %17s %15s" % \
+                (name, result['tests'], result['execs'],
+                 result['tests'] / result['wall'],
+                 result['execs'] / result['wall'],
+                 ms(result['test_overhead']), ms(result['exec_overhead']),
+                 ms(result['direct_exec']))
+            if baseline_path is not None:
+                test_change, exec_change, regression = \
+                    compare(result, baseline, threshold)
+                line += " %7s %7s" % (percent(test_change),
+                                      percent(exec_change))
+                if regression:
+                    line += " REGRESSION"
+                    regressions += 1
+            print line
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(work_dir, True)
+
+    if save_path is not None:
+        save_file = open(save_path, 'w')
+        try:
+            json.dump({'duration': duration, 'jobs': jobs,
+                       'run_seed': run_seed, 'runner_args': args,
+                       'stubs': dict([(x['stub'], x) for x in results])},
+                      save_file, indent=1, sort_keys=True)
+        finally:
+            save_file.close()
+    if regressions:
+        print "%d of %d stubs have overhead higher than the baseline by " \
+            "more than %g%%" % (regressions, len(results), threshold)
+        sys.exit(1)
@@ -16,15 +16,37 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import os
+import time
 import random
 import struct
+import resource
 import fuzz
 from math import ceil
 from os import urandom
+from array import array
 from itertools import chain
+from bisect import bisect_left, bisect_right
 
+try:
+    import cProfile as profile
+except ImportError:
+    # Python 2.4
+    import profile
+import pstats
 
+
+# Default maximal size of the virtual disk
 MAX_IMAGE_SIZE = 10 * (1 << 20)
+# Environment variable overriding MAX_IMAGE_SIZE, in MB
+MAX_IMAGE_SIZE_ENV = 'QCOW2_MAX_IMAGE_SIZE'
+# Maximal number of mutations made by Image.fuzz_more()
+MAX_EXTRA_MUTATIONS = 4
+# Environment variable enabling profiling of create_image(): 'phases' for
+# timers of generation phases, 'cprofile' for timers and function statistics
+PROFILE_ENV = 'QCOW2_PROFILE'
+# Number of functions with the largest cumulative time in a profile
+PROFILE_FUNCTIONS = 20
 # Standard sizes
 UINT32_S = 4
 UINT64_S = 8
@@ -61,18 +83,94 @@ class FieldsList(object):
 
     """List of fields.
 
-    The class allows access to a field in the list by its name.
+    The class allows access to fields in the list by their name and offset.
+    Fields are iterated in the order of their addition. Indexes by names and
+    offsets are updated when a field is added, so names and offsets of fields
+    are not expected to change after that, while their values can be fuzzed.
+    The index by offsets is built on the first query by offset, because such
+    queries are rare comparing with lookups by names.
     """
 
     def __init__(self, meta_data=None):
-        if meta_data is None:
-            self.data = []
-        else:
-            self.data = [Field(*f)
-                         for f in meta_data]
+        self.data = []
+        # Name -> fields with the name in the order of addition
+        self.names = {}
+        # Offset -> fields starting at the offset
+        self.offsets = None
+        # Sorted offsets of fields and the maximal field size, they are
+        # calculated on the first overlap query after addition of fields
+        self.sorted_offsets = None
+        self.max_size = 0
+        if meta_data is not None:
+            self.extend([Field(*f) for f in meta_data])
+
+    def append(self, field):
+        """Add the field to the end of the list."""
+        self.extend([field])
+
+    def extend(self, fields):
+        """Add fields to the end of the list."""
+        names = self.names
+        for field in fields:
+            name = field.name
+            if name in names:
+                names[name].append(field)
+            else:
+                names[name] = [field]
+        if self.offsets is not None:
+            self._index_offsets(fields)
+        self.data.extend(fields)
+        self.sorted_offsets = None
 
     def __getitem__(self, name):
-        return [x for x in self.data if x.name == name]
+        return list(self.names.get(name, []))
+
+    def at(self, offset):
+        """Return fields starting at the offset."""
+        if self.offsets is None:
+            self.offsets = {}
+            self._index_offsets(self.data)
+        return list(self.offsets.get(offset, []))
+
+    def overlapping(self, start, end):
+        """Return fields having at least one byte in the [start, end) range
+        of offsets sorted by their offsets.
+        """
+        if self.offsets is None:
+            self.offsets = {}
+            self._index_offsets(self.data)
+        if self.sorted_offsets is None:
+            self.sorted_offsets = sorted(self.offsets.keys())
+            self.max_size = max([0] + [struct.calcsize(x.fmt)
+                                       for x in self.data])
+        first = bisect_left(self.sorted_offsets, start - self.max_size + 1)
+        last = bisect_left(self.sorted_offsets, end)
+        result = []
+        for offset in self.sorted_offsets[first:last]:
+            for field in self.offsets[offset]:
+                if offset + struct.calcsize(field.fmt) > start:
+                    result.append(field)
+        return result
+
+    def field_offsets(self):
+        """Return offsets of all fields."""
+        return [x.offset for x in self.data]
+
+    def write(self, image_file):
+        """Write all fields to the image file."""
+        for field in self.data:
+            image_file.seek(field.offset)
+            image_file.write(struct.pack(field.fmt, field.value))
+
+    def _index_offsets(self, fields):
+        """Add fields to the index by offsets."""
+        offsets = self.offsets
+        for field in fields:
+            offset = field.offset
+            if offset in offsets:
+                offsets[offset].append(field)
+            else:
+                offsets[offset] = [field]
 
     def __iter__(self):
         return iter(self.data)
@@ -81,6 +179,241 @@ class FieldsList(object):
         return len(self.data)
 
 
+class TableField(object):
+
+    """Field of a FieldsArray.
+
+    The field behaves as a Field object, but its offset and value are stored
+    in arrays of the table.
+    """
+
+    __slots__ = ('table', 'index', 'fmt', 'name')
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+        self.fmt = table.fmt
+        self.name = table.name
+
+    def _get_offset(self):
+        return self.table.offsets[self.index]
+
+    def _get_value(self):
+        return self.table.get_value(self.index)
+
+    def _set_value(self, value):
+        self.table.set_value(self.index, value)
+
+    offset = property(_get_offset)
+    value = property(_get_value, _set_value)
+
+    def __iter__(self):
+        return iter([self.fmt, self.offset, self.value, self.name])
+
+    def __repr__(self):
+        return "Field(fmt='%s', offset=%d, value=%s, name=%s)" % \
+            (self.fmt, self.offset, str(self.value), self.name)
+
+
+class TableFields(object):
+
+    """Sequence of all fields of a FieldsArray as returned by a lookup by
+    their name.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self.table)
+        if not 0 <= index < len(self.table):
+            raise IndexError('field index out of range')
+        return TableField(self.table, index)
+
+    def __iter__(self):
+        return iter(self.table)
+
+    def __len__(self):
+        return len(self.table)
+
+
+class FieldsArray(object):
+
+    """Table of fields with the same format and name, e.g. L2 entries.
+
+    Offsets and values of fields are stored in typed arrays, so a field takes
+    a few bytes instead of a Field object. The table can be iterated and
+    accessed by the name of its fields as FieldsList, fields are represented
+    by TableField objects then. Fuzzed values not fitting the array, e.g.
+    values out of the range of the field format, are kept aside. As in
+    FieldsList, fields can be queried by offsets, the index of offsets is
+    built on the first query.
+    """
+
+    # Array types of values of field formats
+    VALUE_TYPES = {'B': 'B', 'H': 'H', 'I': 'L', 'Q': 'L'}
+
+    def __init__(self, fmt, name):
+        self.fmt = fmt
+        self.name = name
+        self.offsets = array('L')
+        self.values = array(self.VALUE_TYPES[fmt[-1]])
+        # Index -> value not fitting the array
+        self.overrides = {}
+        # Indices of fields sorted by their offsets and the sorted offsets,
+        # they are calculated on the first query by offset after addition of
+        # fields
+        self.order = None
+        self.sorted_offsets = None
+
+    def append(self, offset, value):
+        """Add a field to the end of the table."""
+        self.order = None
+        self.offsets.append(offset)
+        self.values.append(0)
+        self.set_value(len(self.values) - 1, value)
+
+    def get_value(self, index):
+        """Return the value of the field with the index."""
+        if index in self.overrides:
+            return self.overrides[index]
+        return self.values[index]
+
+    def set_value(self, index, value):
+        """Set the value of the field with the index."""
+        try:
+            self.values[index] = value
+        except (OverflowError, TypeError):
+            self.overrides[index] = value
+        else:
+            if index in self.overrides:
+                del self.overrides[index]
+
+    def at(self, offset):
+        """Return fields starting at the offset."""
+        self._index_offsets()
+        first = bisect_left(self.sorted_offsets, offset)
+        last = bisect_right(self.sorted_offsets, offset)
+        return [TableField(self, self.order[i]) for i in xrange(first, last)]
+
+    def overlapping(self, start, end):
+        """Return fields having at least one byte in the [start, end) range
+        of offsets sorted by their offsets.
+        """
+        self._index_offsets()
+        # All fields have the same size
+        first = bisect_left(self.sorted_offsets,
+                            start - struct.calcsize(self.fmt) + 1)
+        last = bisect_left(self.sorted_offsets, end)
+        return [TableField(self, self.order[i]) for i in xrange(first, last)]
+
+    def field_offsets(self):
+        """Return offsets of all fields."""
+        return self.offsets
+
+    def _index_offsets(self):
+        """Sort fields by their offsets if they were added after the last
+        sorting.
+        """
+        if self.order is not None:
+            return
+        offsets = self.offsets
+        self.order = array('L', sorted(xrange(len(offsets)),
+                                       key=offsets.__getitem__))
+        self.sorted_offsets = array('L', [offsets[i] for i in self.order])
+
+    def write(self, image_file):
+        """Write all fields to the image file."""
+        fmt = self.fmt
+        overrides = self.overrides
+        values = self.values
+        index = 0
+        for offset in self.offsets:
+            if index in overrides:
+                value = overrides[index]
+            else:
+                value = values[index]
+            image_file.seek(offset)
+            image_file.write(struct.pack(fmt, value))
+            index += 1
+
+    def __getitem__(self, name):
+        if name == self.name:
+            return TableFields(self)
+        return []
+
+    def __iter__(self):
+        for index in xrange(len(self.offsets)):
+            yield TableField(self, index)
+
+    def __len__(self):
+        return len(self.offsets)
+
+
+class Profiler(object):
+
+    """Profiler of phases of image generation.
+
+    mark() finishes the current phase and starts the next one. For every
+    phase wall-clock time and growth of the peak resident set size of
+    the process are recorded. In the 'cprofile' mode function statistics of
+    all phases are also collected. Without a mode the profiler does nothing.
+    """
+
+    def __init__(self, mode=None):
+        self.mode = mode
+        self.phases = []
+        self.profile = None
+        if mode is None:
+            return
+        self.last = time.time()
+        self.start = self.last
+        self.rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if mode == 'cprofile':
+            self.profile = profile.Profile()
+            self.profile.enable()
+
+    def mark(self, name):
+        """Finish the phase with the specified name."""
+        if self.mode is None:
+            return
+        now = time.time()
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.phases.append((name, now - self.last, rss - self.rss))
+        self.last = now
+        self.rss = rss
+
+    def save(self, path):
+        """Write the profile to the text file.
+
+        Every phase takes a line 'phase NAME SECONDS RSS_GROWTH_KB',
+        followed by a 'total SECONDS PEAK_RSS_KB' line and in the 'cprofile'
+        mode by lines 'function CALLS OWN_SECONDS CUMULATIVE_SECONDS
+        FILE:LINE(NAME)' of PROFILE_FUNCTIONS functions with the largest
+        cumulative time.
+        """
+        if self.mode is None:
+            return
+        lines = ['phase %s %.6f %d' % x for x in self.phases]
+        lines.append('total %.6f %d' % (self.last - self.start, self.rss))
+        if self.profile is not None:
+            self.profile.disable()
+            stats = pstats.Stats(self.profile).stats
+            functions = [(v[3], v[2], v[1], k) for k, v in stats.items()]
+            functions.sort()
+            functions.reverse()
+            for cumulative, own, calls, key in \
+                    functions[:PROFILE_FUNCTIONS]:
+                lines.append('function %d %.6f %.6f %s:%d(%s)' %
+                             ((calls, own, cumulative) + key))
+        profile_file = open(path, 'w')
+        try:
+            profile_file.write('\n'.join(lines) + '\n')
+        finally:
+            profile_file.close()
+
+
 class Image(object):
 
     """ Qcow2 image object.
@@ -90,6 +423,11 @@ class Image(object):
     a file.
     """
 
+    # Image elements in the order of their fields in the image iteration
+    ELEMENTS = ['header', 'backing_file_format', 'feature_name_table',
+                'end_of_extension_area', 'backing_file_name', 'l1_table',
+                'l2_tables', 'refcount_table', 'refcount_blocks']
+
     def __init__(self, backing_file_name=None):
         """Create a random valid qcow2 image with the correct header and stored
         backing file name.
@@ -112,12 +450,11 @@ class Image(object):
                                               self.cluster_size)
         # Percentage of fields will be fuzzed
         self.bias = random.uniform(0.1, 0.5)
+        # Mutations made by fuzz()
+        self.mutations = []
 
     def __iter__(self):
-        return chain(self.header, self.backing_file_format,
-                     self.feature_name_table, self.end_of_extension_area,
-                     self.backing_file_name, self.l1_table, self.l2_tables,
-                     self.refcount_table, self.refcount_blocks)
+        return chain(*[getattr(self, x) for x in self.ELEMENTS])
 
     def create_header(self, cluster_bits, backing_file_name=None):
         """Generate a random valid header."""
@@ -279,7 +616,7 @@ class Image(object):
             # While snapshots are not supported, bit #63 = 1
             # Compressed clusters are not supported => bit #62 = 0
             entry_val = (1 << 63) + cluster_descriptor
-            return ['>Q', entry_offset, entry_val, 'l2_entry']
+            return entry_offset, entry_val
 
         def create_l1_entry(l2_cluster, l1_offset, guest):
             """Generate one L1 entry."""
@@ -287,15 +624,18 @@ class Image(object):
             entry_offset = l1_offset + UINT64_S * (guest / l2_size)
             # While snapshots are not supported bit #63 = 1
             entry_val = (1 << 63) + l2_cluster * self.cluster_size
-            return ['>Q', entry_offset, entry_val, 'l1_entry']
+            return entry_offset, entry_val
 
+        # L1 entries
+        l1 = FieldsArray('>Q', 'l1_entry')
+        # L2 entries
+        l2 = FieldsArray('>Q', 'l2_entry')
         if len(self.data_clusters) == 0:
             # All metadata for an empty guest image needs 4 clusters:
             # header, rfc table, rfc block, L1 table.
             # Header takes cluster #0, other clusters ##1-3 can be used
             l1_offset = random.randint(1, 3) * self.cluster_size
-            l1 = [['>Q', l1_offset, 0, 'l1_entry']]
-            l2 = []
+            l1.append(l1_offset, 0)
         else:
             meta_data = self._get_metadata()
             guest_clusters = random.sample(range(self.image_size /
@@ -309,27 +649,19 @@ class Image(object):
                                                    meta_data, l1_size)
             meta_data |= set(range(l1_start, l1_start + l1_size))
             l1_offset = l1_start * self.cluster_size
-            # Indices of L2 tables
-            l2_ids = []
-            # Host clusters allocated for L2 tables
-            l2_clusters = []
-            # L1 entries
-            l1 = []
-            # L2 entries
-            l2 = []
+            allocate_l2_cluster = self._cluster_allocator(self.data_clusters |
+                                                          meta_data)
+            # Index of a L2 table -> host cluster allocated for it
+            l2_clusters = {}
             for host, guest in zip(self.data_clusters, guest_clusters):
                 l2_id = guest / l_size
-                if l2_id not in l2_ids:
-                    l2_ids.append(l2_id)
-                    l2_clusters.append(self._get_adjacent_clusters(
-                        self.data_clusters | meta_data | set(l2_clusters),
-                        1))
-                    l1.append(create_l1_entry(l2_clusters[-1], l1_offset,
-                                              guest))
-                l2.append(create_l2_entry(host, guest,
-                                          l2_clusters[l2_ids.index(l2_id)]))
-        self.l2_tables = FieldsList(l2)
-        self.l1_table = FieldsList(l1)
+                if l2_id not in l2_clusters:
+                    l2_clusters[l2_id] = allocate_l2_cluster()
+                    l1.append(*create_l1_entry(l2_clusters[l2_id], l1_offset,
+                                               guest))
+                l2.append(*create_l2_entry(host, guest, l2_clusters[l2_id]))
+        self.l2_tables = l2
+        self.l1_table = l1
         self.header['l1_size'][0].value = int(ceil(UINT64_S * self.image_size /
                                                 float(self.cluster_size**2)))
         self.header['l1_table_offset'][0].value = l1_offset
@@ -400,8 +732,7 @@ class Image(object):
                                cluster):
             """Generate a refcount table entry."""
             offset = table_offset + UINT64_S * (cluster / block_size)
-            return ['>Q', offset, block_cluster * self.cluster_size,
-                    'refcount_table_entry']
+            return offset, block_cluster * self.cluster_size
 
         def create_block_entry(block_cluster, block_size, cluster):
             """Generate a list of entries for the current block."""
@@ -409,7 +740,7 @@ class Image(object):
             offset = block_cluster * self.cluster_size
             entry_offset = offset + entry_size * (cluster % block_size)
             # While snapshots are not supported all refcounts are set to 1
-            return ['>H', entry_offset, 1, 'refcount_block_entry']
+            return entry_offset, 1
 
         # Number of refcount entries per refcount block
         block_size = self.cluster_size / \
@@ -445,21 +776,21 @@ class Image(object):
         # Indices of refcount blocks
         block_ids = list(block_ids)
         # Refcount table entries
-        rfc_table = []
+        rfc_table = FieldsArray('>Q', 'refcount_table_entry')
         # Refcount entries
-        rfc_blocks = []
+        rfc_blocks = FieldsArray('>H', 'refcount_block_entry')
 
         for cluster in sorted(self.data_clusters | meta_data):
             if cluster / block_size != block_id:
                 block_id = cluster / block_size
                 block_cluster = block_clusters[block_ids.index(block_id)]
-                rfc_table.append(create_table_entry(table_offset,
-                                                    block_cluster,
-                                                    block_size, cluster))
-            rfc_blocks.append(create_block_entry(block_cluster, block_size,
-                                                 cluster))
-        self.refcount_table = FieldsList(rfc_table)
-        self.refcount_blocks = FieldsList(rfc_blocks)
+                rfc_table.append(*create_table_entry(table_offset,
+                                                     block_cluster,
+                                                     block_size, cluster))
+            rfc_blocks.append(*create_block_entry(block_cluster, block_size,
+                                                  cluster))
+        self.refcount_table = rfc_table
+        self.refcount_blocks = rfc_blocks
 
         self.header['refcount_table_offset'][0].value = table_offset
         self.header['refcount_table_clusters'][0].value = len(table_clusters)
@@ -475,6 +806,10 @@ class Image(object):
 
         In the first case the field will be fuzzed always.
         In the second a random subset of fields will be selected and fuzzed.
+
+        Every mutation is recorded to 'mutations' as a tuple of an element
+        name, a field name, an index of the field among fields of
+        the element with the same name, an original and a fuzzed value.
         """
         def coin():
             """Return boolean value proportional to a portion of fields to be
@@ -483,28 +818,119 @@ class Image(object):
             return random.random() < self.bias
 
         if fields_to_fuzz is None:
-            for field in self:
-                if coin():
-                    field.value = getattr(fuzz, field.name)(field.value)
+            for element in self.ELEMENTS:
+                for field, index in self._indexed(element):
+                    if coin():
+                        self._mutate(element, field, index)
         else:
             for item in fields_to_fuzz:
                 if len(item) == 1:
-                    for field in getattr(self, item[0]):
+                    for field, index in self._indexed(item[0]):
                         if coin():
-                            field.value = getattr(fuzz,
-                                                  field.name)(field.value)
+                            self._mutate(item[0], field, index)
                 else:
                     # If fields with the requested name were not generated
                     # getattr(self, item[0])[item[1]] returns an empty list
-                    for field in getattr(self, item[0])[item[1]]:
-                        field.value = getattr(fuzz, field.name)(field.value)
+                    fields = getattr(self, item[0])[item[1]]
+                    for index in range(len(fields)):
+                        self._mutate(item[0], fields[index], index)
+
+    def fuzz_more(self, seed, fields_to_fuzz=None):
+        """Fuzz from one to MAX_EXTRA_MUTATIONS more random fields.
+
+        Fields are selected from ones allowed by 'fields_to_fuzz' as for
+        fuzz(). Random numbers are taken from the sequence defined by 'seed',
+        the state of the random generator is restored after that.
+        """
+        if fields_to_fuzz is None:
+            fields_to_fuzz = [[x] for x in self.ELEMENTS]
+        # Candidate fields by groups: (element, fields, number of fields),
+        # fields of a table are taken all at once without field objects
+        groups = []
+        total = 0
+        for item in fields_to_fuzz:
+            fields = getattr(self, item[0])
+            if isinstance(fields, FieldsArray):
+                if len(item) > 1 and fields.name != item[1]:
+                    continue
+            else:
+                fields = [(field, index) for field, index
+                          in self._indexed(item[0])
+                          if len(item) == 1 or field.name == item[1]]
+            groups.append((item[0], fields, len(fields)))
+            total += len(fields)
+        if total == 0:
+            return
+        state = random.getstate()
+        random.seed(seed)
+        try:
+            for i in range(random.randint(1, MAX_EXTRA_MUTATIONS)):
+                number = random.choice(xrange(total))
+                for element, fields, size in groups:
+                    if number < size:
+                        break
+                    number -= size
+                if isinstance(fields, FieldsArray):
+                    self._mutate(element, TableField(fields, number), number)
+                else:
+                    self._mutate(element, *fields[number])
+        finally:
+            random.setstate(state)
+
+    def replay(self, mutations):
+        """Revert all mutations made by fuzz() and apply the specified ones
+        instead.
+
+        'mutations' is a list in the form of 'mutations' of the image, only
+        element names, field names, indices and fuzzed values are used.
+        Mutations of fields not existing in the image are skipped.
+        """
+        for element, name, index, original, value in \
+                reversed(self.mutations):
+            getattr(self, element)[name][index].value = original
+        self.mutations = []
+        for element, name, index, original, value in mutations:
+            fields = getattr(self, element, FieldsList())[name]
+            if index >= len(fields):
+                continue
+            field = fields[index]
+            if isinstance(value, unicode):
+                # String values of mutations loaded from JSON
+                value = value.encode('latin-1')
+            self.mutations.append((element, name, index, field.value, value))
+            field.value = value
+
+    def _mutate(self, element, field, index):
+        """Fuzz the field and record the mutation."""
+        original = field.value
+        field.value = getattr(fuzz, field.name)(field.value)
+        self.mutations.append((element, field.name, index, original,
+                               field.value))
+
+    def _indexed(self, element):
+        """Generate pairs of fields of the element and their indices among
+        fields with the same name.
+
+        Fields of a table are created one at a time, so big tables are not
+        duplicated by field objects.
+        """
+        fields = getattr(self, element)
+        if isinstance(fields, FieldsArray):
+            # All fields of a table have the same name
+            for index in xrange(len(fields)):
+                yield TableField(fields, index), index
+            return
+        counts = {}
+        for field in fields:
+            index = counts.get(field.name, 0)
+            counts[field.name] = index + 1
+            yield field, index
 
     def write(self, filename):
         """Write an entire image to the file."""
         image_file = open(filename, 'w')
-        for field in self:
-            image_file.seek(field.offset)
-            image_file.write(struct.pack(field.fmt, field.value))
+        for element in self.ELEMENTS:
+            getattr(self, element).write(image_file)
 
         for cluster in sorted(self.data_clusters):
             image_file.seek(cluster * self.cluster_size)
@@ -526,7 +952,7 @@ class Image(object):
         """
         cluster_bits = random.randrange(9, 21)
         cluster_size = 1 << cluster_bits
-        img_size = random.randrange(0, MAX_IMAGE_SIZE + 1, cluster_size)
+        img_size = random.randrange(0, max_image_size() + 1, cluster_size)
         return (cluster_bits, img_size)
 
     @staticmethod
@@ -544,6 +970,45 @@ class Image(object):
         else:
             return free | set(range(append_id, append_id + number - len(free)))
 
+    @staticmethod
+    def _cluster_allocator(used):
+        """Return a function allocating one cluster at a call.
+
+        'used' contains indices of currently allocated clusters, allocated
+        clusters are added to it. As for _get_adjacent_clusters() with
+        the size of one cluster, a random sequence of free clusters between
+        'used' ones is chosen and its last cluster is allocated; if there are
+        no free clusters, the cluster is appended to the end of 'used'.
+        Sequences of free clusters are tracked by their last clusters, so
+        a cluster is allocated in constant time.
+        """
+        append_id = [max(used) + 1]
+        # Last clusters of sequences of free clusters and their positions
+        ends = [x for x in xrange(1, append_id[0] - 1)
+                if x not in used and x + 1 in used]
+        positions = dict([(x, i) for i, x in enumerate(ends)])
+
+        def allocate():
+            """Return an index of the allocated cluster."""
+            if not ends:
+                cluster = append_id[0]
+                append_id[0] += 1
+            else:
+                cluster = random.choice(ends)
+                # Replace the cluster by the last one in the list
+                last = ends.pop()
+                if last != cluster:
+                    ends[positions[cluster]] = last
+                    positions[last] = positions[cluster]
+                del positions[cluster]
+                # The previous free cluster ends the shortened sequence
+                if cluster > 1 and cluster - 1 not in used:
+                    positions[cluster - 1] = len(ends)
+                    ends.append(cluster - 1)
+            used.add(cluster)
+            return cluster
+        return allocate
+
     @staticmethod
     def _get_adjacent_clusters(used, size):
         """Return an index of the first cluster in the sequence of free ones.
@@ -592,20 +1057,61 @@ class Image(object):
     def _get_metadata(self):
         """Return indices of clusters allocated for image metadata."""
         ids = set()
-        for x in self:
-            ids.add(x.offset/self.cluster_size)
+        for element in self.ELEMENTS:
+            for offset in getattr(self, element).field_offsets():
+                ids.add(offset/self.cluster_size)
         return ids
 
 
+def max_image_size():
+    """Return the maximal size of the virtual disk in bytes.
+
+    It's taken from the MAX_IMAGE_SIZE_ENV environment variable if set.
+    """
+    size = os.environ.get(MAX_IMAGE_SIZE_ENV)
+    if size:
+        return int(float(size) * (1 << 20))
+    return MAX_IMAGE_SIZE
+
+
 def create_image(test_img_path, backing_file_name=None, backing_file_fmt=None,
-                 fields_to_fuzz=None):
-    """Create a fuzzed image and write it to the specified file."""
+                 fields_to_fuzz=None, mutations=None, replay=None,
+                 mutation_seed=None):
+    """Create a fuzzed image and write it to the specified file.
+
+    If 'replay' is specified, the image gets mutations from this list instead
+    of random ones. The random sequence is consumed the same way in both
+    cases, so mutations recorded for a seed can be replayed for it.
+    If 'mutation_seed' is specified, a few more random fields are fuzzed
+    using the sequence defined by this seed.
+
+    If 'mutations' is a list, all mutations of the image are appended to it
+    as described in Image.fuzz().
+
+    If the PROFILE_ENV environment variable is set, phases of generation are
+    profiled and the profile is written to the 'test_img_path.profile' file
+    as described in Profiler.save().
+    """
+    profiler = Profiler(os.environ.get(PROFILE_ENV) or None)
     image = Image(backing_file_name)
+    profiler.mark('init')
     image.set_backing_file_format(backing_file_fmt)
     image.create_feature_name_table()
     image.set_end_of_extension_area()
+    profiler.mark('extensions')
     image.create_l_structures()
+    profiler.mark('l_tables')
     image.create_refcount_structures()
+    profiler.mark('refcounts')
     image.fuzz(fields_to_fuzz)
+    if replay is not None:
+        image.replay(replay)
+    if mutation_seed is not None:
+        image.fuzz_more(mutation_seed, fields_to_fuzz)
+    if mutations is not None:
+        mutations.extend(image.mutations)
+    profiler.mark('fuzz')
     image.write(test_img_path)
+    profiler.mark('write')
+    profiler.save(test_img_path + '.profile')
     return image.image_size
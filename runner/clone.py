@@ -0,0 +1,213 @@
+# Fast copying of test images
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import errno
+import fcntl
+import shutil
+
+try:
+    import ctypes
+    import ctypes.util
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    except (OSError, TypeError):
+        # TypeError: 'use_errno' is not supported before Python 2.6
+        libc = None
+except ImportError:
+    libc = None
+
+# ioctl request for cloning of a file (include/uapi/linux/fs.h)
+FICLONE = 0x40049409
+# lseek() whence values not defined by the 'os' module of Python 2
+SEEK_DATA = 3
+SEEK_HOLE = 4
+# Size of a chunk copied by one system call
+CHUNK_SIZE = 1 << 20
+# Size of a block checked for zeroes by the sparse copy
+BLOCK_SIZE = 1 << 16
+ZERO_BLOCK = '\0' * BLOCK_SIZE
+# Error codes meaning that a strategy is not supported for the files
+UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.EXDEV,
+               errno.ENOSYS, errno.EBADF)
+
+
+class NotSupported(Exception):
+    """Exception for a copy strategy not supported for the files."""
+    pass
+
+
+def _check_unsupported(e):
+    """Raise NotSupported if the error 'e' means that the strategy is not
+    supported.
+    """
+    if e.errno in UNSUPPORTED:
+        raise NotSupported
+    raise e
+
+
+def reflink(src_fd, dst_fd, size):
+    """Share data blocks of the source file with the destination one.
+
+    Only file systems with the copy-on-write support (e.g. Btrfs, XFS)
+    support this strategy.
+    """
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+    except IOError, e:
+        _check_unsupported(e)
+
+
+def _data_segments(fd, size):
+    """Return a list of (start, end) pairs of file areas containing data.
+
+    If the file system doesn't support SEEK_DATA/SEEK_HOLE, the entire file is
+    considered as one segment.
+    """
+    segments = []
+    offset = 0
+    while offset < size:
+        try:
+            start = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                # No data after the offset
+                break
+            return [(0, size)]
+        end = os.lseek(fd, start, SEEK_HOLE)
+        segments.append((start, end))
+        offset = end
+    return segments
+
+
+def _syscall_copy(func, src_fd, dst_fd, size):
+    """Copy data segments of the source file by repeated calls of
+    'func(src_fd, dst_fd, count)' copying 'count' bytes from the current file
+    positions.
+
+    Holes of the source file are not copied.
+    """
+    started = False
+    for start, end in _data_segments(src_fd, size):
+        os.lseek(src_fd, start, os.SEEK_SET)
+        os.lseek(dst_fd, start, os.SEEK_SET)
+        offset = start
+        while offset < end:
+            count = func(src_fd, dst_fd, min(CHUNK_SIZE, end - offset))
+            if count < 0:
+                e = OSError(ctypes.get_errno(),
+                            os.strerror(ctypes.get_errno()))
+                if not started:
+                    _check_unsupported(e)
+                raise e
+            if count == 0:
+                break
+            started = True
+            offset += count
+    os.ftruncate(dst_fd, size)
+
+
+def copy_file_range(src_fd, dst_fd, size):
+    """Copy data inside the kernel via copy_file_range(2)."""
+    func = getattr(libc, 'copy_file_range', None)
+    if func is None:
+        raise NotSupported
+    func.restype = ctypes.c_ssize_t
+    _syscall_copy(lambda src, dst, count:
+                  func(src, None, dst, None, ctypes.c_size_t(count), 0),
+                  src_fd, dst_fd, size)
+
+
+def sendfile(src_fd, dst_fd, size):
+    """Copy data inside the kernel via sendfile(2)."""
+    func = getattr(libc, 'sendfile', None)
+    if func is None:
+        raise NotSupported
+    func.restype = ctypes.c_ssize_t
+    _syscall_copy(lambda src, dst, count:
+                  func(dst, src, None, ctypes.c_size_t(count)),
+                  src_fd, dst_fd, size)
+
+
+def sparse_copy(src_fd, dst_fd, size):
+    """Copy data preserving holes of the source file.
+
+    Areas not allocated in the source file and blocks filled with zeroes
+    are not written to the destination one.
+    """
+    for start, end in _data_segments(src_fd, size):
+        os.lseek(src_fd, start, os.SEEK_SET)
+        offset = start
+        while offset < end:
+            block = os.read(src_fd, min(BLOCK_SIZE, end - offset))
+            if not block:
+                break
+            if block != ZERO_BLOCK[:len(block)]:
+                os.lseek(dst_fd, offset, os.SEEK_SET)
+                os.write(dst_fd, block)
+            offset += len(block)
+    os.ftruncate(dst_fd, size)
+
+
+class Cloner(object):
+
+    """Copier of files using the fastest strategy supported.
+
+    Strategies are tried in the order of STRATEGIES. A strategy once failed
+    as not supported is not used for next copies. The name of the last used
+    strategy is available as 'strategy'.
+    """
+
+    STRATEGIES = [('reflink', reflink),
+                  ('copy_file_range', copy_file_range),
+                  ('sendfile', sendfile),
+                  ('sparse copy', sparse_copy)]
+
+    def __init__(self):
+        self.strategies = list(self.STRATEGIES)
+        if libc is None:
+            self.strategies = [s for s in self.strategies
+                               if s[1] not in (copy_file_range, sendfile)]
+        self.strategy = None
+
+    def clone(self, src, dst):
+        """Copy the file 'src' to 'dst' with its permission bits and return
+        the name of the strategy used.
+        """
+        size = os.path.getsize(src)
+        src_fd = os.open(src, os.O_RDONLY)
+        try:
+            while True:
+                name, strategy = self.strategies[0]
+                dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                                 0666)
+                try:
+                    try:
+                        os.lseek(src_fd, 0, os.SEEK_SET)
+                        strategy(src_fd, dst_fd, size)
+                        break
+                    except NotSupported:
+                        # The last strategy always succeeds
+                        del self.strategies[0]
+                finally:
+                    os.close(dst_fd)
+        finally:
+            os.close(src_fd)
+        shutil.copymode(src, dst)
+        self.strategy = name
+        return name
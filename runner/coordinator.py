@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+
+# Coordinator of test runners on multiple hosts
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import socket
+import getopt
+import threading
+import SocketServer
+from collections import deque
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        # The coordinator and the worker mode are not supported
+        json = None
+
+# Keys of command results sent to the coordinator
+RESULT_KEYS = ['number', 'command', 'retcode', 'signal', 'timed_out',
+               'duration', 'bucket', 'description']
+
+
+def connect(address):
+    """Return a socket connected to the address.
+
+    The address is 'unix:PATH' for a Unix socket or 'HOST:PORT' for a TCP
+    socket.
+    """
+    if address.startswith('unix:'):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(address[5:])
+    else:
+        host, port = address.rsplit(':', 1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((host, int(port)))
+    return sock
+
+
+class Connection(object):
+
+    """Connection speaking the coordinator protocol: every message is a JSON
+    object on its own line.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+        self.wfile = sock.makefile('wb')
+
+    def send(self, message):
+        """Send a message."""
+        self.wfile.write(json.dumps(message) + '\n')
+        self.wfile.flush()
+
+    def receive(self):
+        """Return the next message or None if the connection is closed."""
+        line = self.rfile.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def close(self):
+        """Close the connection."""
+        self.rfile.close()
+        self.wfile.close()
+        self.sock.close()
+
+
+class Worker(object):
+
+    """Source of tests leased from the coordinator for the worker mode of
+    the runner.
+
+    next() returns a tuple of a test number, a seed, commands and a fuzzer
+    configuration of the next test or None if no test is available now.
+    'finished' becomes True when the coordinator has no more tests.
+    Results of tests are sent back via report().
+    """
+
+    # Seconds to wait before the next lease request if all tests are leased
+    RETRY = 1
+
+    def __init__(self, address, name):
+        self.connection = Connection(connect(address))
+        self.name = name
+        self.pending = deque()
+        # Test number -> lease id
+        self.leases = {}
+        self.finished = False
+        self.retry_time = 0
+        self.run_seed = None
+
+    def next(self):
+        """Return the next test or None."""
+        if not self.pending and not self.finished and \
+           time.time() >= self.retry_time:
+            try:
+                self.connection.send({'op': 'lease', 'worker': self.name})
+                reply = self.connection.receive()
+            except socket.error:
+                reply = None
+            if reply is None:
+                print >>sys.stderr, \
+                    "Warning: The coordinator closed the connection."
+                self.finished = True
+            elif reply['lease'] is not None:
+                self.run_seed = reply['run_seed']
+                for position, seed in reply['tests']:
+                    self.pending.append((position + 1, str(seed),
+                                         reply['command'], reply['config']))
+                    self.leases[position + 1] = reply['lease']
+            elif reply.get('wait'):
+                self.retry_time = time.time() + reply['wait']
+            else:
+                self.finished = True
+        if self.pending:
+            return self.pending.popleft()
+        return None
+
+    def report(self, status, report):
+        """Send the result of the test to the coordinator.
+
+        'report' is the dictionary returned by TestEnv.report() or None if
+        the test environment could not be set up.
+        """
+        if report is None:
+            return
+        number = int(report['test'])
+        results = []
+        for result in report['results']:
+            results.append(dict([(k, result.get(k)) for k in RESULT_KEYS]))
+        try:
+            self.connection.send({'op': 'result', 'worker': self.name,
+                                  'lease': self.leases.pop(number, None),
+                                  'status': status,
+                                  'report': {'test': report['test'],
+                                             'seed': report['seed'],
+                                             'directory': report['directory'],
+                                             'results': results}})
+        except socket.error, e:
+            if not self.finished:
+                print >>sys.stderr, \
+                    "Warning: Results cannot be sent to the coordinator.\n" \
+                    "Reason: %s" % e
+            self.finished = True
+
+    def close(self):
+        """Close the connection to the coordinator."""
+        self.connection.close()
+
+
+class Coordinator(object):
+
+    """Leases of tests for workers and their results.
+
+    Tests are positions in the sequence of seeds of the run. A lease is
+    a list of up to 'lease_size' tests handed out to a worker, and it's
+    extended every time the worker reports a result. If the worker doesn't
+    report any result for 'lease_timeout' seconds or its connection is
+    closed, unfinished tests of the lease are requeued for other workers.
+    If 'tests' is specified, only this number of tests is leased.
+
+    Results are added to the 'store' ResultStore by save() and crashes to
+    the 'buckets' CrashBuckets if they are specified. All methods except
+    save() and close() are thread-safe, these two are called by the thread
+    which created the store.
+    """
+
+    def __init__(self, run_seed, seeds, lease_size=100, lease_timeout=1800,
+                 tests=None, command=None, config=None, store=None,
+                 buckets=None):
+        self.run_seed = run_seed
+        self.seeds = seeds
+        self.lease_size = lease_size
+        self.lease_timeout = lease_timeout
+        self.tests = tests
+        self.command = command
+        self.config = config
+        self.store = store
+        self.buckets = buckets
+        self.run_id = None
+        self.config_text = None
+        if store is not None:
+            command_text = None
+            if command is not None:
+                command_text = json.dumps(command)
+            if config is not None:
+                self.config_text = json.dumps(config)
+            self.run_id = store.add_run(run_seed, os.getcwd(), None,
+                                        command_text, self.config_text)
+        self.lock = threading.Lock()
+        self.next_position = 0
+        # Tests to be leased again: (position, seed)
+        self.requeued = deque()
+        # Lease id -> {'worker', 'client', 'tests': {position: seed},
+        #              'deadline'}
+        self.leases = {}
+        self.last_lease = 0
+        self.completed = 0
+        self.crashes = 0
+        # Results waiting for save(): (status, report)
+        self.results = []
+        # Number of connected workers
+        self.clients = 0
+
+    def connected(self):
+        """Take into account a new connection of a worker."""
+        self.lock.acquire()
+        try:
+            self.clients += 1
+        finally:
+            self.lock.release()
+
+    def _log(self, message):
+        """Print a message of the coordinator."""
+        print "%s %s" % (time.strftime('%Y-%m-%d %H:%M:%S'), message)
+        sys.stdout.flush()
+
+    def lease(self, worker, client):
+        """Return a reply to the lease request of the worker."""
+        self.lock.acquire()
+        try:
+            self._expire()
+            tests = []
+            while self.requeued and len(tests) < self.lease_size:
+                tests.append(self.requeued.popleft())
+            while len(tests) < self.lease_size:
+                if self.tests is not None and \
+                   self.next_position >= self.tests:
+                    break
+                tests.append((self.next_position, self.seeds.next()))
+                self.next_position += 1
+            if not tests:
+                if self.leases:
+                    return {'lease': None, 'wait': Worker.RETRY}
+                return {'lease': None}
+            self.last_lease += 1
+            self.leases[self.last_lease] = {
+                'worker': worker, 'client': client, 'tests': dict(tests),
+                'deadline': time.time() + self.lease_timeout}
+            self._log("Lease %d: %d tests from %d to %s" %
+                      (self.last_lease, len(tests), tests[0][0] + 1, worker))
+            return {'lease': self.last_lease, 'run_seed': self.run_seed,
+                    'tests': tests, 'command': self.command,
+                    'config': self.config}
+        finally:
+            self.lock.release()
+
+    def result(self, lease_id, worker, status, report):
+        """Record the result of a test reported by the worker.
+
+        The result is dropped if the test is neither in the lease nor
+        requeued, i.e. a late result of an expired lease for the test which
+        is already leased to another worker or finished.
+        """
+        self.lock.acquire()
+        try:
+            position = int(report['test']) - 1
+            lease = self.leases.get(lease_id)
+            if lease is not None and position in lease['tests']:
+                del lease['tests'][position]
+                lease['deadline'] = time.time() + self.lease_timeout
+                if not lease['tests']:
+                    del self.leases[lease_id]
+            else:
+                for item in self.requeued:
+                    if item[0] == position:
+                        # A late result of an expired lease
+                        self.requeued.remove(item)
+                        break
+                else:
+                    self._log("Result of test %d from %s is dropped: "
+                              "the test is leased again or finished" %
+                              (position + 1, worker))
+                    return
+            self.completed += 1
+            report['directory'] = '%s:%s' % (worker, report['directory'])
+            for r in report['results']:
+                if r['bucket'] is not None:
+                    self.crashes += 1
+                    if self.buckets is not None:
+                        self.buckets.add(r['bucket'], r['description'],
+                                         report['seed'], report['directory'])
+            self.results.append((status, report))
+        finally:
+            self.lock.release()
+
+    def disconnect(self, client):
+        """Requeue unfinished tests of leases of the closed connection."""
+        self.lock.acquire()
+        try:
+            self.clients -= 1
+            for lease_id, lease in self.leases.items():
+                if lease['client'] is client:
+                    self._requeue(lease_id, 'connection closed')
+        finally:
+            self.lock.release()
+
+    def expire(self):
+        """Requeue unfinished tests of expired leases."""
+        self.lock.acquire()
+        try:
+            self._expire()
+        finally:
+            self.lock.release()
+
+    def _expire(self):
+        """Requeue expired leases with the lock held."""
+        now = time.time()
+        for lease_id, lease in self.leases.items():
+            if lease['deadline'] < now:
+                self._requeue(lease_id, 'timeout')
+
+    def _requeue(self, lease_id, reason):
+        """Requeue unfinished tests of the lease with the lock held."""
+        lease = self.leases.pop(lease_id)
+        tests = lease['tests'].items()
+        tests.sort()
+        self.requeued.extend(tests)
+        self._log("Lease %d of %s is requeued (%s): %d tests" %
+                  (lease_id, lease['worker'], reason, len(tests)))
+
+    def finished(self):
+        """Return True if all tests are finished and all workers are
+        informed about it.
+        """
+        self.lock.acquire()
+        try:
+            return self.tests is not None and \
+                self.next_position >= self.tests and \
+                not self.requeued and not self.leases and self.clients == 0
+        finally:
+            self.lock.release()
+
+    def save(self):
+        """Add received results to the store."""
+        self.lock.acquire()
+        try:
+            results = self.results
+            self.results = []
+        finally:
+            self.lock.release()
+        if self.store is not None:
+            for status, report in results:
+                self.store.add_test(self.run_id, status, report,
+                                    self.config_text)
+
+    def close(self):
+        """Save pending results and close the store."""
+        self.save()
+        if self.store is not None:
+            self.store.close()
+
+
+class Handler(SocketServer.BaseRequestHandler):
+
+    """Connection of one worker to the coordinator."""
+
+    def handle(self):
+        coordinator = self.server.coordinator
+        connection = Connection(self.request)
+        coordinator.connected()
+        try:
+            while True:
+                try:
+                    message = connection.receive()
+                except ValueError:
+                    break
+                if message is None:
+                    break
+                if message['op'] == 'lease':
+                    connection.send(coordinator.lease(message['worker'],
+                                                      self))
+                elif message['op'] == 'result':
+                    coordinator.result(message['lease'], message['worker'],
+                                       message['status'], message['report'])
+        finally:
+            coordinator.disconnect(self)
+
+
+class TCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(address, coordinator):
+    """Serve workers at the address until all tests are finished."""
+    if address.startswith('unix:'):
+        path = address[5:]
+        if os.path.exists(path):
+            os.remove(path)
+        server = UnixServer(path, Handler)
+    else:
+        host, port = address.rsplit(':', 1)
+        server = TCPServer((host, int(port)), Handler)
+        address = '%s:%d' % server.server_address
+    server.coordinator = coordinator
+    server.timeout = 1
+    print "Listening on %s" % address
+    sys.stdout.flush()
+    try:
+        while not coordinator.finished():
+            server.handle_request()
+            coordinator.expire()
+            coordinator.save()
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+
+    def usage():
+        print """
+        Usage: coordinator.py [OPTION...] WORK_DIR
+
+        Hand out tests to runners in the worker mode and collect their
+        results in WORK_DIR.
+
+        Example:
+          coordinator.py --listen 0.0.0.0:8700 --run_seed 42 /tmp/fuzz
+          runner.py --coordinator fuzz-host:8700 /tmp/test ../qcow2
+
+        Optional arguments:
+          -h, --help                    display this help and exit
+          --listen=ADDRESS              listen at HOST:PORT or at the Unix
+                                        socket unix:PATH (default:
+                                        127.0.0.1:8700)
+          --run_seed=STRING             seed for the sequence of test seeds,
+                                        by default will be generated randomly
+          --tests=NUMBER                finish after NUMBER of tests, by
+                                        default tests are leased until
+                                        the coordinator is interrupted
+          --lease_size=NUMBER           number of tests in one lease
+                                        (default: 100)
+          --lease_timeout=NUMBER        requeue tests of a lease if its worker
+                                        doesn't report results for NUMBER of
+                                        seconds (default: 1800)
+          -c, --command=JSON            commands of tests as for runner.py
+          --config=JSON                 fuzzer configuration as for runner.py
+        """
+
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'c:h',
+                                       ['help', 'listen=', 'run_seed=',
+                                        'tests=', 'lease_size=',
+                                        'lease_timeout=', 'command=',
+                                        'config='])
+    except getopt.error, e:
+        print >>sys.stderr, \
+            "Error: %s\n\nTry 'coordinator.py --help' for more information" % e
+        sys.exit(1)
+
+    listen = '127.0.0.1:8700'
+    run_seed = None
+    tests = None
+    lease_size = 100
+    lease_timeout = 1800
+    command = None
+    config = None
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt == '--listen':
+            listen = arg
+        elif opt == '--run_seed':
+            run_seed = arg
+        elif opt == '--tests':
+            tests = int(arg)
+        elif opt == '--lease_size':
+            lease_size = int(arg)
+        elif opt == '--lease_timeout':
+            lease_timeout = float(arg)
+        elif opt in ('-c', '--command', '--config'):
+            try:
+                value = json.loads(arg)
+            except (TypeError, ValueError, AttributeError), e:
+                print >>sys.stderr, \
+                    "Error: JSON array cannot be loaded\nReason: %s" % e
+                sys.exit(1)
+            if opt == '--config':
+                config = value
+            else:
+                command = value
+
+    if not len(args) == 1:
+        print >>sys.stderr, \
+            "Expected one parameter\nTry 'coordinator.py --help'" \
+            " for more information."
+        sys.exit(1)
+    if json is None:
+        print >>sys.stderr, "Error: The 'json' module is not found."
+        sys.exit(1)
+
+    # The runner is imported only here, it imports this module itself
+    import random
+    from runner import seed_stream
+    from crash import CrashBuckets
+    from results import ResultStore, sqlite3
+
+    work_dir = os.path.realpath(args[0])
+    try:
+        os.makedirs(work_dir)
+    except OSError:
+        pass
+    os.chdir(work_dir)
+    if run_seed is None:
+        run_seed = str(random.randint(0, sys.maxint))
+    print "Run seed: %s" % run_seed
+    store = None
+    if sqlite3 is not None:
+        store = ResultStore(os.path.join(work_dir, 'results.db'))
+    coordinator = Coordinator(run_seed, seed_stream(run_seed), lease_size,
+                              lease_timeout, tests, command, config, store,
+                              CrashBuckets(os.path.join(work_dir, 'buckets')))
+    try:
+        try:
+            serve(listen, coordinator)
+        except KeyboardInterrupt:
+            pass
+    finally:
+        coordinator.close()
+    print "Tests: %d, crashes: %d" % (coordinator.completed,
+                                      coordinator.crashes)
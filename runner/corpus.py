@@ -0,0 +1,177 @@
+# Corpus of tests with novel behavior of applications under test
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import random
+from crash import normalize
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        # The corpus mode is not supported
+        json = None
+
+# Number of the first output lines of a command taken as its features
+FEATURE_LINES = 16
+# Number of the first output bytes searched for feature lines
+FEATURE_BYTES = 4096
+
+
+def behavior_features(key, retcode, output):
+    """Return a list of features of the command behavior: the exit code or
+    the kill signal and the first lines of the output with numbers and
+    addresses normalized.
+    """
+    features = ['%s: exit %d' % (key, retcode)]
+    for line in output[:FEATURE_BYTES].splitlines()[:FEATURE_LINES]:
+        line = normalize(line.strip())
+        if line:
+            features.append('%s: output %s' % (key, line))
+    return features
+
+
+def _is_crash(feature):
+    """Return True if the feature is a crash signature."""
+    return feature.split(': ', 1)[1].startswith('crash ')
+
+
+def _jsonable(mutations):
+    """Return mutations in a form accepted by the JSON encoder.
+
+    Values of string fields can contain arbitrary bytes, so they are stored
+    as Latin-1 strings.
+    """
+    result = []
+    for mutation in mutations:
+        mutation = list(mutation)
+        for i in (3, 4):
+            if isinstance(mutation[i], str):
+                mutation[i] = mutation[i].decode('latin-1')
+        result.append(mutation)
+    return result
+
+
+def dump_mutations(mutations):
+    """Return a JSON text of the list of mutations."""
+    return json.dumps(_jsonable(mutations))
+
+
+def load_mutations(text):
+    """Return a list of mutations from its JSON text.
+
+    String values are Unicode strings, the image generator converts them
+    back to bytes.
+    """
+    return json.loads(text)
+
+
+class Corpus(object):
+
+    """Bounded corpus of tests which produced novel behavior of applications
+    under test.
+
+    An entry of the corpus is a seed and a list of mutations of the test
+    image, new tests are produced by further mutations of images of
+    entries. A test is added to the corpus if its commands show features
+    (exit codes, output messages, crash signatures) not seen before or cover
+    new edges of the code of applications. Energy of an entry is the number
+    of its novel features and new edges, crash signatures weigh CRASH_WEIGHT
+    features. Entries are chosen proportionally to their energy,
+    which decays every time the entry is chosen. If the corpus is full,
+    the entry with the least energy is evicted.
+
+    The corpus is saved to the file after every change and loaded from it
+    if the file exists.
+    """
+
+    CRASH_WEIGHT = 10
+    DECAY = 0.9
+    MIN_ENERGY = 0.1
+    # Probability to generate a test image from scratch
+    FRESH = 0.2
+
+    def __init__(self, path, size=100, seed=None):
+        self.path = path
+        self.size = size
+        self.rng = random.Random(seed)
+        self.entries = []
+        # Features seen during the run
+        self.features = {}
+        if os.path.exists(path):
+            corpus_file = open(path)
+            try:
+                data = json.load(corpus_file)
+            finally:
+                corpus_file.close()
+            self.entries = data['entries']
+            for feature in data['features']:
+                self.features[feature] = True
+
+    def choose(self):
+        """Return an entry to be mutated by the next test or None if the test
+        should generate an image from scratch.
+        """
+        if len(self.entries) == 0 or self.rng.random() < self.FRESH:
+            return None
+        point = self.rng.uniform(0, sum([e['energy'] for e in self.entries]))
+        for entry in self.entries:
+            point -= entry['energy']
+            if point <= 0:
+                break
+        entry['energy'] = max(entry['energy'] * self.DECAY, self.MIN_ENERGY)
+        return entry
+
+    def add(self, seed, mutations, features, new_edges=0):
+        """Add a test to the corpus if its features are novel or it covered
+        'new_edges' edges and return the number of novel features and edges.
+        """
+        novel = {}
+        for feature in features:
+            if feature not in self.features:
+                novel[feature] = True
+        if len(novel) == 0 and new_edges == 0:
+            return 0
+        energy = new_edges
+        for feature in novel:
+            self.features[feature] = True
+            if _is_crash(feature):
+                energy += self.CRASH_WEIGHT
+            else:
+                energy += 1
+        self.entries.append({'seed': seed, 'mutations': _jsonable(mutations),
+                             'energy': energy})
+        if len(self.entries) > self.size:
+            weakest = min([(e['energy'], i) for i, e in
+                           enumerate(self.entries)])[1]
+            del self.entries[weakest]
+        self.save()
+        return len(novel) + new_edges
+
+    def save(self):
+        """Atomically replace the corpus file."""
+        temp_path = '%s.%d' % (self.path, os.getpid())
+        corpus_file = open(temp_path, 'w')
+        try:
+            json.dump({'entries': self.entries,
+                       'features': self.features.keys()}, corpus_file)
+        finally:
+            corpus_file.close()
+        os.rename(temp_path, self.path)
@@ -0,0 +1,151 @@
+# Code coverage of applications under test built with SanitizerCoverage
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import zlib
+import struct
+from array import array
+
+# Magic numbers of .sancov files with 64-bit and 32-bit offsets
+SANCOV_MAGIC64 = 0xC0BFFFFFFFFFFF64
+SANCOV_MAGIC32 = 0xC0BFFFFFFFFFFF32
+
+# Number of entries of the edge bitmap
+MAP_SIZE = 1 << 16
+
+# Options enabling dumps of coverage into the current directory of
+# an application
+SANITIZER_OPTIONS = ['ASAN_OPTIONS', 'UBSAN_OPTIONS', 'MSAN_OPTIONS']
+
+
+def coverage_env(environ=None):
+    """Return a copy of the environment with sanitizer options extended to
+    dump coverage of an application to .sancov files in its current
+    directory.
+    """
+    if environ is None:
+        environ = os.environ
+    env = dict(environ)
+    for name in SANITIZER_OPTIONS:
+        options = [x for x in env.get(name, '').split(':') if x]
+        options.extend(['coverage=1', 'coverage_dir=.'])
+        env[name] = ':'.join(options)
+    return env
+
+
+def read_sancov(path):
+    """Return a list of offsets of covered edges from the .sancov file."""
+    sancov = open(path, 'rb')
+    try:
+        data = sancov.read()
+    finally:
+        sancov.close()
+    if len(data) < 8:
+        return []
+    magic = struct.unpack('<Q', data[:8])[0]
+    if magic == SANCOV_MAGIC64:
+        width = 8
+        fmt = 'Q'
+    elif magic == SANCOV_MAGIC32:
+        width = 4
+        fmt = 'I'
+    else:
+        return []
+    count = (len(data) - 8) / width
+    return list(struct.unpack('<%d%s' % (count, fmt),
+                              data[8:8 + count * width]))
+
+
+def edge_index(module, offset):
+    """Return an index of the edge of the module in the edge bitmap.
+
+    Offsets are relative to the module base, so indices are the same in all
+    runs of the application.
+    """
+    value = zlib.crc32(module) ^ ((offset * 2654435761) & 0xffffffff)
+    return (value & 0xffffffff) % MAP_SIZE
+
+
+def collect(directory, indices):
+    """Add indices of edges from .sancov files in the directory to
+    the 'indices' dictionary and remove the files.
+
+    File names have the '<module>.<pid>.sancov' form.
+    """
+    for name in os.listdir(directory):
+        if not name.endswith('.sancov'):
+            continue
+        path = os.path.join(directory, name)
+        module = name.rsplit('.', 2)[0]
+        try:
+            offsets = read_sancov(path)
+            os.remove(path)
+        except (IOError, OSError, struct.error):
+            continue
+        for offset in offsets:
+            indices[edge_index(module, offset)] = True
+
+
+class CoverageMap(object):
+
+    """Global bitmap of edges covered by all tests of a run.
+
+    The bitmap is kept in the main process of the runner and merged with
+    indices of edges covered by every finished test. It's saved to the file
+    when new edges are found and loaded from it if the file exists.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.bitmap = array('B', [0]) * MAP_SIZE
+        self.edges = 0
+        if os.path.exists(path):
+            map_file = open(path, 'rb')
+            try:
+                data = map_file.read()
+            finally:
+                map_file.close()
+            # A map of another size is ignored
+            if len(data) == MAP_SIZE:
+                self.bitmap = array('B', data)
+                self.edges = MAP_SIZE - self.bitmap.count(0)
+
+    def merge(self, indices):
+        """Add covered edges to the bitmap and return the number of new
+        ones.
+        """
+        new = 0
+        bitmap = self.bitmap
+        for i in indices:
+            if not bitmap[i]:
+                bitmap[i] = 1
+                new += 1
+        if new:
+            self.edges += new
+            self.save()
+        return new
+
+    def save(self):
+        """Atomically replace the bitmap file."""
+        temp_path = '%s.%d' % (self.path, os.getpid())
+        map_file = open(temp_path, 'wb')
+        try:
+            map_file.write(self.bitmap.tostring())
+        finally:
+            map_file.close()
+        os.rename(temp_path, self.path)
@@ -0,0 +1,221 @@
+# Crash signatures and buckets of failed tests
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import re
+import errno
+import fcntl
+import subprocess
+
+try:
+    from hashlib import sha1
+except ImportError:
+    # Python 2.4
+    from sha import new as sha1
+
+# Number of top stack frames used in a signature
+FRAMES = 5
+
+SANITIZER_RE = re.compile(r'ERROR: (\w+Sanitizer): ([\w-]+)')
+SANITIZER_FRAME_RE = re.compile(r'^\s*#\d+ 0x[0-9a-fA-F]+ in (\S+)')
+UBSAN_RE = re.compile(r'^(?:.*/)?([^/\s:]+):\d+:\d+: runtime error: (.*)$')
+ASSERTION_RE = re.compile(r'^(?:.*/)?([^/\s:]+:\d+: .*Assertion .* failed\.)')
+GDB_FRAME_RE = re.compile(r'^#\d+\s+(?:0x[0-9a-fA-F]+ in )?([^\s(]+)')
+
+
+def normalize(line):
+    """Replace addresses and numbers in a message by placeholders, so messages
+    differing only in values get the same signature.
+    """
+    return re.sub(r'\b\d+\b', 'N', re.sub(r'0x[0-9a-fA-F]+', 'X', line))
+
+
+def parse_output(output):
+    """Return a pair of a crash kind and a list of top stack frames found in
+    the application output.
+
+    Sanitizer (ASan, UBSan, etc.) reports and assertion failures are
+    recognized. If none of them is found, the kind is None.
+    """
+    lines = output.splitlines()
+    for i in range(len(lines)):
+        match = SANITIZER_RE.search(lines[i])
+        if match:
+            frames = []
+            for line in lines[i + 1:]:
+                frame = SANITIZER_FRAME_RE.match(line)
+                if frame:
+                    frames.append(frame.group(1))
+                    if len(frames) == FRAMES:
+                        break
+                elif frames:
+                    # End of the first stack trace
+                    break
+            return ('%s: %s' % match.groups(), frames)
+    for line in lines:
+        match = UBSAN_RE.match(line)
+        if match:
+            return ('runtime error in %s: %s' %
+                    (match.group(1), normalize(match.group(2))), [])
+    for line in lines:
+        match = ASSERTION_RE.match(line)
+        if match:
+            return (normalize(match.group(1)), [])
+    return (None, [])
+
+
+def find_binary(name):
+    """Return the path to an executable searched in PATH as a shell does."""
+    if os.sep in name:
+        return name
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        candidate = os.path.join(path, name)
+        if os.access(candidate, os.X_OK):
+            return candidate
+    return None
+
+
+def core_backtrace(binary, core):
+    """Return a list of top stack frames of the crashed application extracted
+    from its core dump by gdb or an empty list if gdb is not available.
+    """
+    gdb = find_binary('gdb')
+    binary = find_binary(binary)
+    if gdb is None or binary is None:
+        return []
+    devnull = open('/dev/null', 'r+')
+    try:
+        try:
+            process = subprocess.Popen([gdb, '-batch', '-nx', '-ex',
+                                        'bt %d' % FRAMES, binary, core],
+                                       stdin=devnull, stdout=subprocess.PIPE,
+                                       stderr=devnull)
+            out = process.communicate()[0]
+        except OSError:
+            return []
+    finally:
+        devnull.close()
+    frames = []
+    for line in out.splitlines():
+        match = GDB_FRAME_RE.match(line)
+        if match and match.group(1) != '??':
+            frames.append(match.group(1))
+    return frames[:FRAMES]
+
+
+def signature(signal_name, command, output, binary=None, core=None):
+    """Return a pair of a crash signature and its description.
+
+    The signature is built from the kill signal, the command key, a kind of
+    the crash and top stack frames found in the application output or, if
+    the output has no stack trace, in the core dump.
+    """
+    kind, frames = parse_output(output)
+    if not frames and core is not None:
+        frames = core_backtrace(binary, core)
+    description = '%s in %s' % (signal_name, command)
+    if kind is not None:
+        description += ': ' + kind
+    if frames:
+        description += ' at ' + ' < '.join(frames)
+    return (sha1(description).hexdigest()[:12], description)
+
+
+class CrashBuckets(object):
+
+    """Buckets of failed tests with the same crash signature.
+
+    Every bucket is a file named by the signature in the bucket directory
+    with the description of the crash on the first line and a line with
+    a seed and a test directory for every member. Buckets are updated under
+    an exclusive lock, so they can be shared by parallel tests.
+
+    Only the first 'keep' members of a bucket are expected to keep their
+    artifacts, others are represented by their seeds only. If 'keep' is
+    None, all members keep their artifacts.
+    """
+
+    def __init__(self, bucket_dir, keep=None):
+        self.bucket_dir = bucket_dir
+        self.keep = keep
+
+    def add(self, sig, description, seed, test_dir):
+        """Add a test to the bucket and return True if the test is one of
+        the first 'keep' members of it.
+        """
+        try:
+            os.makedirs(self.bucket_dir)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        bucket = open(os.path.join(self.bucket_dir, sig), 'a+')
+        try:
+            fcntl.lockf(bucket, fcntl.LOCK_EX)
+            bucket.seek(0)
+            lines = bucket.readlines()
+            if not lines:
+                bucket.write(description + '\n')
+                lines = [description]
+            bucket.write('%s %s\n' % (seed, test_dir))
+            bucket.flush()
+            fcntl.lockf(bucket, fcntl.LOCK_UN)
+        finally:
+            bucket.close()
+        return self.keep is None or len(lines) <= self.keep
+
+    def members(self):
+        """Return a dictionary of test directories of bucket members in
+        the order of their addition by crash signatures.
+        """
+        members = {}
+        if not os.path.isdir(self.bucket_dir):
+            return members
+        for sig in os.listdir(self.bucket_dir):
+            bucket = open(os.path.join(self.bucket_dir, sig))
+            try:
+                lines = bucket.readlines()[1:]
+            finally:
+                bucket.close()
+            members[sig] = [x.rstrip('\n').split(' ', 1)[-1] for x in lines]
+        return members
+
+    def discard(self, match):
+        """Remove members with test directories for which the 'match'
+        function returns True from all buckets, buckets left without members
+        are removed.
+        """
+        if not os.path.isdir(self.bucket_dir):
+            return
+        for sig in os.listdir(self.bucket_dir):
+            path = os.path.join(self.bucket_dir, sig)
+            bucket = open(path, 'r+')
+            try:
+                fcntl.lockf(bucket, fcntl.LOCK_EX)
+                lines = bucket.readlines()
+                members = [x for x in lines[1:]
+                           if not match(x.rstrip('\n').split(' ', 1)[-1])]
+                if not members:
+                    os.remove(path)
+                elif len(members) < len(lines) - 1:
+                    bucket.seek(0)
+                    bucket.truncate()
+                    bucket.writelines(lines[:1] + members)
+                    bucket.flush()
+                fcntl.lockf(bucket, fcntl.LOCK_UN)
+            finally:
+                bucket.close()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+
+# Export of fuzzed images without execution of tests
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import signal
+import getopt
+import random
+import multiprocessing
+from itertools import islice
+from runner import seed_stream, WRITABLE_FORMATS, MIN_BACKING_FILE_SIZE, \
+    MAX_BACKING_FILE_SIZE
+
+try:
+    import json
+except ImportError:
+    try:
+        import simplejson as json
+    except ImportError:
+        json = None
+
+# Name of the manifest file in the output directory
+MANIFEST = 'manifest.jsonl'
+# Maximal number of images generated by a worker process per task
+MAX_CHUNK = 64
+
+
+def range_seeds(first, last):
+    """Generate seeds of the inclusive range of integers."""
+    for seed in xrange(first, last + 1):
+        yield str(seed)
+
+
+def export_image(seed):
+    """Generate the image of the seed in the current directory and return
+    the seed, the name of its backing file, the size of its virtual disk and
+    the size of the image file.
+
+    The image is the same as the one of the runner's test with the seed, so
+    random numbers are consumed as by TestEnv before the image generation.
+    The backing file itself isn't created.
+
+    The image generator is taken from the global 'image_generator' and its
+    configuration from the global 'fuzz_config'.
+    """
+    path = '%s.img' % seed
+    random.seed(seed)
+    # Values of 'backing_file' and 'backing_fmt' options of 'qemu-img amend'
+    # and cache modes of 'qemu-img convert' to writable formats, each is
+    # a single random.choice()
+    for _ in xrange(2 + len(WRITABLE_FORMATS)):
+        random.random()
+    backing_file_fmt = random.choice(WRITABLE_FORMATS)
+    backing_file_name = 'backing_img.' + backing_file_fmt
+    random.randint(MIN_BACKING_FILE_SIZE, MAX_BACKING_FILE_SIZE)
+    size = image_generator.create_image(path, backing_file_name,
+                                        backing_file_fmt, fuzz_config)
+    return seed, backing_file_name, size, os.path.getsize(path)
+
+
+def init_worker():
+    """Leave handling of keyboard interruptions to the main process."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+if __name__ == '__main__':
+
+    def usage():
+        print """
+        Usage: export.py [OPTION...] OUT_DIR IMG_GENERATOR
+
+        Generate fuzzed images without execution of tests and write them to
+        OUT_DIR, e.g. as seed corpora for other fuzzers. Images are generated
+        by IMG_GENERATOR in parallel processes. The image of a seed is written
+        to the SEED.img file and is the test image of runner.py for the seed
+        except for data clusters, every image is described by a line of
+        OUT_DIR/manifest.jsonl.
+
+        Example:
+          export.py -n 10000 --run_seed 42 /tmp/corpus ../qcow2
+          export.py --seeds 0-999 /tmp/corpus ../qcow2
+
+        Optional arguments:
+          -h, --help                    display this help and exit
+          -n, --images=NUMBER           number of images taken from
+                                        the sequence of seeds defined by
+                                        '--run_seed' (default: 1000)
+          --run_seed=STRING             seed for the sequence of image seeds
+                                        as for runner.py, by default will be
+                                        generated randomly
+          --seeds=FIRST-LAST            generate images for the range of
+                                        integer seeds instead
+          -j, --jobs=NUMBER             generate images in NUMBER of
+                                        processes (default: number of CPUs)
+          --config=JSON                 take fuzzer configuration from the JSON
+                                        array as for runner.py
+        """
+
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'hn:j:',
+                                       ['help', 'images=', 'run_seed=',
+                                        'seeds=', 'jobs=', 'config='])
+    except getopt.error, e:
+        print >>sys.stderr, \
+            "Error: %s\n\nTry 'export.py --help' for more information" % e
+        sys.exit(1)
+
+    images = 1000
+    run_seed = None
+    seed_range = None
+    jobs = multiprocessing.cpu_count()
+    fuzz_config = None
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt in ('-n', '--images'):
+            images = int(arg)
+        elif opt == '--run_seed':
+            run_seed = arg
+        elif opt == '--seeds':
+            try:
+                first, last = [int(x) for x in arg.split('-', 1)]
+            except ValueError:
+                print >>sys.stderr, \
+                    "Error: Seeds should be specified as FIRST-LAST."
+                sys.exit(1)
+            seed_range = (first, last)
+        elif opt in ('-j', '--jobs'):
+            jobs = int(arg)
+        elif opt == '--config':
+            try:
+                fuzz_config = json.loads(arg)
+            except (TypeError, ValueError, AttributeError), e:
+                print >>sys.stderr, \
+                    "Error: JSON array cannot be loaded\nReason: %s" % e
+                sys.exit(1)
+
+    if not len(args) == 2:
+        print >>sys.stderr, \
+            "Expected two parameters\nTry 'export.py --help'" \
+            " for more information."
+        sys.exit(1)
+    if json is None:
+        print >>sys.stderr, "Error: The 'json' module is not found."
+        sys.exit(1)
+
+    out_dir = os.path.realpath(args[0])
+    # Add the path to the image generator module to sys.path
+    sys.path.append(os.path.realpath(os.path.dirname(args[1])))
+    # Remove a script extension from image generator module if any
+    generator_name = os.path.splitext(os.path.basename(args[1]))[0]
+    try:
+        image_generator = __import__(generator_name)
+    except ImportError, e:
+        print >>sys.stderr, \
+            "Error: The image generator '%s' cannot be imported.\n" \
+            "Reason: %s" % (generator_name, e)
+        sys.exit(1)
+
+    if seed_range is not None:
+        seeds = range_seeds(*seed_range)
+        images = max(0, seed_range[1] - seed_range[0] + 1)
+    else:
+        if run_seed is None:
+            run_seed = str(random.randint(0, sys.maxint))
+        print "Run seed: %s" % run_seed
+        seeds = islice(seed_stream(run_seed), images)
+
+    try:
+        os.makedirs(out_dir)
+    except OSError:
+        pass
+    os.chdir(out_dir)
+    # The manifest describes images of this export only
+    manifest = open(MANIFEST, 'w')
+    # Large chunks save interprocess communication, small ones keep all
+    # processes busy till the end
+    chunk = max(1, min(MAX_CHUNK, images / (jobs * 4)))
+    pool = multiprocessing.Pool(jobs, init_worker)
+    start = time.time()
+    done = 0
+    written = 0
+    try:
+        try:
+            for seed, backing_file, size, length in \
+                    pool.imap_unordered(export_image, seeds, chunk):
+                manifest.write(json.dumps({'image': '%s.img' % seed,
+                                           'seed': seed,
+                                           'backing_file': backing_file,
+                                           'config': fuzz_config,
+                                           'size': size,
+                                           'bytes': length}) + '\n')
+                done += 1
+                written += length
+            pool.close()
+        except KeyboardInterrupt:
+            pool.terminate()
+        except Exception:
+            # Workers are stopped on errors, e.g. of the image generator,
+            # otherwise join() waits for all remaining tasks
+            pool.terminate()
+            raise
+    finally:
+        pool.join()
+        manifest.close()
+    elapsed = max(time.time() - start, 1e-6)
+    print "%d images in %.1fs (%.1f images/s, %.1f MB/s)" % \
+        (done, elapsed, done / elapsed, written / elapsed / (1 << 20))
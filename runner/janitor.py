@@ -0,0 +1,195 @@
+# Background cleanup of test directories
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import gzip
+import time
+import shutil
+import threading
+
+# Priorities of kept test directories, directories with the lowest one are
+# evicted first
+DUPLICATE = 0
+PASSED = 1
+UNIQUE = 2
+
+# Files smaller than this number of bytes are not compressed
+MIN_COMPRESS_SIZE = 4096
+
+
+def disk_usage(path):
+    """Return the number of bytes allocated for the file or the directory
+    with all its content.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return 0
+    total = st.st_blocks * 512
+    if os.path.isdir(path) and not os.path.islink(path):
+        for root, dirs, files in os.walk(path):
+            for name in dirs + files:
+                try:
+                    total += os.lstat(os.path.join(root, name)).st_blocks * 512
+                except OSError:
+                    pass
+    return total
+
+
+def compress_file(path):
+    """Replace the file by its gzip-compressed copy 'path.gz'."""
+    src = open(path, 'rb')
+    try:
+        dst = gzip.open(path + '.gz', 'wb')
+        try:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        finally:
+            dst.close()
+    finally:
+        src.close()
+    os.remove(path)
+
+
+class Janitor(threading.Thread):
+
+    """Thread of the main runner process removing and compressing test
+    directories in the background.
+
+    Tests move directories to be removed to the 'trash_dir' directory,
+    which is emptied by the janitor, so removal of big directories doesn't
+    delay tests. Directories of finished tests kept in the work directory
+    are registered via add(). If 'compress' is True, their files are
+    compressed by gzip. If 'quota' is specified, kept directories are
+    evicted when the work directory grows over 'quota' bytes: duplicate
+    crashes first, then passed tests, then unique crashes, the oldest
+    directories first within the same priority. 'log' is a function
+    receiving messages about evicted directories.
+
+    Directories of a previous run found in the work directory are kept with
+    priorities from 'priorities' (a dictionary of priorities by paths),
+    other ones are considered passed tests.
+    """
+
+    # Seconds between checks of the trash and the quota
+    INTERVAL = 1
+
+    def __init__(self, work_dir, trash_dir, quota=None, compress=False,
+                 log=None, priorities=None):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.work_dir = work_dir
+        self.trash_dir = trash_dir
+        self.quota = quota
+        self.compress = compress
+        self.log = log
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        # Directories registered, but not processed yet: (priority, path)
+        self.new = []
+        # Kept directories: path -> [priority, time, size]
+        self.kept = {}
+        try:
+            os.makedirs(trash_dir)
+        except OSError:
+            pass
+        if priorities is None:
+            priorities = {}
+        # Directories of a previous run can be evicted as well
+        for name in os.listdir(work_dir):
+            path = os.path.join(work_dir, name)
+            if name.startswith('test-') and os.path.isdir(path):
+                self.kept[path] = [priorities.get(path, PASSED),
+                                   os.stat(path).st_mtime, disk_usage(path)]
+
+    def add(self, path, priority):
+        """Register the directory of a finished test kept in the work
+        directory.
+        """
+        self.lock.acquire()
+        try:
+            self.new.append((priority, path))
+        finally:
+            self.lock.release()
+
+    def stop(self):
+        """Finish pending work and stop the thread."""
+        self.stopped.set()
+        self.join()
+
+    def run(self):
+        while True:
+            stopped = self.stopped.isSet()
+            self._empty_trash()
+            self._process_new()
+            if self.quota is not None:
+                self._enforce_quota()
+            if stopped:
+                break
+            self.stopped.wait(self.INTERVAL)
+
+    def _empty_trash(self):
+        """Remove all directories moved to the trash."""
+        for name in os.listdir(self.trash_dir):
+            shutil.rmtree(os.path.join(self.trash_dir, name), True)
+
+    def _process_new(self):
+        """Compress and measure newly registered directories."""
+        self.lock.acquire()
+        try:
+            new = self.new
+            self.new = []
+        finally:
+            self.lock.release()
+        for priority, path in new:
+            if not os.path.isdir(path):
+                continue
+            if self.compress:
+                for name in os.listdir(path):
+                    file_path = os.path.join(path, name)
+                    if not name.endswith('.gz') and \
+                       os.path.isfile(file_path) and \
+                       not os.path.islink(file_path) and \
+                       os.path.getsize(file_path) >= MIN_COMPRESS_SIZE:
+                        try:
+                            compress_file(file_path)
+                        except (IOError, OSError):
+                            pass
+            self.kept[path] = [priority, time.time(), disk_usage(path)]
+
+    def _enforce_quota(self):
+        """Evict kept directories until the work directory fits the quota."""
+        total = 0
+        for name in os.listdir(self.work_dir):
+            path = os.path.join(self.work_dir, name)
+            if path in self.kept:
+                total += self.kept[path][2]
+            elif not name.startswith('test-'):
+                # Directories of running tests are not taken into account
+                total += disk_usage(path)
+        if total <= self.quota:
+            return
+        candidates = [(v[0], v[1], k) for k, v in self.kept.items()]
+        candidates.sort()
+        for priority, mtime, path in candidates:
+            if total <= self.quota:
+                break
+            total -= self.kept.pop(path)[2]
+            shutil.rmtree(path, True)
+            if self.log is not None:
+                self.log("Info: '%s' is removed to fit the disk quota.\n\n"
+                         % path)
@@ -0,0 +1,79 @@
+# Minimization of fuzzed fields of failed tests
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+def _split(items, n):
+    """Split the list into n parts of almost equal sizes."""
+    parts = []
+    start = 0
+    for i in range(n):
+        end = start + (len(items) - start) / (n - i)
+        parts.append(items[start:end])
+        start = end
+    return parts
+
+
+def ddmin(items, first_failing):
+    """Return a 1-minimal subset of 'items' still causing the failure.
+
+    'first_failing' is a function taking a list of candidate subsets and
+    returning an index of the first one causing the failure or None, so
+    candidates can be tested in parallel. The failure is expected for all
+    'items'.
+
+    This is the delta debugging algorithm by Zeller and Hildebrandt: the set
+    is split into n parts, if a part or its complement still causes
+    the failure, the search continues with it, otherwise the granularity is
+    doubled.
+    """
+    n = 2
+    while len(items) >= 2:
+        parts = _split(items, n)
+        candidates = list(parts)
+        if n > 2:
+            # For two parts complements are the parts themselves
+            for part in parts:
+                excluded = set(part)
+                candidates.append([x for x in items if x not in excluded])
+        index = first_failing(candidates)
+        if index is not None:
+            items = candidates[index]
+            if index < len(parts):
+                n = 2
+            else:
+                n = max(n - 1, 2)
+        elif n >= len(items):
+            break
+        else:
+            n = min(len(items), 2 * n)
+    return items
+
+
+def reproducer_config(mutations):
+    """Return a fuzzer configuration in the '--config' form covering fields
+    of the mutations.
+
+    Every field name is listed once in the order of the first mutation of
+    the field.
+    """
+    config = []
+    for mutation in mutations:
+        item = [mutation[0], mutation[1]]
+        if item not in config:
+            config.append(item)
+    return config
@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+# Queryable store of test results
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import sys
+import time
+import getopt
+
+try:
+    import sqlite3
+except ImportError:
+    try:
+        # Python 2.4
+        from pysqlite2 import dbapi2 as sqlite3
+    except ImportError:
+        sqlite3 = None
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS runs (
+           id INTEGER PRIMARY KEY,
+           run_seed TEXT,
+           started REAL,
+           work_dir TEXT,
+           generator TEXT,
+           commands TEXT,
+           config TEXT)""",
+    """CREATE TABLE IF NOT EXISTS tests (
+           run INTEGER,
+           test INTEGER,
+           seed TEXT,
+           config TEXT,
+           status TEXT,
+           directory TEXT,
+           finished REAL,
+           PRIMARY KEY (run, test))""",
+    """CREATE TABLE IF NOT EXISTS commands (
+           run INTEGER,
+           test INTEGER,
+           number INTEGER,
+           command TEXT,
+           retcode INTEGER,
+           signal TEXT,
+           timed_out INTEGER,
+           duration REAL,
+           bucket TEXT,
+           PRIMARY KEY (run, test, number))""",
+    "CREATE INDEX IF NOT EXISTS tests_seed ON tests (seed)",
+    "CREATE INDEX IF NOT EXISTS tests_finished ON tests (finished)",
+    "CREATE INDEX IF NOT EXISTS commands_crash ON commands (command, signal)",
+    "CREATE INDEX IF NOT EXISTS commands_bucket ON commands (bucket)",
+]
+
+# Time in seconds to wait for a database locked by another runner
+LOCK_TIMEOUT = 60
+
+
+class ResultStore(object):
+
+    """SQLite database of test results.
+
+    Results are kept in memory and written in one transaction per batch of
+    'batch_size' tests or once per 'interval' seconds, whichever comes
+    first, so a fast run doesn't pay for a transaction per test. The database
+    can be shared by several runs, every run gets its own id.
+    """
+
+    def __init__(self, path, batch_size=100, interval=5):
+        self.db = sqlite3.connect(path, timeout=LOCK_TIMEOUT)
+        for statement in SCHEMA:
+            self.db.execute(statement)
+        self.db.commit()
+        self.batch_size = batch_size
+        self.interval = interval
+        self.tests = []
+        self.commands = []
+        self.last_flush = time.time()
+
+    def add_run(self, run_seed, work_dir, generator, commands=None,
+                config=None):
+        """Register a new run and return its id.
+
+        'commands' and 'config' are JSON texts of the '--command' and
+        '--config' runner parameters if any.
+        """
+        cursor = self.db.execute(
+            "INSERT INTO runs (run_seed, started, work_dir, generator, "
+            "commands, config) VALUES (?, ?, ?, ?, ?, ?)",
+            (run_seed, time.time(), work_dir, generator, commands, config))
+        self.db.commit()
+        return cursor.lastrowid
+
+    def add_test(self, run, status, report, config=None):
+        """Add results of a finished test.
+
+        'status' is False if the test could not be executed, 'report' is
+        the dictionary returned by TestEnv.report().
+        """
+        results = report['results']
+        if not status:
+            test_status = 'error'
+        elif [r for r in results if r['retcode'] < 0]:
+            test_status = 'fail'
+        else:
+            test_status = 'pass'
+        self.tests.append((run, int(report['test']), report['seed'], config,
+                           test_status, report['directory'], time.time()))
+        for r in results:
+            self.commands.append((run, int(report['test']), r['number'],
+                                  r['command'], r['retcode'], r['signal'],
+                                  int(r['timed_out']), r['duration'],
+                                  r['bucket']))
+        if len(self.tests) >= self.batch_size or \
+           time.time() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        """Write all pending results in one transaction."""
+        self.db.executemany("INSERT OR REPLACE INTO tests VALUES "
+                            "(?, ?, ?, ?, ?, ?, ?)", self.tests)
+        self.db.executemany("INSERT OR REPLACE INTO commands VALUES "
+                            "(?, ?, ?, ?, ?, ?, ?, ?, ?)", self.commands)
+        self.db.commit()
+        self.tests = []
+        self.commands = []
+        self.last_flush = time.time()
+
+    def close(self):
+        """Write pending results and close the database."""
+        self.flush()
+        self.db.close()
+
+
+def query(db, command=None, signal=None, status=None, run=None, days=None,
+          bucket=None, crashes=False):
+    """Return rows of command results matching all specified conditions.
+
+    Every row contains a run id, a test number, a seed, a command key,
+    a signal name, a return code, a duration and a crash bucket.
+    """
+    conditions = []
+    args = []
+    if command is not None:
+        conditions.append('c.command = ?')
+        args.append(command)
+    if signal is not None:
+        conditions.append('c.signal = ?')
+        args.append(signal)
+    if status is not None:
+        conditions.append('t.status = ?')
+        args.append(status)
+    if run is not None:
+        conditions.append('c.run = ?')
+        args.append(run)
+    if days is not None:
+        conditions.append('t.finished >= ?')
+        args.append(time.time() - days * 24 * 3600)
+    if bucket is not None:
+        conditions.append('c.bucket = ?')
+        args.append(bucket)
+    if crashes:
+        conditions.append('c.retcode < 0')
+    sql = "SELECT c.run, c.test, t.seed, c.command, c.signal, c.retcode, " \
+          "c.duration, c.bucket FROM commands c JOIN tests t " \
+          "ON c.run = t.run AND c.test = t.test"
+    if conditions:
+        sql += ' WHERE ' + ' AND '.join(conditions)
+    sql += ' ORDER BY c.run, c.test, c.number'
+    return db.execute(sql, args).fetchall()
+
+
+if __name__ == '__main__':
+
+    def usage():
+        print """
+        Usage: results.py [OPTION...] DATABASE
+
+        Query test results stored by the test runner in DATABASE.
+
+        Example:
+          results.py --command 'qemu-img amend' --signal SIGSEGV --days 7 \\
+              --seeds /tmp/test/results.db
+
+        Optional arguments:
+          -h, --help                    display this help and exit
+          --command=KEY                 select results of the command, e.g.
+                                        'qemu-img amend' or 'qemu-io write'
+          --signal=NAME                 select commands killed by the signal,
+                                        e.g. SIGSEGV
+          --crashes                     select commands killed by any signal
+          --status=STATUS               select tests with the status: 'pass',
+                                        'fail' or 'error'
+          --run=NUMBER                  select results of the run
+          --days=NUMBER                 select tests finished during the last
+                                        NUMBER of days
+          --bucket=SIGNATURE            select crashes of the bucket
+          --seeds                       print only unique seeds of selected
+                                        tests, e.g. for their replay
+          --summary                     print numbers of selected results per
+                                        command and signal
+        """
+
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'h',
+                                       ['help', 'command=', 'signal=',
+                                        'crashes', 'status=', 'run=', 'days=',
+                                        'bucket=', 'seeds', 'summary'])
+    except getopt.error, e:
+        print >>sys.stderr, \
+            "Error: %s\n\nTry 'results.py --help' for more information" % e
+        sys.exit(1)
+
+    conditions = {}
+    output = 'rows'
+    for opt, arg in opts:
+        if opt in ('-h', '--help'):
+            usage()
+            sys.exit()
+        elif opt == '--crashes':
+            conditions['crashes'] = True
+        elif opt == '--run':
+            conditions['run'] = int(arg)
+        elif opt == '--days':
+            conditions['days'] = float(arg)
+        elif opt in ('--seeds', '--summary'):
+            output = opt[2:]
+        else:
+            conditions[opt[2:]] = arg
+
+    if not len(args) == 1:
+        print >>sys.stderr, \
+            "Expected one parameter\nTry 'results.py --help'" \
+            " for more information."
+        sys.exit(1)
+    if sqlite3 is None:
+        print >>sys.stderr, "Error: The 'sqlite3' module is not found."
+        sys.exit(1)
+
+    db = sqlite3.connect(args[0], timeout=LOCK_TIMEOUT)
+    rows = query(db, **conditions)
+    if output == 'seeds':
+        seen = {}
+        for row in rows:
+            if row[2] not in seen:
+                seen[row[2]] = True
+                print row[2]
+    elif output == 'summary':
+        counts = {}
+        for row in rows:
+            key = (row[3], row[4] or '-')
+            counts[key] = counts.get(key, 0) + 1
+        keys = counts.keys()
+        keys.sort()
+        for key in keys:
+            print "%-24s %-8s %d" % (key + (counts[key],))
+    else:
+        for row in rows:
+            duration = row[6]
+            if duration is None:
+                duration = '-'
+            else:
+                duration = '%.3f' % duration
+            print "%d\t%d\t%s\t%s\t%s\t%s\t%s\t%s" % \
+                (row[0], row[1], row[2], row[3], row[4] or '-', row[5],
+                 duration, row[7] or '-')
+    db.close()
@@ -21,6 +21,7 @@
 import sys
 import os
 import signal
+import errno
 import subprocess
 import random
 import shutil
@@ -29,6 +30,22 @@ import time
 import getopt
 import StringIO
 import resource
+import fcntl
+import traceback
+import Queue
+import select
+import socket
+from collections import deque
+from clone import Cloner, NotSupported, reflink
+from crash import CrashBuckets, signature
+from stats import RunStats
+from results import ResultStore, sqlite3
+from minimize import ddmin, reproducer_config
+from corpus import Corpus, behavior_features, dump_mutations, load_mutations
+from coverage import CoverageMap, collect, coverage_env
+from schedule import CommandScheduler
+from coordinator import Worker
+from janitor import Janitor, DUPLICATE, PASSED, UNIQUE
 
 # All formats supported by the 'qemu-img create' command.
 WRITABLE_FORMATS = ['raw', 'vmdk', 'vdi', 'cow', 'qcow2', 'file', 'qed', 'vpc']
@@ -43,6 +60,26 @@ except ImportError:
             "Warning: Module for JSON processing is not found.\n" \
             "'--config' and '--command' options are not supported."
 
+try:
+    import multiprocessing
+except ImportError:
+    # Python 2.4 and 2.5 have no multiprocessing, tests can be run only
+    # one at a time
+    multiprocessing = None
+
+# Time in seconds after which an application under test is killed
+SUT_TIMEOUT = 300
+
+# Maximal interval in seconds between checks of an application under test
+# which closed its output but hasn't exited yet
+REAP_INTERVAL = 0.05
+
+# Default limit of bytes of every output stream of a command kept in logs
+OUTPUT_LIMIT = 1 << 20
+
+# Command marking the end of a command in a qemu-io session
+SESSION_MARKER = 'x-runner-mark-%06d'
+
 # Backing file sizes in MB
 MAX_BACKING_FILE_SIZE = 10
 MIN_BACKING_FILE_SIZE = 1
@@ -64,39 +101,548 @@ def str_signal(sig):
             return k
 
 
-def run_app(fd, q_args):
-    """Start an application with specified arguments and return its exit code
-    or kill signal depending on the result of execution.
+def seed_stream(run_seed):
+    """Generate seeds for consecutive tests of a run.
+
+    The same run seed always produces the same sequence of test seeds
+    independently of the number of tests executed in parallel.
     """
+    rng = random.Random(run_seed)
+    while True:
+        yield str(rng.randint(0, sys.maxint))
+
+
+class RunLog(object):
+
+    """Summary log shared by all tests of a run.
+
+    Every message is written under an exclusive lock of the log file, so
+    messages of tests executed in parallel processes are not interleaved.
+    """
+
+    def __init__(self, path):
+        self.fd = open(path, 'a')
+
+    def write(self, msg):
+        """Append a message to the log."""
+        fcntl.lockf(self.fd, fcntl.LOCK_EX)
+        try:
+            self.fd.write(msg)
+            self.fd.flush()
+        finally:
+            fcntl.lockf(self.fd, fcntl.LOCK_UN)
 
-    class Alarm(Exception):
-        """Exception for signal.alarm events."""
+    def flush(self):
+        """Do nothing, every message is flushed by write()."""
         pass
 
-    def handler(*args):
-        """Notify that an alarm event occurred."""
-        raise Alarm
+    def close(self):
+        """Close the log file."""
+        self.fd.close()
+
+
+def command_key(item):
+    """Return a short name of a command used to collect statistics of its
+    executions, e.g. 'qemu-img convert' or 'qemu-io write'.
+
+    'item' is a command in the form accepted by the '--command' option.
+    """
+    if item[0] == 'qemu-io':
+        ops = [item[i + 1].split(' ')[0] for i in range(len(item) - 1)
+               if item[i] == '-c']
+        return ' '.join([item[0]] + ops)
+    for arg in item[1:]:
+        if not (arg.startswith('-') or '$' in arg):
+            return item[0] + ' ' + arg
+    return item[0]
+
+
+class ExecLimits(object):
+
+    """Limits for executions of applications under test.
+
+    A deadline of a command is derived from execution times of its previous
+    runs: the 99th percentile of them multiplied by 'factor' and bounded by
+    'min_timeout' and 'max_timeout' seconds. Until enough runs of the command
+    are observed 'max_timeout' is used.
+
+    'memory' and 'cpu' optionally limit an address space in bytes and
+    CPU time in seconds of every application (RLIMIT_AS and RLIMIT_CPU).
+
+    'output' limits bytes of every output stream of an application kept
+    for logs.
+    """
+
+    # Number of the latest runs taken into account for every command
+    WINDOW = 1000
+    # Minimal number of runs necessary to derive a deadline
+    MIN_SAMPLES = 20
+
+    def __init__(self, max_timeout=SUT_TIMEOUT, min_timeout=10, factor=10,
+                 memory=None, cpu=None, output=OUTPUT_LIMIT):
+        self.max_timeout = max_timeout
+        self.output = output
+        self.min_timeout = min(min_timeout, max_timeout)
+        self.factor = factor
+        self.rlimits = []
+        if memory is not None:
+            self.rlimits.append((resource.RLIMIT_AS, memory))
+        if cpu is not None:
+            self.rlimits.append((resource.RLIMIT_CPU, cpu))
+        # Command key -> list of the latest execution times
+        self.samples = {}
+
+    def timeout(self, key):
+        """Return the deadline in seconds for the next run of the command."""
+        samples = self.samples.get(key, [])
+        if len(samples) < self.MIN_SAMPLES:
+            return self.max_timeout
+        ordered = sorted(samples)
+        p99 = ordered[int(0.99 * (len(ordered) - 1))]
+        return max(self.min_timeout, min(self.max_timeout, p99 * self.factor))
+
+    def record(self, key, elapsed):
+        """Take into account the execution time of a finished command."""
+        samples = self.samples.setdefault(key, [])
+        samples.append(elapsed)
+        if len(samples) > self.WINDOW:
+            del samples[0]
+
+
+class OutputCapture(object):
+
+    """Output stream of an application under test limited in size.
+
+    Only the first and the last 'limit' / 2 bytes of the output are kept,
+    chunks of data are stored as they are read without copying.
+    """
+
+    def __init__(self, limit=OUTPUT_LIMIT):
+        self.head_limit = limit / 2
+        self.tail_limit = limit - self.head_limit
+        self.head = []
+        self.head_size = 0
+        self.tail = deque()
+        self.tail_size = 0
+        self.skipped = 0
+
+    def write(self, data):
+        """Add a chunk of the output."""
+        if self.head_size < self.head_limit:
+            part = data[:self.head_limit - self.head_size]
+            self.head.append(part)
+            self.head_size += len(part)
+            data = data[len(part):]
+        if data:
+            self.tail.append(data)
+            self.tail_size += len(data)
+            while self.tail_size - len(self.tail[0]) >= self.tail_limit:
+                chunk = self.tail.popleft()
+                self.tail_size -= len(chunk)
+                self.skipped += len(chunk)
+
+    def dump(self, fd):
+        """Write the kept output to the file object."""
+        for chunk in self.head:
+            fd.write(chunk)
+        excess = max(0, self.tail_size - self.tail_limit)
+        if self.skipped + excess > 0:
+            fd.write('\n[%d bytes of the output are skipped]\n' %
+                     (self.skipped + excess))
+        for chunk in self.tail:
+            fd.write(chunk[excess:])
+            excess = 0
+
+    def text(self):
+        """Return the kept output as a string."""
+        return ''.join(self.head) + ''.join(self.tail)
+
+
+class SUTJob(object):
+
+    """Execution of an application under test by run_apps().
+
+    Standard output and error of the application are collected to 'out' and
+    'err' OutputCapture objects limited by 'output_limit' bytes.
+
+    If 'stdin_data' is specified, it's passed to the standard input of
+    the application, and the standard error is merged with the standard
+    output to keep the order of messages of an interactive application.
+
+    If 'env' is specified, the application is executed with this environment
+    instead of the one of the runner.
+
+    After the execution 'retcode' contains an exit code or a kill signal of
+    the application or OSError if the application could not be started,
+    'pid' and 'start' contain its process id and start time, 'elapsed'
+    contains its wall-clock time, 'rusage' contains its resource usage
+    reported by os.wait4() (None if not available) and 'timed_out' is True
+    if the application was killed by timeout.
+    """
+
+    def __init__(self, q_args, cwd=None, timeout=SUT_TIMEOUT, stdin_data=None,
+                 output_limit=OUTPUT_LIMIT, env=None):
+        self.q_args = q_args
+        self.cwd = cwd
+        self.timeout = timeout
+        self.stdin_data = stdin_data
+        self.env = env
+        self.out = OutputCapture(output_limit)
+        self.err = OutputCapture(output_limit)
+        self.retcode = None
+        self.pid = None
+        self.start = None
+        self.elapsed = None
+        self.rusage = None
+        self.timed_out = False
+
+    def dump(self, fd):
+        """Write the collected output of the application to the file
+        object.
+        """
+        self.out.dump(fd)
+        self.err.dump(fd)
+
+    def text(self):
+        """Return the collected output of the application as a string."""
+        return self.out.text() + self.err.text()
+
+
+class SessionOutput(object):
+
+    """Output of a qemu-io session split into outputs of commands.
+
+    A line containing the marker of the current command completes its
+    output, the line itself is not kept. Output of every command is kept in
+    its own OutputCapture object of 'commands' limited by 'limit' bytes.
+    """
 
-    signal.signal(signal.SIGALRM, handler)
-    signal.alarm(300)
-    term_signal = signal.SIGKILL
+    def __init__(self, limit=OUTPUT_LIMIT):
+        self.limit = limit
+        self.commands = [OutputCapture(limit)]
+        # Chunks of the incomplete line
+        self.line = []
+        self.line_size = 0
+
+    def write(self, data):
+        """Add a chunk of the session output."""
+        pieces = data.split('\n')
+        for piece in pieces[:-1]:
+            self.line.append(piece)
+            line = ''.join(self.line)
+            self.line = []
+            self.line_size = 0
+            if SESSION_MARKER % (len(self.commands) - 1) in line:
+                self.commands.append(OutputCapture(self.limit))
+            else:
+                self.commands[-1].write(line + '\n')
+        if pieces[-1]:
+            self.line.append(pieces[-1])
+            self.line_size += len(pieces[-1])
+            # Markers are short, so too long lines are not kept in memory
+            if self.line_size > self.limit:
+                self.close()
+
+    def close(self):
+        """Add the incomplete line to the output of the current command."""
+        if self.line:
+            self.commands[-1].write(''.join(self.line))
+            self.line = []
+            self.line_size = 0
+
+
+def _sut_preexec(rlimits):
+    """Return a function setting up a child process of an application under
+    test: the process gets its own process group and resource limits.
+    """
+    def preexec():
+        """Move the application to a new process group and limit it."""
+        os.setpgid(0, 0)
+        for res, limit in rlimits:
+            resource.setrlimit(res, (limit, limit))
+    return preexec
+
+
+def run_apps(jobs, limit, rlimits=()):
+    """Execute applications concurrently and return a list of their exit codes
+    or kill signals in the order of 'jobs'.
+
+    'jobs' is a list of SUTJob objects. Not more than 'limit' applications
+    are executed at the same time. Every application runs in its own process
+    group with 'rlimits' resource limits applied. If the application doesn't
+    finish before its deadline, its whole process group is killed.
+
+    Outputs of applications are collected by jobs while they are read,
+    the timeout message is added to the standard error of a killed
+    application. If an application cannot be started, the OSError is placed to
+    the list instead of the exit code, and applications following it are not
+    started.
+    """
     devnull = open('/dev/null', 'r+')
-    process = subprocess.Popen(q_args, stdin=devnull,
-                               stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
+    preexec = _sut_preexec(rlimits)
+    pending = list(jobs)
+    pending.reverse()
+    # Running applications: stdout/stderr pipe -> (job, pipe, output)
+    pipes = {}
+    # Job -> [process, start time, number of open pipes, reap delay]
+    running = {}
     try:
-        out, err = process.communicate()
-        signal.alarm(0)
-        fd.write(out)
-        fd.write(err)
-        fd.flush()
-        return process.returncode
+        while pending or running:
+            while pending and len(running) < limit:
+                job = pending.pop()
+                if job.stdin_data is None:
+                    stdin = devnull
+                    stderr = subprocess.PIPE
+                else:
+                    stdin = subprocess.PIPE
+                    stderr = subprocess.STDOUT
+                job.start = time.time()
+                try:
+                    process = subprocess.Popen(job.q_args, stdin=stdin,
+                                               stdout=subprocess.PIPE,
+                                               stderr=stderr,
+                                               cwd=job.cwd,
+                                               env=job.env,
+                                               preexec_fn=preexec)
+                except OSError, e:
+                    job.retcode = e
+                    pending = []
+                    break
+                job.pid = process.pid
+                running[job] = [process, job.start, 1, 0.001]
+                pipes[process.stdout.fileno()] = (job, process.stdout,
+                                                  job.out)
+                if process.stderr is not None:
+                    running[job][2] += 1
+                    pipes[process.stderr.fileno()] = (job, process.stderr,
+                                                      job.err)
+                if process.stdin is not None:
+                    _feed_stdin(process, job.stdin_data)
+
+            if not running:
+                break
+            timeout = max(0, min([r[1] + j.timeout
+                                  for j, r in running.items()]) - time.time())
+            # Applications without open pipes are polled until they exit
+            delays = [r[3] for r in running.values() if r[2] == 0]
+            if delays:
+                timeout = min([timeout] + delays)
+            try:
+                ready = select.select(pipes.keys(), [], [], timeout)[0]
+            except select.error, e:
+                if e[0] == errno.EINTR:
+                    continue
+                raise
+            for pipe_fd in ready:
+                job, pipe, output = pipes[pipe_fd]
+                data = os.read(pipe_fd, 65536)
+                if data:
+                    output.write(data)
+                else:
+                    del pipes[pipe_fd]
+                    pipe.close()
+                    running[job][2] -= 1
+
+            now = time.time()
+            for job, state in running.items():
+                process, start, open_pipes, delay = state
+                if open_pipes == 0:
+                    exited, rusage = _poll_process(process)
+                    if exited:
+                        job.rusage = rusage
+                        job.elapsed = time.time() - start
+                        job.retcode = process.returncode
+                        del running[job]
+                        continue
+                    state[3] = min(delay * 2, REAP_INTERVAL)
+                if now - start >= job.timeout:
+                    _kill_job(pipes, job, process)
+                    job.elapsed = time.time() - start
+                    if job.stdin_data is None:
+                        job.err.write('The command was terminated by '
+                                      'timeout.\n')
+                    else:
+                        job.out.write('The command was terminated by '
+                                      'timeout.\n')
+                    job.retcode = -signal.SIGKILL
+                    job.timed_out = True
+                    del running[job]
+    finally:
+        # Nothing is left running in case of an unexpected error
+        for job, state in running.items():
+            _kill_job(pipes, job, state[0])
+        devnull.close()
+    return [job.retcode for job in jobs]
+
+
+def _feed_stdin(process, data):
+    """Write data to the standard input of the process and close it.
+
+    The data is expected to fit in the pipe buffer.
+    """
+    try:
+        try:
+            process.stdin.write(data)
+        finally:
+            process.stdin.close()
+    except IOError, e:
+        # The application has already exited
+        if e.errno != errno.EPIPE:
+            raise
 
-    except Alarm:
-        os.kill(process.pid, term_signal)
-        fd.write('The command was terminated by timeout.\n')
-        fd.flush()
-        return -term_signal
+
+def _kill_job(pipes, job, process):
+    """Kill the process group of the application executed by run_apps() and
+    release its pipes.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError, e:
+        # The group is empty if the application has already exited and its
+        # children closed the pipes
+        if e.errno != errno.ESRCH:
+            raise
+    for pipe_fd, item in pipes.items():
+        if item[0] is job:
+            item[1].close()
+            del pipes[pipe_fd]
+    job.rusage = _wait_process(process)
+
+
+def _wait_process(process):
+    """Wait for the process to terminate and return its resource usage.
+
+    The exit code of the process is set as Popen.wait() does. If os.wait4()
+    is not available (Python 2.4), the resource usage is None.
+    """
+    if not hasattr(os, 'wait4'):
+        process.wait()
+        return None
+    while True:
+        try:
+            status, rusage = os.wait4(process.pid, 0)[1:]
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    _set_returncode(process, status)
+    return rusage
+
+
+def _poll_process(process):
+    """Check without blocking if the process has terminated.
+
+    Return a tuple of True and the resource usage of the terminated process
+    or (False, None) if it's still running. The exit code is set as by
+    _wait_process().
+    """
+    if not hasattr(os, 'wait4'):
+        return process.poll() is not None, None
+    while True:
+        try:
+            pid, status, rusage = os.wait4(process.pid, os.WNOHANG)
+            break
+        except OSError, e:
+            if e.errno != errno.EINTR:
+                raise
+    if pid == 0:
+        return False, None
+    _set_returncode(process, status)
+    return True, rusage
+
+
+def _set_returncode(process, status):
+    """Set the exit code of the process from its wait status."""
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+
+
+# Copier of test images shared by all tests executed by the process
+cloner = Cloner()
+
+
+class BackingPool(object):
+
+    """Backing files shared by all tests of a run.
+
+    A backing file of every combination of a format and a size is created
+    once per run in the pool directory, tests get reflinks or hard links to
+    pool files.
+
+    Pool files are read-only and have zero modification time, so a pool file
+    modified by an application under test via a hard link is detected and
+    replaced by a new pristine one.
+    """
+
+    def __init__(self, pool_dir):
+        self.pool_dir = pool_dir
+        self.reflinks = True
+
+    def get(self, fmt, size, dst, create):
+        """Place a pristine backing file of the format and the size in bytes
+        to 'dst'.
+
+        'create' is a function creating a backing file by the specified path
+        and returning True on success. It's called only if the pool has no
+        pristine file yet. Return False if the file cannot be created.
+        """
+        path = os.path.join(self.pool_dir, '%dM.%s' % (size >> 20, fmt))
+        try:
+            pristine = os.stat(path).st_mtime == 0
+        except OSError:
+            pristine = False
+        if not pristine:
+            try:
+                os.makedirs(self.pool_dir)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+            # Parallel tests can create the same file, so it's created under
+            # a unique name and atomically renamed
+            temp_path = '%s.%d' % (path, os.getpid())
+            if not create(temp_path):
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                return False
+            os.chmod(temp_path, 0444)
+            os.utime(temp_path, (0, 0))
+            os.rename(temp_path, path)
+
+        if self.reflinks:
+            src_fd = os.open(path, os.O_RDONLY)
+            dst_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+            try:
+                try:
+                    reflink(src_fd, dst_fd, size)
+                    return True
+                except NotSupported:
+                    self.reflinks = False
+            finally:
+                os.close(src_fd)
+                os.close(dst_fd)
+            os.remove(dst)
+        os.link(path, dst)
+        return True
+
+
+def read_phases(path):
+    """Return a dictionary of wall-clock times of image generation phases
+    from the profile written by the image generator.
+
+    Only 'phase NAME SECONDS ...' lines of the profile are taken into account.
+    """
+    phases = {}
+    profile = open(path)
+    try:
+        for line in profile:
+            fields = line.split()
+            if len(fields) >= 3 and fields[0] == 'phase':
+                phases[fields[1]] = float(fields[2])
+    finally:
+        profile.close()
+    return phases
 
 
 class TestException(Exception):
@@ -122,19 +668,56 @@ class TestEnv(object):
     """
 
     def __init__(self, test_id, seed, work_dir, run_log,
-                 cleanup=True, log_all=False):
+                 cleanup=True, log_all=False, command_jobs=1, limits=None,
+                 backing_pool=None, sessions=False, buckets=None,
+                 corpus=False, coverage=False, generated=None,
+                 trash_dir=None):
         """Set test environment in a specified work directory.
 
         Path to qemu-img and qemu-io will be retrieved from 'QEMU_IMG' and
         'QEMU_IO' environment variables.
+
+        If 'command_jobs' is greater than one, up to 'command_jobs' commands
+        of the test are executed concurrently.
+
+        'limits' is an ExecLimits object shared by tests of a run, so
+        deadlines of commands can be adapted to their execution times.
+
+        'backing_pool' is a BackingPool object providing backing files.
+        If it's not specified, a backing file is created for every test.
+
+        If 'sessions' is True, qemu-io commands are executed in persistent
+        qemu-io sessions.
+
+        'buckets' is a CrashBuckets object grouping failures by their crash
+        signatures. A failed test is kept only if at least one of its
+        failures is one of the first members of its bucket.
+
+        If 'corpus' is True, mutations of the test image and behavior
+        features of commands are collected for a corpus of tests.
+
+        If 'coverage' is True, applications under test are expected to be
+        built with SanitizerCoverage and edges covered by commands of the test
+        are collected.
+
+        'generated' is a state of the test returned by state() of the test
+        environment which generated images of the test in another process.
+        The test directory is reused then, and only commands are executed.
+
+        If 'trash_dir' is specified, the test directory is moved there instead
+        of its removal.
         """
         if seed is not None:
             self.seed = seed
         else:
             self.seed = str(random.randint(0, sys.maxint))
+        # export_image() of export.py consumes random numbers the same way
+        # till the image generation, so changes of the order of random
+        # choices should be made there too
         random.seed(self.seed)
 
         self.init_path = os.getcwd()
+        self.test_id = test_id
         self.work_dir = work_dir
         self.current_dir = os.path.join(work_dir, 'test-' + test_id)
         self.qemu_img = \
@@ -192,18 +775,67 @@ class TestEnv(object):
                 ['qemu-img', 'convert', '-f', 'qcow2', '-O', fmt] + cache_opt +
                 ['$test_img', 'converted_image.' + fmt])
 
-        try:
-            os.makedirs(self.current_dir)
-        except OSError, e:
-            print >>sys.stderr, \
-                "Error: The working directory '%s' cannot be used. Reason: %s"\
-                % (self.work_dir, e[1])
-            raise TestException
-        self.log = open(os.path.join(self.current_dir, "test.log"), "w")
-        self.parent_log = open(run_log, "a")
+        if generated is None:
+            try:
+                os.makedirs(self.current_dir)
+            except OSError, e:
+                print >>sys.stderr, \
+                    "Error: The working directory '%s' cannot be used. " \
+                    "Reason: %s" % (self.work_dir, e[1])
+                raise TestException
+            self.log = open(os.path.join(self.current_dir, "test.log"), "w")
+        else:
+            self.log = open(os.path.join(self.current_dir, "test.log"), "a")
+        self.parent_log = RunLog(run_log)
         self.failed = False
         self.cleanup = cleanup
         self.log_all = log_all
+        self.command_jobs = command_jobs
+        if limits is None:
+            limits = ExecLimits()
+        self.limits = limits
+        self.backing_pool = backing_pool
+        self.sessions = sessions
+        self.buckets = buckets
+        self.keep_artifacts = buckets is None
+        # Signature -> True if the test is kept as a member of the bucket,
+        # every test joins a bucket once
+        self.bucketed = {}
+        # Resource usage records of test stages
+        self.usage = []
+        # Results of executed commands
+        self.results = []
+        self.corpus = corpus
+        # Behavior features of commands are collected for the corpus and
+        # the command scheduler
+        self.collect_features = corpus
+        # Mutations of the test image if recorded
+        self.mutations = None
+        self.mutations_file = None
+        # Indices of covered edges in the edge bitmap if collected
+        if coverage:
+            self.coverage = {}
+            self.env = coverage_env()
+        else:
+            self.coverage = None
+            self.env = None
+        self.backing_file_name = None
+        self.trash_dir = trash_dir
+        if generated is not None:
+            self.backing_file_name = generated['backing_file_name']
+            self.usage = generated['usage']
+            self.mutations = generated['mutations']
+            self.mutations_file = generated['mutations_file']
+            self.collect_features = generated['collect_features']
+
+    def state(self):
+        """Return a dictionary with the state of the test after generate()
+        necessary to execute its commands in another process.
+        """
+        return {'backing_file_name': self.backing_file_name,
+                'usage': self.usage, 'mutations': self.mutations,
+                'mutations_file': self.mutations_file,
+                'collect_features': self.collect_features}
 
     def _create_backing_file(self):
         """Create a backing file in the current directory.
@@ -211,18 +843,44 @@ class TestEnv(object):
         Return a tuple of a backing file name and format.
 
         Format of a backing file is randomly chosen from all formats supported
-        by 'qemu-img create'.
+        by 'qemu-img create'. If the test has a pool of backing files, the
+        file is taken from the pool.
         """
 
         backing_file_fmt = random.choice(WRITABLE_FORMATS)
         backing_file_name = 'backing_img.' + backing_file_fmt
         backing_file_size = random.randint(MIN_BACKING_FILE_SIZE,
                                            MAX_BACKING_FILE_SIZE) * (1 << 20)
-        cmd = self.qemu_img + ['create', '-f', backing_file_fmt,
-                               backing_file_name, str(backing_file_size)]
         temp_log = StringIO.StringIO()
-        retcode = run_app(temp_log, cmd)
-        if retcode == 0:
+        # The qemu-img process creating the file if any
+        creator = []
+
+        def create(path):
+            """Create a backing file by the specified path."""
+            cmd = self.qemu_img + ['create', '-f', backing_file_fmt, path,
+                                   str(backing_file_size)]
+            job = SUTJob(cmd, None, self.limits.max_timeout)
+            run_apps([job], 1, self.limits.rlimits)
+            if isinstance(job.retcode, OSError):
+                raise job.retcode
+            job.dump(temp_log)
+            creator.append(job)
+            return job.retcode == 0
+
+        start = time.time()
+        if self.backing_pool is None:
+            created = create(backing_file_name)
+        else:
+            created = self.backing_pool.get(backing_file_fmt,
+                                            backing_file_size,
+                                            backing_file_name, create)
+        rusage = None
+        if creator:
+            rusage = creator[0].rusage
+        self._record_usage('backing_file', time.time() - start, rusage,
+                           format=backing_file_fmt, size=backing_file_size,
+                           created=bool(creator))
+        if created:
             temp_log.close()
             return (backing_file_name, backing_file_fmt)
         else:
@@ -233,12 +891,34 @@ class TestEnv(object):
             temp_log.close()
             return (None, None)
 
-    def execute(self, input_commands=None, fuzz_config=None):
+    def execute(self, input_commands=None, fuzz_config=None, mutations=None,
+                replay=None, mutation_seed=None, schedule=None):
         """ Execute a test.
 
         The method creates backing and test images, runs test app and analyzes
         its exit status. If the application was killed by a signal, the test
         is marked as failed.
+
+        'mutations', 'replay' and 'mutation_seed' are passed to the image
+        generator if specified, so mutations of the test image can be
+        recorded, replayed and extended. If mutations are replayed or
+        extended, i.e. the test can't be reproduced by its seed only, they are
+        saved to the 'mutations.json' file in the test directory.
+
+        If 'schedule' is specified, only commands with indices in it are
+        executed. Parameters of all commands are still generated, so
+        the seed reproduces the executed commands.
+        """
+        prepared = self.generate(input_commands, fuzz_config, mutations,
+                                 replay, mutation_seed, schedule)
+        self.run(prepared)
+
+    def generate(self, input_commands=None, fuzz_config=None, mutations=None,
+                 replay=None, mutation_seed=None, schedule=None):
+        """Create backing and test images and return a list of prepared
+        commands of the test for run().
+
+        Arguments are the same as of execute().
         """
         if input_commands is None:
             commands = self.commands
@@ -247,10 +927,191 @@ class TestEnv(object):
 
         os.chdir(self.current_dir)
         backing_file_name, backing_file_fmt = self._create_backing_file()
-        img_size = image_generator.create_image(
-            'test.img', backing_file_name, backing_file_fmt, fuzz_config)
+        self.backing_file_name = backing_file_name
+        start = time.time()
+        before = resource.getrusage(resource.RUSAGE_SELF)
+        if mutations is None and self.corpus:
+            mutations = []
+        if mutations is None and replay is None and mutation_seed is None:
+            img_size = image_generator.create_image(
+                'test.img', backing_file_name, backing_file_fmt, fuzz_config)
+        else:
+            if mutations is None:
+                mutations = []
+            img_size = image_generator.create_image(
+                'test.img', backing_file_name, backing_file_fmt, fuzz_config,
+                mutations, replay, mutation_seed)
+            self.mutations = mutations
+            if replay is not None or mutation_seed is not None:
+                mutations_file = open('mutations.json', 'w')
+                mutations_file.write(dump_mutations(mutations))
+                mutations_file.close()
+                self.mutations_file = 'mutations.json'
+        after = resource.getrusage(resource.RUSAGE_SELF)
+        # The image is generated by the runner process itself, so its CPU
+        # time is a difference of usages and its peak memory is the one of
+        # the process
+        self._record_usage('create_image', time.time() - start, None,
+                           utime=after.ru_utime - before.ru_utime,
+                           stime=after.ru_stime - before.ru_stime,
+                           maxrss=after.ru_maxrss)
+        if os.path.exists('test.img.profile'):
+            self.usage[-1]['phases'] = read_phases('test.img.profile')
+        prepared = self._prepare_commands(commands, img_size,
+                                          backing_file_name)
+        if schedule is not None:
+            self.collect_features = True
+            selected = dict([(i, True) for i in schedule])
+            for i in range(len(prepared)):
+                if i not in selected:
+                    prepared[i] = (None, None, None)
+        return prepared
+
+    def run(self, prepared):
+        """Execute prepared commands of the test and analyze their results.
+        """
+        os.chdir(self.current_dir)
+        backing_file_name = self.backing_file_name
+        if self.sessions:
+            sessions = self._run_sessions(prepared)
+        else:
+            sessions = {}
+        if self.command_jobs > 1:
+            self._execute_concurrently(prepared, backing_file_name, sessions)
+            return
+
+        for i in range(len(prepared)):
+            current_cmd, test_summary, key = prepared[i]
+            if current_cmd is None:
+                if test_summary is not None:
+                    multilog(test_summary, sys.stderr, self.log,
+                             self.parent_log)
+                continue
+            if i in sessions:
+                self._log_session_result(i + 1, current_cmd, test_summary,
+                                         key, sessions[i])
+                continue
+            self._copy_image('copy.img')
+            job = SUTJob(current_cmd, None, self.limits.timeout(key), None,
+                         self.limits.output, self.env)
+            run_apps([job], 1, self.limits.rlimits)
+            self._record_job(i + 1, key, job)
+            self._log_result(i + 1, current_cmd, test_summary, job.retcode,
+                             job, key, self._find_core(job))
+            os.remove('copy.img')
+
+    def _session_ops(self, current_cmd, key):
+        """Return a list of operations of a qemu-io command if the command
+        can be executed in a qemu-io session and None otherwise.
+
+        Only commands consisting of '-c' operations on the test image can be
+        executed in a session.
+        """
+        if key is None or not key.startswith('qemu-io'):
+            return None
+        args = current_cmd[len(self.qemu_io):]
+        if len(args) < 3 or len(args) % 2 == 0 or args[0] != 'copy.img' or \
+           [x for x in args[1::2] if x != '-c']:
+            return None
+        return args[2::2]
+
+    def _run_sessions(self, prepared):
+        """Execute qemu-io commands in persistent qemu-io sessions.
+
+        A session is one qemu-io process reading operations of all suitable
+        commands from its standard input. All operations of the session work
+        on the same copy of the test image. Operations of every command are
+        followed by an unknown command as a marker of the command end, so
+        output and a crash are attributed to the exact command. If a session
+        terminates before the end of the batch, a new session is started for
+        the remaining commands.
+
+        Return a dictionary mapping indices of executed commands in 'prepared'
+        to triples of an exit code or a kill signal, an OutputCapture object
+        with the command output and a list of operations executed in
+        the session up to the end of the command. Exit codes of commands
+        completed in a session are zeroes, except the last command of
+        a session failed after its end.
+        """
+        batch = []
+        for i in range(len(prepared)):
+            current_cmd, test_summary, key = prepared[i]
+            if current_cmd is not None:
+                ops = self._session_ops(current_cmd, key)
+                if ops is not None:
+                    batch.append((i, ops, key))
+
+        results = {}
+        while batch:
+            lines = []
+            timeout = 0
+            for n in range(len(batch)):
+                idx, ops, key = batch[n]
+                lines.extend(ops)
+                lines.append(SESSION_MARKER % n)
+                timeout += self.limits.timeout(key)
+            self._copy_image('copy.img')
+            job = SUTJob(self.qemu_io + ['copy.img'], None, timeout,
+                         '\n'.join(lines) + '\n', self.limits.output,
+                         self.env)
+            job.out = SessionOutput(self.limits.output)
+            run_apps([job], 1, self.limits.rlimits)
+            os.remove('copy.img')
+            if self.coverage is not None:
+                collect(os.curdir, self.coverage)
+            if isinstance(job.retcode, OSError):
+                results[batch[0][0]] = (job.retcode, None, [])
+                break
+            self._record_usage('session', job.elapsed, job.rusage,
+                               commands=[x[0] + 1 for x in
+                                         batch[:len(job.out.commands)]],
+                               retcode=job.retcode,
+                               timed_out=job.timed_out)
+
+            job.out.close()
+            outputs = job.out.commands
+            session_ops = []
+            for n in range(len(batch)):
+                idx, ops, key = batch[n]
+                session_ops.extend(ops)
+                if n == len(outputs) - 1:
+                    # The session was terminated by this command
+                    results[idx] = (job.retcode, outputs[n],
+                                    list(session_ops))
+                    batch = batch[n + 1:]
+                    break
+                results[idx] = (0, outputs[n], list(session_ops))
+            else:
+                if job.retcode != 0:
+                    # The session failed after the last command, e.g. on
+                    # closing the image, the failure is attributed to
+                    # the last command with the output of the session end
+                    outputs[n].write(outputs[-1].text())
+                    results[idx] = (job.retcode, outputs[n],
+                                    list(session_ops))
+                batch = []
+        return results
+
+    def _log_session_result(self, number, current_cmd, test_summary, key,
+                            result):
+        """Log the result of a command executed in a qemu-io session."""
+        retcode, output, session_ops = result
+        test_summary += "Session operations: %s\n" % \
+                        ", ".join(["'%s'" % op for op in session_ops])
+        self._log_result(number, current_cmd, test_summary, retcode, output,
+                         key)
+
+    def _prepare_commands(self, commands, img_size, backing_file_name):
+        """Return a list of triples of a command line with all placeholders
+        replaced, a log header for it and a command key in the order of
+        'commands'.
+
+        If the application under test is not defined for a command, the triple
+        consists of None, a warning message and None. Commands skipped by
+        the schedule are replaced by triples of None.
+        """
+        prepared = []
         for item in commands:
-            shutil.copy('test.img', 'copy.img')
             # 'off' and 'len' are multiple of the sector size
             sector_size = 512
             start = random.randrange(0, img_size + 1, sector_size)
@@ -261,8 +1122,8 @@ class TestEnv(object):
             elif item[0] == 'qemu-io':
                 current_cmd = list(self.qemu_io)
             else:
-                multilog("Warning: test command '%s' is not defined.\n"
-                         % item[0], sys.stderr, self.log, self.parent_log)
+                prepared.append((None, "Warning: test command '%s' is not "
+                                 "defined.\n" % item[0], None))
                 continue
             # Replace all placeholders with their real values
             for v in item[1:]:
@@ -277,40 +1138,267 @@ class TestEnv(object):
                            "Backing file: %s\n" \
                            % (self.seed, " ".join(current_cmd),
                               self.current_dir, backing_file_name)
-            temp_log = StringIO.StringIO()
-            try:
-                retcode = run_app(temp_log, current_cmd)
-            except OSError, e:
-                multilog(test_summary +
-                         ("Error: Start of '%s' failed. Reason: %s\n\n"
-                          % (os.path.basename(current_cmd[0]), e[1])),
-                         sys.stderr, self.log, self.parent_log)
-                raise TestException
+            if self.mutations_file is not None:
+                test_summary += "Mutations: %s\n" % self.mutations_file
+            prepared.append((current_cmd, test_summary, command_key(item)))
+        return prepared
 
-            if retcode < 0:
-                self.log.write(temp_log.getvalue())
+    def _execute_concurrently(self, prepared, backing_file_name, sessions):
+        """Execute commands concurrently.
+
+        Every command is executed in its own 'cmd-<number>' subdirectory with
+        its own copy of the test image and a link to the backing file, so
+        command lines and output files are the same as for sequential
+        execution. Results are logged in the order of commands after all of
+        them are finished.
+
+        Commands already executed in qemu-io sessions are only logged.
+        """
+        jobs = []
+        for i in range(len(prepared)):
+            current_cmd, test_summary, key = prepared[i]
+            if current_cmd is None or i in sessions:
+                continue
+            cmd_dir = 'cmd-%d' % (i + 1)
+            os.mkdir(cmd_dir)
+            self._copy_image(os.path.join(cmd_dir, 'copy.img'))
+            if backing_file_name is not None:
+                os.symlink(os.path.join(os.pardir, backing_file_name),
+                           os.path.join(cmd_dir, backing_file_name))
+            jobs.append(SUTJob(current_cmd, cmd_dir, self.limits.timeout(key),
+                               None, self.limits.output, self.env))
+
+        run_apps(jobs, self.command_jobs, self.limits.rlimits)
+        job_id = 0
+        for i in range(len(prepared)):
+            current_cmd, test_summary, key = prepared[i]
+            if current_cmd is None:
+                if test_summary is not None:
+                    multilog(test_summary, sys.stderr, self.log,
+                             self.parent_log)
+                continue
+            if i in sessions:
+                self._log_session_result(i + 1, current_cmd, test_summary,
+                                         key, sessions[i])
+                continue
+            job = jobs[job_id]
+            self._record_job(i + 1, key, job)
+            self._log_result(i + 1, current_cmd, test_summary, job.retcode,
+                             job, key, self._find_core(job))
+            os.remove(os.path.join(job.cwd, 'copy.img'))
+            job_id += 1
+
+    def _record_job(self, number, key, job):
+        """Take into account the execution time of a finished command for
+        deadlines of its next runs and record its resource usage and
+        coverage.
+        """
+        if isinstance(job.retcode, OSError):
+            return
+        if self.coverage is not None:
+            collect(job.cwd or os.curdir, self.coverage)
+        if not job.timed_out:
+            self.limits.record(key, job.elapsed)
+        self._record_usage('command', job.elapsed, job.rusage, number=number,
+                           command=key, retcode=job.retcode,
+                           timed_out=job.timed_out)
+
+    def _record_usage(self, stage, wall, rusage=None, **fields):
+        """Add a resource usage record of a test stage.
+
+        'wall' is wall-clock time of the stage in seconds, 'rusage' is
+        resource usage of an application executed at the stage as returned by
+        os.wait4(). Other fields are added to the record as is.
+        """
+        record = {'stage': stage, 'wall': round(wall, 6)}
+        if rusage is not None:
+            record['utime'] = rusage.ru_utime
+            record['stime'] = rusage.ru_stime
+            # Kilobytes on Linux
+            record['maxrss'] = rusage.ru_maxrss
+        record.update(fields)
+        for name in ('utime', 'stime'):
+            if name in record:
+                record[name] = round(record[name], 6)
+        self.usage.append(record)
+
+    def _copy_image(self, dst):
+        """Copy the test image to 'dst'.
+
+        The copy strategy is reported to the summary log when it's selected
+        first time in the current process.
+        """
+        previous = cloner.strategy
+        strategy = cloner.clone('test.img', dst)
+        if strategy != previous:
+            multilog("Info: Test images are copied via %s.\n\n" % strategy,
+                     self.parent_log)
+
+    def _save_output(self, number, output):
+        """Save the output of the command with the specified number to
+        the 'cmd-<number>.log' file and refer to it in the test log.
+        """
+        log_name = 'cmd-%d.log' % number
+        log = open(log_name, 'w')
+        output.dump(log)
+        log.close()
+        self.log.write("Output: %s\n" % log_name)
+
+    def _find_core(self, job):
+        """Return the path to the core dump of the finished job or None if
+        the application didn't dump its core in the working directory or
+        wasn't started.
+        """
+        if job.pid is None:
+            return None
+        directory = job.cwd or os.curdir
+        path = os.path.join(directory, 'core.%d' % job.pid)
+        if os.path.exists(path):
+            return path
+        # A bare 'core' may be left by an earlier command of the test, so it's
+        # taken only if it was written after the start of the job
+        path = os.path.join(directory, 'core')
+        try:
+            if os.stat(path).st_mtime >= job.start:
+                return path
+        except OSError:
+            pass
+        return None
+
+    def _log_result(self, number, current_cmd, test_summary, retcode, output,
+                    key, core=None):
+        """Log the result of a command execution.
+
+        'number' is a number of the command in the test. 'retcode' is an exit
+        code or a kill signal of the application under test or OSError if
+        the application cannot be started. 'output' is an object providing
+        the collected application output via dump() and text(), 'key' is
+        the command key and 'core' is a path to the core dump if any.
+        If the application was killed by a signal, the test is marked as
+        failed. The application output is saved only for failed commands
+        or if all results are logged.
+        """
+        if isinstance(retcode, OSError):
+            multilog(test_summary +
+                     ("Error: Start of '%s' failed. Reason: %s\n\n"
+                      % (os.path.basename(current_cmd[0]), retcode[1])),
+                     sys.stderr, self.log, self.parent_log)
+            raise TestException
+
+        result = {'number': number, 'command': key, 'retcode': retcode,
+                  'signal': None, 'bucket': None, 'description': None}
+        self.results.append(result)
+        if self.collect_features:
+            result['features'] = behavior_features(key, retcode,
+                                                   output.text())
+        if retcode < 0:
+            result['signal'] = str_signal(-retcode)
+            self._save_output(number, output)
+            sig, description = signature(str_signal(-retcode), key,
+                                         output.text(), current_cmd[0], core)
+            result['bucket'] = sig
+            result['description'] = description
+            if self.collect_features:
+                result['features'].append('%s: crash %s' % (key, sig))
+            if self.buckets is not None:
+                if sig not in self.bucketed:
+                    self.bucketed[sig] = self.buckets.add(sig, description,
+                                                          self.seed,
+                                                          self.current_dir)
+                if self.bucketed[sig]:
+                    self.keep_artifacts = True
+                test_summary += "Crash bucket: %s (%s)\n" % (sig, description)
+            multilog(test_summary +
+                     ("FAIL: Test terminated by signal %s\n\n"
+                      % str_signal(-retcode)),
+                     sys.stderr, self.log, self.parent_log)
+            self.failed = True
+        else:
+            if self.log_all:
+                self._save_output(number, output)
                 multilog(test_summary +
-                         ("FAIL: Test terminated by signal %s\n\n"
-                          % str_signal(-retcode)),
-                         sys.stderr, self.log, self.parent_log)
-                self.failed = True
-            else:
-                if self.log_all:
-                    self.log.write(temp_log.getvalue())
-                    multilog(test_summary +
-                             ("PASS: Application exited with the code '%d'\n\n"
-                              % retcode),
-                             sys.stdout, self.log, self.parent_log)
-            temp_log.close()
-            os.remove('copy.img')
+                         ("PASS: Application exited with the code '%d'\n\n"
+                          % retcode),
+                         sys.stdout, self.log, self.parent_log)
+
+    def report(self):
+        """Return a dictionary with the test number, seed and directory,
+        resource usage records of test stages ('usage'), results of executed
+        commands ('results'), mutations of the test image ('mutations') and
+        indices of covered edges in the edge bitmap ('coverage') if recorded.
+
+        Every result contains a command number and key, an exit code or
+        a kill signal and its name, a flag if the command was killed by
+        timeout, an execution time if known, a crash signature ('bucket') and
+        its description if the application was killed by a signal and
+        behavior features ('features') if they are collected for a corpus.
+        """
+        durations = {}
+        timeouts = {}
+        for record in self.usage:
+            if record['stage'] == 'command':
+                durations[record['number']] = record['wall']
+                timeouts[record['number']] = record['timed_out']
+            elif record['stage'] == 'session' and record['timed_out']:
+                timeouts[record['commands'][-1]] = True
+        for result in self.results:
+            result['duration'] = durations.get(result['number'])
+            result['timed_out'] = timeouts.get(result['number'], False)
+        coverage = None
+        if self.coverage is not None:
+            coverage = self.coverage.keys()
+        return {'test': self.test_id, 'seed': self.seed,
+                'directory': self.current_dir, 'usage': self.usage,
+                'results': self.results, 'mutations': self.mutations,
+                'coverage': coverage}
+
+    def suspend(self):
+        """Restore the environment of the process after generate() keeping
+        the test directory for execution of the test in another process.
+        """
+        self.log.close()
+        self.parent_log.close()
+        os.chdir(self.init_path)
 
     def finish(self):
         """Restore the test environment after a test execution."""
+        self._write_usage()
         self.log.close()
         self.parent_log.close()
         os.chdir(self.init_path)
         if self.cleanup and not self.failed:
+            self._remove()
+        elif self.failed and not self.keep_artifacts:
+            # All crashes of the test are already represented in their
+            # buckets, the seed is enough to reproduce them
+            self._remove()
+
+    def _remove(self):
+        """Remove the test directory or move it to the trash directory to be
+        removed in the background.
+        """
+        if self.trash_dir is None:
             shutil.rmtree(self.current_dir)
+        else:
+            os.rename(self.current_dir,
+                      os.path.join(self.trash_dir, '%s.%d' %
+                                   (os.path.basename(self.current_dir),
+                                    os.getpid())))
+
+    def _write_usage(self):
+        """Append resource usage records of the test to the 'usage.log'
+        file in the work directory as one JSON object per line.
+        """
+        try:
+            line = json.dumps({'test': self.test_id, 'seed': self.seed,
+                               'stages': self.usage})
+        except NameError:
+            # No JSON module
+            return
+        log = RunLog(os.path.join(self.work_dir, 'usage.log'))
+        log.write(line + '\n')
+        log.close()
+
 
 if __name__ == '__main__':
 
@@ -331,10 +1419,84 @@ if __name__ == '__main__':
                                         the JSON array
           -s, --seed=STRING             seed for a test image generation,
                                         by default will be generated randomly
+          --run_seed=STRING             seed for the sequence of test seeds,
+                                        by default will be generated randomly
+          -j, --jobs=NUMBER             run NUMBER of tests in parallel
+          --command_jobs=NUMBER         run up to NUMBER of commands of a test
+                                        concurrently
+          --qemu_io_sessions            execute qemu-io commands of a test in
+                                        one qemu-io process
+          --timeout=NUMBER              kill a command after NUMBER of seconds
+                                        (300 by default)
+          --min_timeout=NUMBER          lower bound in seconds for deadlines of
+                                        commands derived from their previous
+                                        runs (10 by default)
+          --output_limit=NUMBER         keep only the first and the last
+                                        NUMBER / 2 KB of every output stream
+                                        of a command (1024 by default)
+          --memory_limit=NUMBER         limit address space of a command to
+                                        NUMBER of MB
+          --cpu_limit=NUMBER            limit CPU time of a command to NUMBER
+                                        of seconds
           --config=JSON                 take fuzzer configuration from the JSON
                                         array
           -k, --keep_passed             don't remove folders of passed tests
           -v, --verbose                 log information about passed tests
+          --keep_crashes=NUMBER         keep folders of failed tests only for
+                                        the first NUMBER tests with the same
+                                        crash signature
+          --stats_interval=NUMBER       report run statistics every NUMBER of
+                                        seconds (60 by default)
+          --metrics_file=PATH           export run statistics to PATH in
+                                        the Prometheus text format
+          --results_db=PATH             store test results in the SQLite
+                                        database PATH (TEST_DIR/results.db by
+                                        default)
+          --no_results_db               don't store test results in a database
+          --minimize                    find a minimal subset of fuzzed fields
+                                        of the test specified via '--seed'
+                                        still reproducing its first crash
+          --corpus                      keep tests with novel behavior of
+                                        applications in TEST_DIR/corpus.json
+                                        and mutate their images further
+          --corpus_size=NUMBER          maximal number of corpus entries
+                                        (default: 100)
+          --replay=FILE                 apply mutations from FILE, e.g.
+                                        mutations.json of a corpus test, to
+                                        the image of the test specified via
+                                        '--seed'
+          --coverage                    collect coverage of applications built
+                                        with SanitizerCoverage to
+                                        TEST_DIR/coverage.map and keep tests
+                                        covering new edges in the corpus
+          --test_budget=SECONDS         execute only commands chosen by their
+                                        crash and novelty yield and execution
+                                        time within the time budget per test
+          --exploration=PROBABILITY     probability of every command to be
+                                        executed regardless of the budget
+                                        (default: 0.05)
+          --generators=NUMBER           generate test images in NUMBER of
+                                        processes ahead of their execution by
+                                        '--jobs' processes
+          --queue_depth=NUMBER          maximal number of test images
+                                        generated ahead (default: twice the
+                                        number of jobs)
+          --coordinator=ADDRESS         execute tests leased by the coordinator
+                                        at HOST:PORT or at the Unix socket
+                                        unix:PATH
+          --resume                      continue the interrupted run in
+                                        TEST_DIR from its checkpoint
+          --disk_quota=NUMBER           remove kept test directories when
+                                        TEST_DIR grows over NUMBER of MB
+          --compress                    compress files of kept test
+                                        directories by gzip in the background
+          --profile=MODE                profile generation of test images by
+                                        the qcow2 generator: 'phases' for
+                                        times of generation phases, 'cprofile'
+                                        for also the most expensive functions
+          --max_image_size=NUMBER       generate virtual disks of test images
+                                        up to NUMBER of MB by the qcow2
+                                        generator (10 by default)
 
         JSON:
 
@@ -367,33 +1529,452 @@ if __name__ == '__main__':
         """
 
     def run_test(test_id, seed, work_dir, run_log, cleanup, log_all,
-                 command, fuzz_config):
-        """Setup environment for one test and execute this test."""
+                 command_jobs, sessions, command, fuzz_config,
+                 corpus_mode=False, replay=None, mutation_seed=None,
+                 coverage=False, schedule=None):
+        """Setup environment for one test and execute this test.
+
+        If 'corpus_mode' is True, the test collects data for the corpus, if
+        'coverage' is True, it collects coverage of applications under test.
+        'replay', 'mutation_seed' and 'schedule' are passed to
+        TestEnv.execute().
+
+        Return a pair of a status and a report of the test returned by
+        TestEnv.report(). The status is False if the test environment cannot
+        be set up or an application under test cannot be started and True
+        otherwise. The report is None if the test environment cannot be set
+        up.
+        """
         try:
+            # 'limits', 'backing_pool' and 'buckets' are global to keep their
+            # state between tests executed by the current process, as well as
+            # 'trash_dir' common for all tests
             test = TestEnv(test_id, seed, work_dir, run_log, cleanup,
-                           log_all)
+                           log_all, command_jobs, limits, backing_pool,
+                           sessions, buckets, corpus_mode, coverage, None,
+                           trash_dir)
         except TestException:
-            sys.exit(1)
+            return (False, None)
 
         # Python 2.4 doesn't support 'finally' and 'except' in the same 'try'
         # block
         try:
             try:
-                test.execute(command, fuzz_config)
+                test.execute(command, fuzz_config, None, replay,
+                             mutation_seed, schedule)
             except TestException:
-                sys.exit(1)
+                return (False, test.report())
+        finally:
+            test.finish()
+        return (True, test.report())
+
+    def generate_test(args):
+        """Generate images of a test in a generator process of the pipeline.
+
+        'args' are arguments of run_test(). Return a pair of a flag if
+        the test is ready for execution and either its state for
+        execute_test() or a result of the failed test as of run_test().
+        """
+        (test_id, seed, work_dir, run_log, cleanup, log_all, command_jobs,
+         sessions, command, fuzz_config, corpus_mode, replay, mutation_seed,
+         coverage, schedule) = args
+        try:
+            test = TestEnv(test_id, seed, work_dir, run_log, cleanup,
+                           log_all, command_jobs, limits, backing_pool,
+                           sessions, buckets, corpus_mode, coverage, None,
+                           trash_dir)
+        except TestException:
+            return (False, (False, None))
+        try:
+            prepared = test.generate(command, fuzz_config, None, replay,
+                                     mutation_seed, schedule)
+        except TestException:
+            test.finish()
+            return (False, (False, test.report()))
+        test.suspend()
+        state = test.state()
+        state['args'] = args
+        state['prepared'] = prepared
+        state['ready'] = time.time()
+        return (True, state)
+
+    def execute_test(state):
+        """Execute commands of a test generated by generate_test() in
+        an executor process of the pipeline and return a result as of
+        run_test().
+
+        The report additionally contains the time in seconds the test waited
+        for execution after its generation ('queue_wait').
+        """
+        (test_id, seed, work_dir, run_log, cleanup, log_all, command_jobs,
+         sessions, command, fuzz_config, corpus_mode, replay, mutation_seed,
+         coverage, schedule) = state['args']
+        queue_wait = time.time() - state['ready']
+        try:
+            test = TestEnv(test_id, seed, work_dir, run_log, cleanup,
+                           log_all, command_jobs, limits, backing_pool,
+                           sessions, buckets, corpus_mode, coverage, state,
+                           trash_dir)
+        except TestException:
+            return (False, None)
+        status = True
+        try:
+            try:
+                test.run(state['prepared'])
+            except TestException:
+                status = False
         finally:
             test.finish()
+        report = test.report()
+        report['queue_wait'] = queue_wait
+        return (status, report)
+
+    def pipeline_job(args):
+        """Execute a stage of the pipeline in a worker process.
+
+        'args' is a pair of a stage function and its argument. Unlike
+        the stage functions the function never raises an exception.
+        """
+        stage, arg = args
+        try:
+            return stage(arg)
+        except Exception:
+            traceback.print_exc()
+            if stage is generate_test:
+                return (False, (False, None))
+            return (False, None)
+
+    def init_worker():
+        """Leave handling of keyboard interruptions to the main process."""
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    def run_job(args):
+        """Execute one test in a worker process.
+
+        Unlike run_test() the function never raises an exception, otherwise
+        the main process would wait for the test result forever.
+        """
+        try:
+            return run_test(*args)
+        except Exception:
+            traceback.print_exc()
+            return (False, None)
 
     def should_continue(duration, start_time):
         """Return True if a new test can be started and False otherwise."""
         current_time = int(time.time())
         return (duration is None) or (current_time - start_time < duration)
 
+    def more_tests():
+        """Return True if more tests can be started now or later."""
+        return should_continue(duration, start_time) and \
+            (worker is None or not worker.finished)
+
+    def report_stats():
+        """Print statistics of the run, add them to the summary log and
+        export them to the metrics file if any.
+        """
+        summary = "Stats: %s" % stats.summary()
+        if corpus is not None:
+            summary += ", %d corpus entries" % len(corpus.entries)
+        if coverage_map is not None:
+            stats.edges = coverage_map.edges
+            summary += ", %d edges covered" % coverage_map.edges
+        summary += "\n"
+        multilog(summary, sys.stdout)
+        log = RunLog(run_log)
+        log.write(summary + '\n')
+        log.close()
+        if metrics_file is not None:
+            stats.write_metrics(metrics_file)
+
+    def report_schedule():
+        """Add statistics of commands collected by the scheduler to
+        the summary log.
+        """
+        log = RunLog(run_log)
+        log.write("Command schedule:\n%s\n\n" %
+                  '\n'.join(scheduler.summary()))
+        log.close()
+
+    def add_test(result):
+        """Take into account a finished test and return its status."""
+        status, report = result
+        if report is None:
+            stats.add_test(status, [])
+        else:
+            started.pop(int(report['test']), None)
+            stats.add_test(status, report['usage'], report.get('queue_wait'))
+            if store is not None:
+                store.add_test(run_id, status, report, config_text)
+            if worker is not None:
+                worker.report(status, report)
+            if janitor is not None and os.path.isdir(report['directory']):
+                keep_test(report)
+            if scheduler is not None:
+                scheduler.record(report['results'])
+            new_edges = 0
+            if coverage_map is not None and report['coverage'] is not None:
+                new_edges = coverage_map.merge(report['coverage'])
+            if corpus is not None and report['mutations'] is not None:
+                features = []
+                for r in report['results']:
+                    features.extend(r.get('features', []))
+                corpus.add(report['seed'], report['mutations'], features,
+                           new_edges)
+        return status
+
+    def keep_test(report):
+        """Register the kept directory of a finished test in the janitor.
+
+        A failed test is a duplicate if all its crashes are already
+        represented by earlier tests of their buckets.
+        """
+        signatures = [r['bucket'] for r in report['results'] if r['bucket']]
+        if not signatures:
+            priority = PASSED
+        elif [x for x in signatures if x not in seen_buckets]:
+            priority = UNIQUE
+        else:
+            priority = DUPLICATE
+        for sig in signatures:
+            seen_buckets[sig] = True
+        janitor.add(report['directory'], priority)
+
+    def janitor_log(msg):
+        """Add a message of the janitor to the summary log."""
+        log = RunLog(run_log)
+        log.write(msg)
+        log.close()
+
+    def next_test():
+        """Return arguments of run_test() for the next test or None if no
+        test is available now.
+
+        In the worker mode tests are leased from the coordinator. In
+        the corpus mode a test either mutates further an image of a corpus
+        entry or generates a new image from its own seed.
+        """
+        if worker is None:
+            if retry:
+                number, test_seed = retry.pop(0)
+            else:
+                number = test_id.next()
+                test_seed = seeds.next()
+                last_test[0] = number
+            started[number] = True
+            test_command, test_config = command, config
+        else:
+            leased = worker.next()
+            if leased is None:
+                return None
+            number, test_seed, test_command, test_config = leased
+        replay = replay_mutations
+        schedule = None
+        if scheduler is not None:
+            schedule = scheduler.choose()
+        mutation_seed = None
+        if corpus is not None:
+            entry = corpus.choose()
+            if entry is not None:
+                # The new seed drives only the extra mutations
+                test_seed, replay, mutation_seed = \
+                    entry['seed'], entry['mutations'], test_seed
+        return (str(number), test_seed, work_dir, run_log, cleanup,
+                log_all, command_jobs, sessions, test_command, test_config,
+                corpus is not None, replay, mutation_seed,
+                coverage_map is not None, schedule)
+
+    def check_stats():
+        """Report statistics and save a checkpoint if the reporting interval
+        is over.
+        """
+        if reporting and time.time() >= next_report[0]:
+            report_stats()
+            save_checkpoint()
+            next_report[0] = time.time() + stats_interval
+
+    def save_checkpoint():
+        """Atomically save the state of the run to the 'checkpoint.json' file
+        in the work directory, so the run can be continued via '--resume'.
+
+        Tests started but not finished are executed again after resume.
+        Pending results are written to the results database first, so
+        results of tests counted as finished by the checkpoint are not lost.
+        """
+        if worker is not None or 'json' not in globals():
+            return
+        if store is not None:
+            store.flush()
+        incomplete = started.keys()
+        incomplete.sort()
+        state = {'run_seed': run_seed, 'next_test': last_test[0] + 1,
+                 'incomplete': incomplete, 'stats': stats.state(),
+                 'run_id': run_id}
+        path = os.path.join(work_dir, 'checkpoint.json')
+        temp_path = '%s.%d' % (path, os.getpid())
+        checkpoint_file = open(temp_path, 'w')
+        try:
+            json.dump(state, checkpoint_file)
+        finally:
+            checkpoint_file.close()
+        os.rename(temp_path, path)
+
+    def run_trial(args):
+        """Execute a test of minimization and return a list of crash
+        signatures of its commands.
+
+        'args' is a tuple of a test id, a fuzzer configuration, a list for
+        recording of mutations or None, mutations to replay or None and a flag
+        if the test directory should be kept. The test directory is created
+        in the 'minimize' subdirectory of the work directory. Messages of
+        the test are written only to its logs and the 'minimize.log' summary
+        log.
+        """
+        test_id, fuzz_config, mutations, replay, keep_dir = args
+        saved = (sys.stdout, sys.stderr)
+        messages = StringIO.StringIO()
+        sys.stdout = sys.stderr = messages
+        try:
+            try:
+                test = TestEnv(test_id, seed, minimize_dir, minimize_log, True,
+                               False, command_jobs, limits, backing_pool,
+                               sessions)
+                try:
+                    test.execute(command, fuzz_config, mutations, replay)
+                finally:
+                    test.finish()
+            except TestException:
+                saved[1].write(messages.getvalue())
+                raise
+        finally:
+            sys.stdout, sys.stderr = saved
+        if not keep_dir and os.path.exists(test.current_dir):
+            shutil.rmtree(test.current_dir)
+        return [r['bucket'] for r in test.results if r['bucket'] is not None]
+
+    def format_value(value):
+        """Return a printable form of a field value."""
+        if isinstance(value, str):
+            return repr(value)
+        return str(value)
+
+    def minimize_test():
+        """Find a minimal subset of mutations of the test image still
+        reproducing the first crash of the test and print a fuzzer
+        configuration for it.
+
+        Return an exit status of the runner.
+        """
+        # Trials are kept apart from tests of runs in the work directory and
+        # numbered after trials of earlier minimizations
+        numbers = [0]
+        if os.path.isdir(minimize_dir):
+            for name in os.listdir(minimize_dir):
+                number = name[len('test-'):]
+                if name.startswith('test-') and number.isdigit():
+                    numbers.append(int(number))
+        trial_id = count(max(numbers) + 1)
+        mutations = []
+        crashes = run_trial((str(trial_id.next()), config, mutations,
+                             replay_mutations, True))
+        if not crashes:
+            print >>sys.stderr, \
+                "Error: The test with the seed '%s' doesn't crash." % seed
+            return 1
+        target = crashes[0]
+        print "Crash signature: %s" % target
+        print "Mutations: %d" % len(mutations)
+        sys.stdout.flush()
+
+        pool = None
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs, init_worker)
+
+        def first_failing(candidates):
+            """Execute tests keeping candidate subsets of mutations, up to
+            'jobs' tests at once, and return an index of the first subset
+            reproducing the crash or None.
+            """
+            for start in range(0, len(candidates), jobs):
+                batch = [(str(trial_id.next()), config, None,
+                          [mutations[i] for i in c], False)
+                         for c in candidates[start:start + jobs]]
+                if pool is None:
+                    results = map(run_trial, batch)
+                else:
+                    results = pool.map(run_trial, batch)
+                for i in range(len(results)):
+                    if target in results[i]:
+                        return start + i
+            return None
+
+        try:
+            try:
+                if first_failing([[]]) is not None:
+                    minimal = []
+                else:
+                    minimal = ddmin(range(len(mutations)), first_failing)
+            except (KeyboardInterrupt, TestException):
+                if pool is not None:
+                    pool.terminate()
+                    pool.join()
+                return 1
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+        minimal = [mutations[i] for i in minimal]
+        print "Minimal mutations: %d" % len(minimal)
+        for element, name, index, original, value in minimal:
+            print "    %s.%s[%d]: %s -> %s" % \
+                (element, name, index, format_value(original),
+                 format_value(value))
+        reproducer = reproducer_config(minimal)
+        print "Reproducer config: %s" % json.dumps(reproducer)
+        # Fields of the configuration get new random values, so the crash
+        # can depend on the exact values found by the minimization
+        if target in run_trial((str(trial_id.next()), reproducer, None, None,
+                                True)):
+            print "The configuration reproduces the crash."
+        else:
+            print "Warning: The configuration doesn't reproduce the crash " \
+                "with random values of the fields, use values listed above."
+        return 0
+
+    def exit_run(code):
+        """Report final statistics, save pending results and a checkpoint
+        and exit.
+        """
+        if reporting:
+            report_stats()
+            save_checkpoint()
+        if scheduler is not None:
+            report_schedule()
+        if store is not None:
+            store.close()
+        if janitor is not None:
+            janitor.stop()
+        sys.exit(code)
+
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'c:hs:kvd:',
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'c:hs:kvd:j:',
                                        ['command=', 'help', 'seed=', 'config=',
-                                        'keep_passed', 'verbose', 'duration='])
+                                        'keep_passed', 'verbose', 'duration=',
+                                        'run_seed=', 'jobs=',
+                                        'command_jobs=', 'timeout=',
+                                        'min_timeout=', 'memory_limit=',
+                                        'cpu_limit=', 'qemu_io_sessions',
+                                        'output_limit=', 'keep_crashes=',
+                                        'stats_interval=', 'metrics_file=',
+                                        'results_db=', 'no_results_db',
+                                        'minimize', 'corpus', 'corpus_size=',
+                                        'replay=', 'coverage', 'test_budget=',
+                                        'exploration=', 'generators=',
+                                        'queue_depth=', 'coordinator=',
+                                        'resume', 'disk_quota=', 'compress',
+                                        'profile=', 'max_image_size='])
     except getopt.error, e:
         print >>sys.stderr, \
             "Error: %s\n\nTry 'runner.py --help' for more information" % e
@@ -405,6 +1986,32 @@ if __name__ == '__main__':
     seed = None
     config = None
     duration = None
+    run_seed = None
+    jobs = 1
+    command_jobs = 1
+    sessions = False
+    max_timeout = SUT_TIMEOUT
+    min_timeout = 10
+    memory_limit = None
+    cpu_limit = None
+    output_limit = OUTPUT_LIMIT
+    keep_crashes = None
+    stats_interval = 60
+    metrics_file = None
+    results_db = ''
+    minimize = False
+    corpus_mode = False
+    corpus_size = 100
+    replay_mutations = None
+    coverage = False
+    test_budget = None
+    exploration = 0.05
+    generators = 0
+    queue_depth = None
+    coordinator = None
+    resume = False
+    disk_quota = None
+    compress = False
     for opt, arg in opts:
         if opt in ('-h', '--help'):
             usage()
@@ -425,6 +2032,97 @@ if __name__ == '__main__':
             seed = arg
         elif opt in ('-d', '--duration'):
             duration = int(arg)
+        elif opt == '--run_seed':
+            run_seed = arg
+        elif opt in ('-j', '--jobs'):
+            jobs = int(arg)
+            if jobs < 1:
+                print >>sys.stderr, \
+                    "Error: The number of jobs should be positive."
+                sys.exit(1)
+            if jobs > 1 and multiprocessing is None:
+                print >>sys.stderr, \
+                    "Error: Parallel tests require the 'multiprocessing'" \
+                    " module (Python 2.6 or later)."
+                sys.exit(1)
+        elif opt == '--command_jobs':
+            command_jobs = int(arg)
+            if command_jobs < 1:
+                print >>sys.stderr, \
+                    "Error: The number of command jobs should be positive."
+                sys.exit(1)
+        elif opt == '--qemu_io_sessions':
+            sessions = True
+        elif opt == '--timeout':
+            max_timeout = int(arg)
+        elif opt == '--min_timeout':
+            min_timeout = int(arg)
+        elif opt == '--keep_crashes':
+            keep_crashes = int(arg)
+        elif opt == '--stats_interval':
+            stats_interval = int(arg)
+        elif opt == '--metrics_file':
+            metrics_file = os.path.realpath(arg)
+        elif opt == '--results_db':
+            results_db = os.path.realpath(arg)
+        elif opt == '--no_results_db':
+            results_db = None
+        elif opt == '--minimize':
+            minimize = True
+        elif opt == '--corpus':
+            corpus_mode = True
+        elif opt == '--corpus_size':
+            corpus_size = int(arg)
+        elif opt == '--coverage':
+            coverage = True
+        elif opt == '--test_budget':
+            test_budget = float(arg)
+        elif opt == '--exploration':
+            exploration = float(arg)
+        elif opt == '--generators':
+            generators = int(arg)
+            if generators > 0 and multiprocessing is None:
+                print >>sys.stderr, \
+                    "Error: The pipeline requires the 'multiprocessing'" \
+                    " module (Python 2.6 or later)."
+                sys.exit(1)
+        elif opt == '--queue_depth':
+            queue_depth = int(arg)
+        elif opt == '--coordinator':
+            coordinator = arg
+        elif opt == '--resume':
+            resume = True
+        elif opt == '--disk_quota':
+            disk_quota = int(arg) * (1 << 20)
+        elif opt == '--compress':
+            compress = True
+        elif opt == '--profile':
+            if arg not in ('phases', 'cprofile'):
+                print >>sys.stderr, \
+                    "Error: Profiling mode should be 'phases' or 'cprofile'."
+                sys.exit(1)
+            # Inherited by all test processes
+            os.environ['QCOW2_PROFILE'] = arg
+        elif opt == '--max_image_size':
+            os.environ['QCOW2_MAX_IMAGE_SIZE'] = str(float(arg))
+        elif opt == '--replay':
+            try:
+                replay_file = open(arg)
+                try:
+                    replay_mutations = load_mutations(replay_file.read())
+                finally:
+                    replay_file.close()
+            except (IOError, TypeError, ValueError, AttributeError), e:
+                print >>sys.stderr, \
+                    "Error: Mutations cannot be loaded from '%s'.\n" \
+                    "Reason: %s" % (arg, e)
+                sys.exit(1)
+        elif opt == '--output_limit':
+            output_limit = int(arg) * (1 << 10)
+        elif opt == '--memory_limit':
+            memory_limit = int(arg) * (1 << 20)
+        elif opt == '--cpu_limit':
+            cpu_limit = int(arg)
         elif opt == '--config':
             try:
                 config = json.loads(arg)
@@ -439,6 +2137,28 @@ if __name__ == '__main__':
             "Expected two parameters\nTry 'runner.py --help'" \
             " for more information."
         sys.exit(1)
+    if minimize and seed is None:
+        print >>sys.stderr, \
+            "Error: Minimization requires a seed of the failed test."
+        sys.exit(1)
+    if resume and (seed is not None or coordinator is not None):
+        print >>sys.stderr, \
+            "Error: Only a run of tests from the seed sequence can be resumed."
+        sys.exit(1)
+    if coordinator is not None and (seed is not None or
+                                    'json' not in globals()):
+        print >>sys.stderr, \
+            "Error: The worker mode requires the 'json' module and doesn't " \
+            "accept a seed."
+        sys.exit(1)
+    if replay_mutations is not None and seed is None:
+        print >>sys.stderr, \
+            "Error: Mutations can be replayed only for the test specified " \
+            "by its seed."
+        sys.exit(1)
+
+    if queue_depth is None:
+        queue_depth = 2 * jobs
 
     work_dir = os.path.realpath(args[0])
     # run_log is created in 'main', because multiple tests are expected to
@@ -458,18 +2178,278 @@ if __name__ == '__main__':
             "Reason: %s" % (generator_name, e)
         sys.exit(1)
 
+    limits = ExecLimits(max_timeout, min_timeout, memory=memory_limit,
+                        cpu=cpu_limit, output=output_limit)
+    backing_pool = BackingPool(os.path.join(work_dir, 'backing'))
+    buckets = CrashBuckets(os.path.join(work_dir, 'buckets'), keep_crashes)
     # Enable core dumps
     resource.setrlimit(resource.RLIMIT_CORE, (-1, -1))
+    janitor = None
+    trash_dir = None
+    if minimize:
+        minimize_log = os.path.join(work_dir, 'minimize.log')
+        minimize_dir = os.path.join(work_dir, 'minimize')
+        sys.exit(minimize_test())
     # If a seed is specified, only one test will be executed.
     # Otherwise runner will terminate after a keyboard interruption
-    start_time = int(time.time())
-    test_id = count(1)
-    while should_continue(duration, start_time):
+    worker = None
+    checkpoint = None
+    if resume:
         try:
-            run_test(str(test_id.next()), seed, work_dir, run_log, cleanup,
-                     log_all, command, config)
-        except (KeyboardInterrupt, SystemExit):
+            checkpoint_file = open(os.path.join(work_dir, 'checkpoint.json'))
+            try:
+                checkpoint = json.load(checkpoint_file)
+            finally:
+                checkpoint_file.close()
+        except (IOError, ValueError, NameError), e:
+            print >>sys.stderr, \
+                "Error: The checkpoint of the run in '%s' cannot be " \
+                "loaded.\nReason: %s" % (work_dir, e)
             sys.exit(1)
-
-        if seed is not None:
-            break
+        run_seed = str(checkpoint['run_seed'])
+    if seed is not None:
+        seeds = iter([seed])
+        jobs = 1
+    elif coordinator is not None:
+        try:
+            worker = Worker(coordinator,
+                            '%s:%d' % (socket.gethostname(), os.getpid()))
+        except socket.error, e:
+            print >>sys.stderr, \
+                "Error: The coordinator at '%s' is not available.\n" \
+                "Reason: %s" % (coordinator, e)
+            sys.exit(1)
+        print "Worker of the coordinator at %s" % coordinator
+        sys.stdout.flush()
+    else:
+        if run_seed is None:
+            run_seed = str(random.randint(0, sys.maxint))
+        print "Run seed: %s" % run_seed
+        sys.stdout.flush()
+        seeds = seed_stream(run_seed)
+    # Tests to be executed again after resume: (number, seed)
+    retry = []
+    # Number of the last test taken from the seed sequence
+    last_test = [0]
+    if checkpoint is not None:
+        incomplete = dict([(n, True) for n in checkpoint['incomplete']])
+        for number in range(1, checkpoint['next_test']):
+            test_seed = seeds.next()
+            if number in incomplete:
+                retry.append((number, test_seed))
+
+        def repeated(test_dir):
+            """Return True if the test of the directory was interrupted or
+            started after the checkpoint, so it's executed again.
+            """
+            number = os.path.basename(test_dir)[len('test-'):]
+            return number.isdigit() and \
+                (int(number) in incomplete or
+                 int(number) >= checkpoint['next_test'])
+
+        # Directories and crashes of repeated tests are incomplete
+        for name in os.listdir(work_dir):
+            test_dir = os.path.join(work_dir, name)
+            if name.startswith('test-') and repeated(test_dir):
+                shutil.rmtree(test_dir)
+        buckets.discard(repeated)
+        last_test[0] = checkpoint['next_test'] - 1
+        print "Resumed at test %d, %d interrupted tests will be repeated" % \
+            (checkpoint['next_test'], len(retry))
+        sys.stdout.flush()
+    # Tests taken from the seed sequence or leased and not finished yet
+    started = {}
+    # Crash signatures of finished tests
+    seen_buckets = {}
+    if seed is None:
+        # Kept failed tests of a previous run in the work directory are
+        # prioritized by their buckets as tests of this run
+        priorities = {}
+        for sig, members in buckets.members().items():
+            members = [x for x in members if os.path.isdir(x)]
+            if members:
+                seen_buckets[sig] = True
+                priorities[members[0]] = UNIQUE
+                for test_dir in members[1:]:
+                    priorities.setdefault(test_dir, DUPLICATE)
+        # Directories of passed tests are removed in the background
+        trash_dir = os.path.join(work_dir, '.trash')
+        janitor = Janitor(work_dir, trash_dir, disk_quota, compress,
+                          janitor_log, priorities)
+        janitor.start()
+    corpus = None
+    if corpus_mode and seed is None:
+        if 'json' in globals():
+            corpus = Corpus(os.path.join(work_dir, 'corpus.json'),
+                            corpus_size, run_seed)
+        else:
+            print >>sys.stderr, \
+                "Warning: The corpus mode requires the 'json' module."
+    coverage_map = None
+    if coverage:
+        coverage_map = CoverageMap(os.path.join(work_dir, 'coverage.map'))
+    scheduler = None
+    if test_budget is not None and seed is None:
+        scheduler = CommandScheduler(test_budget, exploration, run_seed)
+    store = None
+    run_id = None
+    if results_db is not None and sqlite3 is not None:
+        if results_db == '':
+            results_db = os.path.join(work_dir, 'results.db')
+        if config is None:
+            config_text = None
+        else:
+            config_text = json.dumps(config)
+        if command is None:
+            command_text = None
+        else:
+            command_text = json.dumps(command)
+        try:
+            os.makedirs(os.path.dirname(results_db))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        store = ResultStore(results_db)
+        if checkpoint is not None and checkpoint['run_id'] is not None:
+            run_id = checkpoint['run_id']
+        else:
+            run_id = store.add_run(run_seed or seed, work_dir,
+                                   generator_name, command_text, config_text)
+    start_time = int(time.time())
+    test_id = count(last_test[0] + 1)
+    stats = RunStats()
+    if checkpoint is not None:
+        stats.restore(checkpoint['stats'])
+        # The duration of the run includes the time before resume
+        start_time -= int(checkpoint['stats']['elapsed'])
+    # Statistics are not reported for a single test
+    reporting = seed is None
+    # A list to be modified by check_stats()
+    next_report = [time.time() + stats_interval]
+    if generators > 0 and seed is None:
+        generator_pool = multiprocessing.Pool(generators, init_worker)
+        executor_pool = multiprocessing.Pool(jobs, init_worker)
+        # Both stages pass their results to the main process via the queue
+        events = Queue.Queue()
+
+        def generated(result):
+            """Pass a result of generate_test() to the main process."""
+            events.put((generate_test, result))
+
+        def executed(result):
+            """Pass a result of execute_test() to the main process."""
+            events.put((execute_test, result))
+
+        # States of generated tests waiting for execution
+        ready = []
+        generating = 0
+        executing = 0
+        failed = False
+        try:
+            while True:
+                # Not more than 'queue_depth' tests are generated ahead
+                while not failed and generating + len(ready) < queue_depth \
+                      and more_tests():
+                    args = next_test()
+                    if args is None:
+                        break
+                    generator_pool.apply_async(
+                        pipeline_job, [(generate_test, args)],
+                        callback=generated)
+                    generating += 1
+                while ready and executing < jobs:
+                    executor_pool.apply_async(
+                        pipeline_job, [(execute_test, ready.pop(0))],
+                        callback=executed)
+                    executing += 1
+                stats.queue_depth = len(ready)
+                if generating == 0 and executing == 0 and \
+                   (failed or not more_tests()):
+                    break
+                check_stats()
+                try:
+                    stage, result = events.get(True, 1)
+                except Queue.Empty:
+                    continue
+                if stage is generate_test:
+                    generating -= 1
+                    is_ready, value = result
+                    if is_ready:
+                        ready.append(value)
+                    else:
+                        failed = not add_test(value) or failed
+                else:
+                    executing -= 1
+                    failed = not add_test(result) or failed
+        except KeyboardInterrupt:
+            for pool in (generator_pool, executor_pool):
+                pool.terminate()
+                pool.join()
+            exit_run(1)
+        for pool in (generator_pool, executor_pool):
+            pool.close()
+            pool.join()
+        if failed:
+            exit_run(1)
+    elif jobs == 1:
+        while more_tests():
+            try:
+                args = next_test()
+                if args is None:
+                    # All tests of the coordinator are leased now
+                    time.sleep(Worker.RETRY)
+                    continue
+                result = run_test(*args)
+            except (KeyboardInterrupt, SystemExit):
+                exit_run(1)
+            if not add_test(result):
+                exit_run(1)
+            check_stats()
+
+            if seed is not None:
+                break
+    else:
+        pool = multiprocessing.Pool(jobs, init_worker)
+        # Results of finished tests are passed to the main process via
+        # the queue, so not more than 'jobs' tests are in flight
+        finished = Queue.Queue()
+        in_flight = 0
+        failed = False
+        try:
+            while True:
+                while not failed and in_flight < jobs and more_tests():
+                    args = next_test()
+                    if args is None:
+                        break
+                    pool.apply_async(run_job, [args], callback=finished.put)
+                    in_flight += 1
+                if in_flight == 0 and (failed or not more_tests()):
+                    break
+                check_stats()
+                try:
+                    # Blocking get() without a timeout cannot be interrupted
+                    # by a keyboard interruption in Python 2
+                    result = finished.get(True, 1)
+                except Queue.Empty:
+                    continue
+                in_flight -= 1
+                failed = not add_test(result) or failed
+        except KeyboardInterrupt:
+            pool.terminate()
+            pool.join()
+            exit_run(1)
+        pool.close()
+        pool.join()
+        if failed:
+            exit_run(1)
+    if reporting:
+        report_stats()
+        save_checkpoint()
+    if scheduler is not None:
+        report_schedule()
+    if store is not None:
+        store.close()
+    if worker is not None:
+        worker.close()
+    if janitor is not None:
+        janitor.stop()
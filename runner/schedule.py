@@ -0,0 +1,131 @@
+# Adaptive scheduling of commands under test
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import random
+
+
+class Arm(object):
+
+    """Statistics of one command of the test command list."""
+
+    def __init__(self, key):
+        self.key = key
+        self.runs = 0
+        self.hits = 0
+        # Total and number of known execution times
+        self.cost = 0.0
+        self.timed = 0
+
+    def mean_cost(self, default):
+        """Return the mean execution time or 'default' if it's unknown."""
+        if self.timed == 0:
+            return default
+        return self.cost / self.timed
+
+
+class CommandScheduler(object):
+
+    """Multi-armed bandit choosing commands to be executed for a test image.
+
+    Every command of the test command list is an arm. A run of a command is
+    a hit if the application crashed or showed a behavior feature not seen
+    before. For every test the scheduler samples a hit rate of every command
+    from its Beta posterior (Thompson sampling), divides it by the mean
+    execution time of the command and picks commands in the order of this
+    score until their expected time exceeds 'budget' seconds. Independently
+    of the budget every command is picked with probability 'floor', so no
+    command is starved.
+
+    Statistics are collected in the main process of the runner from results
+    of finished tests. Until a test with all commands is finished, tests
+    execute all commands.
+    """
+
+    def __init__(self, budget, floor=0.05, seed=None):
+        self.budget = budget
+        self.floor = floor
+        self.rng = random.Random(seed)
+        # Command index -> Arm
+        self.arms = {}
+        # Behavior features seen during the run
+        self.features = {}
+
+    def choose(self):
+        """Return a sorted list of indices of commands to be executed by
+        the next test or None if all commands should be executed.
+        """
+        if len(self.arms) == 0:
+            return None
+        costs = [a.mean_cost(None) for a in self.arms.values() if a.timed]
+        if costs:
+            default = sum(costs) / len(costs)
+        else:
+            default = 1.0
+        chosen = []
+        scored = []
+        for index, arm in self.arms.items():
+            if self.rng.random() < self.floor:
+                chosen.append(index)
+                continue
+            rate = self.rng.betavariate(arm.hits + 1, arm.runs - arm.hits + 1)
+            cost = max(arm.mean_cost(default), 1e-6)
+            scored.append((rate / cost, cost, index))
+        scored.sort()
+        scored.reverse()
+        spent = 0.0
+        for score, cost, index in scored:
+            if spent + cost > self.budget and (chosen or spent > 0):
+                continue
+            chosen.append(index)
+            spent += cost
+        chosen.sort()
+        return chosen
+
+    def record(self, results):
+        """Take into account results of commands of a finished test.
+
+        'results' is a list of command results from TestEnv.report().
+        """
+        for result in results:
+            index = result['number'] - 1
+            arm = self.arms.get(index)
+            if arm is None:
+                arm = self.arms[index] = Arm(result['command'])
+            arm.runs += 1
+            hit = result['retcode'] < 0 and not result['timed_out']
+            for feature in result.get('features', []):
+                if feature not in self.features:
+                    self.features[feature] = True
+                    hit = True
+            if hit:
+                arm.hits += 1
+            if result['duration'] is not None:
+                arm.cost += result['duration']
+                arm.timed += 1
+
+    def summary(self):
+        """Return lines with statistics of commands."""
+        lines = []
+        indices = self.arms.keys()
+        indices.sort()
+        for index in indices:
+            arm = self.arms[index]
+            lines.append("%3d %-24s %6d runs %5d hits %8.3fs mean" %
+                         (index + 1, arm.key, arm.runs, arm.hits,
+                          arm.mean_cost(0.0)))
+        return lines
@@ -0,0 +1,249 @@
+# Live statistics of a test run
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import time
+
+# Upper bounds in seconds of buckets of the command latency histogram
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300]
+
+# Prefix of names of exported metrics
+PREFIX = 'image_fuzzer'
+
+
+def _label(value):
+    """Escape a value of a metric label."""
+    return value.replace('\\', '\\\\').replace('"', '\\"') \
+                .replace('\n', '\\n')
+
+
+class Histogram(object):
+
+    """Cumulative histogram of observed values in the Prometheus style."""
+
+    def __init__(self, bounds=None):
+        if bounds is None:
+            bounds = LATENCY_BUCKETS
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        """Take into account one observed value."""
+        for i in range(len(self.bounds)):
+            if value <= self.bounds[i]:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def lines(self, name, labels):
+        """Return lines of the histogram in the text exposition format."""
+        lines = []
+        total = 0
+        for bound, n in zip(self.bounds, self.counts):
+            total += n
+            lines.append('%s_bucket{%sle="%g"} %d' %
+                         (name, labels, bound, total))
+        lines.append('%s_bucket{%sle="+Inf"} %d' % (name, labels, self.count))
+        lines.append('%s_sum{%s} %s' % (name, labels.rstrip(','),
+                                        repr(self.sum)))
+        lines.append('%s_count{%s} %d' % (name, labels.rstrip(','),
+                                          self.count))
+        return lines
+
+
+class RunStats(object):
+
+    """Statistics of a test run.
+
+    Statistics are collected in the main process of the runner from
+    resource usage records of finished tests, so workers executing tests
+    never share or lock them.
+
+    A command execution is counted as a crash if the application was killed
+    by a signal and as a timeout if it was killed by the runner.
+
+    In the pipeline mode the depth of the queue of generated tests and total
+    times of generation, execution and waiting in the queue are reported
+    as well.
+    """
+
+    def __init__(self):
+        self.start = time.time()
+        self.tests = 0
+        self.failed_tests = 0
+        self.execs = 0
+        self.crashes = 0
+        self.timeouts = 0
+        # Command key -> Histogram of execution times
+        self.latency = {}
+        # Number of covered edges if coverage is collected
+        self.edges = None
+        # Number of tests waiting for execution in the pipeline mode
+        self.queue_depth = None
+        # Stage -> total time in seconds
+        self.stage_time = {'generate': 0.0, 'execute': 0.0, 'wait': 0.0}
+        # Values of counters at the last report
+        self.last_report = (self.start, 0, 0)
+
+    def add_test(self, status, usage, queue_wait=None):
+        """Take into account a finished test.
+
+        'status' is False if the test could not be executed, 'usage' is
+        a list of resource usage records of test stages, 'queue_wait' is
+        the time the test waited for execution in the pipeline mode.
+        """
+        self.tests += 1
+        if queue_wait is not None:
+            self.stage_time['wait'] += queue_wait
+        for record in usage:
+            if record['stage'] in ('backing_file', 'create_image'):
+                self.stage_time['generate'] += record['wall']
+            else:
+                self.stage_time['execute'] += record['wall']
+            if record['stage'] == 'command':
+                self.execs += 1
+                self._add_result(record)
+                if not record['timed_out']:
+                    self.latency.setdefault(record['command'], Histogram()) \
+                                .observe(record['wall'])
+            elif record['stage'] == 'session':
+                self.execs += len(record['commands'])
+                self._add_result(record)
+        if not status or [r for r in usage if r.get('retcode', 0) < 0]:
+            self.failed_tests += 1
+
+    def _add_result(self, record):
+        """Count a timeout or a crash of the application."""
+        if record['timed_out']:
+            self.timeouts += 1
+        elif record['retcode'] < 0:
+            self.crashes += 1
+
+    def state(self):
+        """Return a dictionary with counters and histograms for a checkpoint
+        of the run.
+        """
+        latency = {}
+        for key, histogram in self.latency.items():
+            latency[key] = {'counts': histogram.counts,
+                            'count': histogram.count, 'sum': histogram.sum}
+        return {'elapsed': time.time() - self.start, 'tests': self.tests,
+                'failed_tests': self.failed_tests, 'execs': self.execs,
+                'crashes': self.crashes, 'timeouts': self.timeouts,
+                'latency': latency}
+
+    def restore(self, state):
+        """Continue statistics from the state returned by state()."""
+        self.start = time.time() - state['elapsed']
+        for name in ('tests', 'failed_tests', 'execs', 'crashes', 'timeouts'):
+            setattr(self, name, state[name])
+        for key, data in state['latency'].items():
+            histogram = Histogram()
+            if len(data['counts']) == len(histogram.counts):
+                histogram.counts = data['counts']
+                histogram.count = data['count']
+                histogram.sum = data['sum']
+            self.latency[str(key)] = histogram
+        self.last_report = (time.time(), self.tests, self.execs)
+
+    def summary(self):
+        """Return a one-line summary with rates since the previous summary and
+        since the start of the run.
+        """
+        now = time.time()
+        last_time, last_tests, last_execs = self.last_report
+        interval = max(now - last_time, 1e-6)
+        elapsed = max(now - self.start, 1e-6)
+        self.last_report = (now, self.tests, self.execs)
+        summary = "%d tests (%.2f/s, %.2f/s overall), %d executions " \
+                  "(%.1f/s, %.1f/s overall), %d crashes, %d timeouts, " \
+                  "%d failed tests" % \
+                  (self.tests, (self.tests - last_tests) / interval,
+                   self.tests / elapsed, self.execs,
+                   (self.execs - last_execs) / interval, self.execs / elapsed,
+                   self.crashes, self.timeouts, self.failed_tests)
+        if self.queue_depth is not None:
+            tests = max(self.tests, 1)
+            summary += ", %d tests queued, per test: %.3fs generation, " \
+                       "%.3fs execution, %.3fs in queue" % \
+                       (self.queue_depth, self.stage_time['generate'] / tests,
+                        self.stage_time['execute'] / tests,
+                        self.stage_time['wait'] / tests)
+        return summary
+
+    def metrics(self):
+        """Return metrics in the Prometheus text exposition format."""
+        lines = []
+        for name, value, text in [
+                ('tests_total', self.tests, 'Finished tests.'),
+                ('failed_tests_total', self.failed_tests, 'Failed tests.'),
+                ('executions_total', self.execs,
+                 'Executions of commands under test.'),
+                ('crashes_total', self.crashes,
+                 'Commands killed by a signal.'),
+                ('timeouts_total', self.timeouts,
+                 'Commands killed by timeout.')]:
+            name = '%s_%s' % (PREFIX, name)
+            lines.append('# HELP %s %s' % (name, text))
+            lines.append('# TYPE %s counter' % name)
+            lines.append('%s %d' % (name, value))
+        name = '%s_run_start_time_seconds' % PREFIX
+        lines.append('# HELP %s Start time of the run.' % name)
+        lines.append('# TYPE %s gauge' % name)
+        lines.append('%s %d' % (name, self.start))
+        if self.queue_depth is not None:
+            name = '%s_queue_depth' % PREFIX
+            lines.append('# HELP %s Generated tests waiting for execution.'
+                         % name)
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %d' % (name, self.queue_depth))
+            name = '%s_stage_seconds_total' % PREFIX
+            lines.append('# HELP %s Time spent by tests at pipeline stages.'
+                         % name)
+            lines.append('# TYPE %s counter' % name)
+            for stage in ('generate', 'execute', 'wait'):
+                lines.append('%s{stage="%s"} %s' %
+                             (name, stage, repr(self.stage_time[stage])))
+        if self.edges is not None:
+            name = '%s_edges_covered' % PREFIX
+            lines.append('# HELP %s Edges covered by all tests.' % name)
+            lines.append('# TYPE %s gauge' % name)
+            lines.append('%s %d' % (name, self.edges))
+        name = '%s_command_duration_seconds' % PREFIX
+        lines.append('# HELP %s Execution time of commands.' % name)
+        lines.append('# TYPE %s histogram' % name)
+        keys = self.latency.keys()
+        keys.sort()
+        for key in keys:
+            lines.extend(self.latency[key].lines(
+                name, 'command="%s",' % _label(key)))
+        return '\n'.join(lines) + '\n'
+
+    def write_metrics(self, path):
+        """Atomically replace the file by the current metrics."""
+        temp_path = '%s.%d' % (path, os.getpid())
+        metrics_file = open(temp_path, 'w')
+        try:
+            metrics_file.write(self.metrics())
+        finally:
+            metrics_file.close()
+        os.rename(temp_path, path)
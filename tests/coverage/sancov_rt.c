@@ -0,0 +1,82 @@
+/*
+ * Minimal SanitizerCoverage runtime for the stand-in application under test
+ *
+ * Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 2 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ *
+ * Covered edges are recorded by the '-fsanitize-coverage=trace-pc' callback
+ * as offsets from the executable base and dumped at exit to
+ * '<program>.<pid>.sancov' in 'coverage_dir' if ASAN_OPTIONS contains
+ * 'coverage=1', as the sanitizer runtime does. This file is compiled without
+ * instrumentation.
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdint.h>
+#include <unistd.h>
+
+#define MAX_EDGES 65536
+
+extern char __executable_start;
+extern char *program_invocation_short_name;
+
+static uint64_t edges[MAX_EDGES];
+static int edge_count;
+
+void __sanitizer_cov_trace_pc(void)
+{
+    uint64_t pc = (uint64_t)(uintptr_t)__builtin_return_address(0) -
+                  (uint64_t)(uintptr_t)&__executable_start;
+    int i;
+
+    for (i = 0; i < edge_count; i++) {
+        if (edges[i] == pc) {
+            return;
+        }
+    }
+    if (edge_count < MAX_EDGES) {
+        edges[edge_count++] = pc;
+    }
+}
+
+static __attribute__((destructor)) void dump_coverage(void)
+{
+    const char *options = getenv("ASAN_OPTIONS");
+    const char *dir;
+    char path[4096];
+    uint64_t magic = 0xC0BFFFFFFFFFFF64ULL;
+    FILE *sancov;
+
+    if (options == NULL || strstr(options, "coverage=1") == NULL) {
+        return;
+    }
+    dir = strstr(options, "coverage_dir=");
+    if (dir != NULL) {
+        dir += strlen("coverage_dir=");
+    } else {
+        dir = ".";
+    }
+    snprintf(path, sizeof(path), "%.*s/%s.%d.sancov", (int)strcspn(dir, ":"),
+             dir, program_invocation_short_name, (int)getpid());
+    sancov = fopen(path, "wb");
+    if (sancov == NULL) {
+        return;
+    }
+    fwrite(&magic, sizeof(magic), 1, sancov);
+    fwrite(edges, sizeof(edges[0]), edge_count, sancov);
+    fclose(sancov);
+}
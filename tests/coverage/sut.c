@@ -0,0 +1,113 @@
+/*
+ * Stand-in for qemu-img and qemu-io built with SanitizerCoverage
+ *
+ * Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+ *
+ * This program is free software: you can redistribute it and/or modify
+ * it under the terms of the GNU General Public License as published by
+ * the Free Software Foundation, either version 2 of the License, or
+ * (at your option) any later version.
+ *
+ * This program is distributed in the hope that it will be useful,
+ * but WITHOUT ANY WARRANTY; without even the implied warranty of
+ * MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ * GNU General Public License for more details.
+ *
+ * You should have received a copy of the GNU General Public License
+ * along with this program.  If not, see <http://www.gnu.org/licenses/>.
+ *
+ * The application creates backing files for 'create' and otherwise takes
+ * different branches depending on the qcow2 header of the first image in
+ * its arguments, so different test images cover different edges.
+ *
+ * Build:
+ *   gcc -fsanitize-coverage=trace-pc -c sut.c
+ *   gcc -c sancov_rt.c
+ *   gcc -o qemu-img sut.o sancov_rt.o
+ */
+
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+#include <stdint.h>
+#include <unistd.h>
+
+#define HEADER_SIZE 104
+
+static uint32_t be32(const unsigned char *p)
+{
+    return (uint32_t)p[0] << 24 | p[1] << 16 | p[2] << 8 | p[3];
+}
+
+static int read_header(const char *path, unsigned char *header)
+{
+    FILE *image = fopen(path, "rb");
+    size_t size;
+
+    if (image == NULL) {
+        return 0;
+    }
+    size = fread(header, 1, HEADER_SIZE, image);
+    fclose(image);
+    return size >= 72 && memcmp(header, "QFI\xfb", 4) == 0;
+}
+
+int main(int argc, char **argv)
+{
+    unsigned char header[HEADER_SIZE];
+    uint32_t version, cluster_bits;
+    int i;
+
+    /* qemu-img create -f FMT PATH SIZE */
+    if (argc == 6 && strcmp(argv[1], "create") == 0) {
+        FILE *backing = fopen(argv[4], "wb");
+
+        if (backing == NULL) {
+            return 1;
+        }
+        fclose(backing);
+        return truncate(argv[4], atol(argv[5])) != 0;
+    }
+
+    for (i = 1; i < argc; i++) {
+        if (read_header(argv[i], header)) {
+            break;
+        }
+    }
+    if (i == argc) {
+        puts("no image");
+        return 1;
+    }
+    version = be32(header + 4);
+    cluster_bits = be32(header + 20);
+    if (version == 2) {
+        puts("version 2");
+    } else if (version == 3) {
+        puts("version 3");
+    } else {
+        puts("unknown version");
+        return 1;
+    }
+    if (cluster_bits < 9) {
+        puts("small clusters");
+    } else if (cluster_bits > 21) {
+        puts("huge clusters");
+    } else if (cluster_bits == 16) {
+        puts("default clusters");
+    } else {
+        puts("other clusters");
+    }
+    if (be32(header + 36) > 1000) {
+        puts("big L1 table");
+    }
+    if (be32(header + 32) != 0) {
+        puts("encrypted");
+    }
+    if (be32(header + 60) > 100) {
+        puts("many snapshots");
+    }
+    if (version == 3 && (header[79] & 1)) {
+        puts("dirty");
+    }
+    return 0;
+}
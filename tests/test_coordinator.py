@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+
+# Tests of leases and results of the coordinator of test runners
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from itertools import count
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..', 'runner'))
+from coordinator import Coordinator
+from crash import CrashBuckets
+
+
+def report(position, bucket=None):
+    """Return a report of the test at the position with one result."""
+    return {'test': str(position + 1), 'seed': str(position),
+            'directory': 'test-%d' % (position + 1),
+            'results': [{'bucket': bucket, 'description': 'crash'}]}
+
+
+class TestLateResults(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='coordinator-test-')
+        self.buckets = CrashBuckets(self.work_dir)
+        self.coordinator = Coordinator('1', (str(x) for x in count()),
+                                       lease_size=2, lease_timeout=-1,
+                                       buckets=self.buckets)
+        self.output = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def tearDown(self):
+        sys.stdout.close()
+        sys.stdout = self.output
+        shutil.rmtree(self.work_dir, True)
+
+    def test_requeued(self):
+        first = self.coordinator.lease('a', None)['lease']
+        self.coordinator.expire()
+        # The late result is counted once and the test isn't leased again
+        self.coordinator.result(first, 'a', 'failed', report(0, 'x'))
+        self.coordinator.result(first, 'a', 'failed', report(0, 'x'))
+        self.assertEqual(self.coordinator.completed, 1)
+        self.assertEqual(self.coordinator.crashes, 1)
+        self.assertEqual(len(self.buckets.members()['x']), 1)
+        reply = self.coordinator.lease('b', None)
+        self.assertEqual([x[0] for x in reply['tests']], [1, 2])
+
+    def test_leased_again(self):
+        first = self.coordinator.lease('a', None)['lease']
+        self.coordinator.expire()
+        self.coordinator.lease_timeout = 1800
+        second = self.coordinator.lease('b', None)['lease']
+        self.coordinator.result(second, 'b', 'failed', report(0, 'x'))
+        # The late result of the test leased to another worker is dropped
+        self.coordinator.result(first, 'a', 'failed', report(0, 'x'))
+        self.coordinator.result(first, 'a', 'passed', report(1))
+        self.assertEqual(self.coordinator.completed, 1)
+        self.assertEqual(self.coordinator.crashes, 1)
+        self.assertEqual(len(self.buckets.members()['x']), 1)
+        self.assertEqual(len(self.coordinator.results), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+# Tests of coverage collection from applications built with SanitizerCoverage
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import struct
+import shutil
+import tempfile
+import unittest
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+STAND_IN = os.path.join(ROOT, 'tests', 'coverage')
+sys.path.insert(0, os.path.join(ROOT, 'runner'))
+from coverage import MAP_SIZE, SANCOV_MAGIC64, collect, edge_index
+
+
+def find_program(name):
+    """Return True if the program is found in PATH."""
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(directory, name), os.X_OK):
+            return True
+    return False
+
+
+class TestCollect(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='coverage-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, True)
+
+    def test_collect(self):
+        path = os.path.join(self.work_dir, 'qemu-img.123.sancov')
+        sancov = open(path, 'wb')
+        sancov.write(struct.pack('<4Q', SANCOV_MAGIC64, 0x10, 0x20, 0x10))
+        sancov.close()
+        indices = {}
+        collect(self.work_dir, indices)
+        self.assertEqual(sorted(indices.keys()),
+                         sorted([edge_index('qemu-img', 0x10),
+                                 edge_index('qemu-img', 0x20)]))
+        # Collected files are removed
+        self.assertEqual(os.listdir(self.work_dir), [])
+
+
+class TestRunnerCoverage(unittest.TestCase):
+
+    """Run the runner with '--coverage' against the stand-in application
+    from 'tests/coverage' built with gcc -fsanitize-coverage=trace-pc.
+    """
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp(prefix='coverage-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, True)
+
+    def build(self):
+        """Build the stand-in as 'qemu-img' and return its path."""
+        build_dir = os.path.join(self.work_dir, 'build')
+        os.mkdir(build_dir)
+        for args in (['-fsanitize-coverage=trace-pc', '-c',
+                      os.path.join(STAND_IN, 'sut.c')],
+                     ['-c', os.path.join(STAND_IN, 'sancov_rt.c')],
+                     ['-o', 'qemu-img', 'sut.o', 'sancov_rt.o']):
+            retcode = subprocess.call(['gcc'] + args, cwd=build_dir)
+            self.assertEqual(retcode, 0)
+        return os.path.join(build_dir, 'qemu-img')
+
+    @unittest.skipUnless(find_program('gcc'), 'gcc is not found')
+    def test_edges_collected(self):
+        sut = self.build()
+        env = dict(os.environ)
+        env['QEMU_IMG'] = sut
+        env['QEMU_IO'] = sut
+        test_dir = os.path.join(self.work_dir, 'run')
+        devnull = open(os.devnull, 'w')
+        try:
+            retcode = subprocess.call([sys.executable,
+                                       os.path.join(ROOT, 'runner',
+                                                    'runner.py'),
+                                       '-d', '3', '--run_seed', '1',
+                                       '--coverage', test_dir,
+                                       os.path.join(ROOT, 'qcow2')],
+                                      env=env, stdout=devnull,
+                                      stderr=subprocess.STDOUT)
+        finally:
+            devnull.close()
+        self.assertEqual(retcode, 0)
+        map_file = open(os.path.join(test_dir, 'coverage.map'), 'rb')
+        try:
+            bitmap = map_file.read()
+        finally:
+            map_file.close()
+        self.assertEqual(len(bitmap), MAP_SIZE)
+        self.assertTrue(MAP_SIZE - bitmap.count('\0') > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
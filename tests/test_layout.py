@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+# Tests of queries of qcow2 image fields by offsets
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                                '..'))
+from qcow2.layout import FieldsList, FieldsArray
+
+
+def names(fields):
+    """Return names of fields."""
+    return [x.name for x in fields]
+
+
+def offsets(fields):
+    """Return offsets of fields."""
+    return [x.offset for x in fields]
+
+
+class TestFieldsList(unittest.TestCase):
+
+    def setUp(self):
+        # Fields of different sizes: [0, 8), [8, 12), [12, 13), [16, 24)
+        self.fields = FieldsList([['>Q', 0, 1, 'a'],
+                                  ['>I', 8, 2, 'b'],
+                                  ['>B', 12, 3, 'c'],
+                                  ['>Q', 16, 4, 'd']])
+
+    def test_at(self):
+        self.assertEqual(names(self.fields.at(8)), ['b'])
+        self.assertEqual(self.fields.at(9), [])
+
+    def test_overlapping_boundaries(self):
+        # The last byte of a field
+        self.assertEqual(names(self.fields.overlapping(7, 8)), ['a'])
+        # The end of the range is excluded
+        self.assertEqual(names(self.fields.overlapping(0, 8)), ['a'])
+        self.assertEqual(self.fields.overlapping(13, 16), [])
+        # A short field right after a long one isn't found by the maximal
+        # field size
+        self.assertEqual(names(self.fields.overlapping(12, 13)), ['c'])
+        self.assertEqual(self.fields.overlapping(13, 14), [])
+        self.assertEqual(names(self.fields.overlapping(7, 17)),
+                         ['a', 'b', 'c', 'd'])
+
+    def test_index_update(self):
+        self.fields.overlapping(0, 1)
+        self.fields.extend(FieldsList([['>I', 14, 5, 'e']]))
+        self.assertEqual(names(self.fields.overlapping(13, 16)), ['e'])
+        self.assertEqual(names(self.fields.at(14)), ['e'])
+
+
+class TestFieldsArray(unittest.TestCase):
+
+    def setUp(self):
+        # Entries are added not in the order of their offsets
+        self.table = FieldsArray('>Q', 'entry')
+        for offset in [24, 0, 8, 40]:
+            self.table.append(offset, offset + 1)
+
+    def test_at(self):
+        fields = self.table.at(8)
+        self.assertEqual(offsets(fields), [8])
+        self.assertEqual(fields[0].value, 9)
+        self.assertEqual(self.table.at(9), [])
+
+    def test_overlapping_boundaries(self):
+        # Fields are sorted by offsets
+        self.assertEqual(offsets(self.table.overlapping(0, 48)),
+                         [0, 8, 24, 40])
+        # The first byte of the range is the last byte of a field
+        self.assertEqual(offsets(self.table.overlapping(15, 16)), [8])
+        self.assertEqual(offsets(self.table.overlapping(16, 24)), [])
+        self.assertEqual(offsets(self.table.overlapping(16, 25)), [24])
+        self.assertEqual(offsets(self.table.overlapping(47, 100)), [40])
+        self.assertEqual(self.table.overlapping(48, 100), [])
+
+    def test_index_update(self):
+        self.table.overlapping(0, 1)
+        self.table.append(16, 17)
+        self.assertEqual(offsets(self.table.overlapping(16, 24)), [16])
+        fields = self.table.at(16)
+        fields[0].value = 100
+        self.assertEqual(self.table.get_value(4), 100)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,235 @@
+#!/usr/bin/env python
+
+# Tests of the test runner with stub applications under test
+#
+# Copyright (C) 2014 Maria Kustova <maria.k@catit.be>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 2 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+import time
+import json
+import signal
+import shutil
+import sqlite3
+import tempfile
+import unittest
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+RUNNER = os.path.join(ROOT, 'runner', 'runner.py')
+EXPORT = os.path.join(ROOT, 'runner', 'export.py')
+GENERATOR = os.path.join(ROOT, 'qcow2')
+
+# 'qemu-img create' of backing files handled by all stubs
+STUB_TEMPLATE = """#!/bin/sh
+if [ "$1" = create ]; then
+    : > "$4" && truncate -s "$5" "$4"
+    exit $?
+fi
+%s
+"""
+
+
+class RunnerTestCase(unittest.TestCase):
+
+    """Base class of tests running the runner in a temporary directory."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp(prefix='runner-test-')
+        self.work_dir = os.path.join(self.tmp_dir, 'work')
+        self.qemu_img = self.stub('qemu-img', 'exit 0')
+        self.qemu_io = self.stub('qemu-io', 'exit 0')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir, True)
+
+    def stub(self, name, body):
+        """Create an executable stub application and return its path."""
+        path = os.path.join(self.tmp_dir, name)
+        stub = open(path, 'w')
+        try:
+            stub.write(STUB_TEMPLATE % body)
+        finally:
+            stub.close()
+        os.chmod(path, 0755)
+        return path
+
+    def start(self, *args):
+        """Start the runner with arguments and return its process."""
+        env = dict(os.environ)
+        env['QEMU_IMG'] = self.qemu_img
+        env['QEMU_IO'] = self.qemu_io
+        self.output = open(os.path.join(self.tmp_dir, 'runner.out'), 'a')
+        try:
+            return subprocess.Popen([sys.executable, RUNNER] + list(args) +
+                                    [self.work_dir, GENERATOR], env=env,
+                                    stdout=self.output,
+                                    stderr=subprocess.STDOUT)
+        finally:
+            self.output.close()
+
+    def run_runner(self, *args):
+        """Run the runner with arguments and return its exit code."""
+        return self.start(*args).wait()
+
+    def read(self, name):
+        """Return the content of the file in the work directory."""
+        result = open(os.path.join(self.work_dir, name))
+        try:
+            return result.read()
+        finally:
+            result.close()
+
+
+class TestSessions(RunnerTestCase):
+
+    def test_crash_at_exit(self):
+        # The session crashes after all its commands, e.g. closing the image
+        self.qemu_io = self.stub('qemu-io', """
+while read line; do
+    echo "$line"
+done
+kill -SEGV $$
+""")
+        retcode = self.run_runner(
+            '-s', '1', '--qemu_io_sessions', '-c',
+            '[["qemu-io", "$test_img", "-c", "read $off $len"],'
+            ' ["qemu-io", "$test_img", "-c", "write $off $len"]]')
+        self.assertEqual(retcode, 0)
+        self.assertTrue('FAIL: Test terminated by signal SIGSEGV' in
+                        self.read('run.log'))
+        # The failed test is kept
+        self.assertTrue(os.path.isdir(os.path.join(self.work_dir, 'test-1')))
+
+
+class TestMinimize(RunnerTestCase):
+
+    def test_trial_directories(self):
+        self.qemu_io = self.stub('qemu-io', 'kill -SEGV $$')
+        command = '[["qemu-io", "$test_img", "-c", "read $off $len"]]'
+        self.assertEqual(self.run_runner('-s', '1', '-c', command), 0)
+        log = self.read(os.path.join('test-1', 'test.log'))
+        # Trials of minimizations don't reuse directories of tests and of
+        # each other
+        for _ in range(2):
+            self.assertEqual(self.run_runner('-s', '1', '--minimize', '-c',
+                                             command), 0)
+            self.assertEqual(self.read(os.path.join('test-1', 'test.log')),
+                             log)
+        trials = [x for x in os.listdir(os.path.join(self.work_dir,
+                                                     'minimize'))
+                  if x.startswith('test-')]
+        self.assertEqual(len(trials), 4)
+
+
+class TestResume(RunnerTestCase):
+
+    def checkpoint(self):
+        """Return the checkpoint of the run or None if it's not saved."""
+        try:
+            return json.loads(self.read('checkpoint.json'))
+        except IOError:
+            return None
+
+    def finished_tests(self):
+        """Return numbers of tests stored in the results database."""
+        db = sqlite3.connect(os.path.join(self.work_dir, 'results.db'))
+        try:
+            return [x[0] for x in db.execute('SELECT test FROM tests')]
+        finally:
+            db.close()
+
+    def test_results_after_kill(self):
+        self.qemu_io = self.stub('qemu-io', 'kill -SEGV $$')
+        process = self.start('--run_seed', '7', '--stats_interval', '1')
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            checkpoint = self.checkpoint()
+            if checkpoint is not None and checkpoint['next_test'] > 3:
+                break
+            time.sleep(0.1)
+        os.kill(process.pid, signal.SIGKILL)
+        process.wait()
+        checkpoint = self.checkpoint()
+        self.assertTrue(checkpoint['next_test'] > 3)
+        # Tests finished according to the checkpoint have their results
+        finished = self.finished_tests()
+        for number in range(1, checkpoint['next_test']):
+            if number not in checkpoint['incomplete']:
+                self.assertTrue(number in finished)
+
+        self.assertEqual(self.run_runner('--run_seed', '7', '--resume',
+                                         '-d', '2'), 0)
+        checkpoint = self.checkpoint()
+        self.assertEqual(sorted(self.finished_tests()),
+                         range(1, checkpoint['next_test']))
+
+
+class TestExport(RunnerTestCase):
+
+    def export(self, out_dir, *args):
+        """Run export.py with arguments and return its exit code."""
+        output = open(os.path.join(self.tmp_dir, 'export.out'), 'a')
+        try:
+            return subprocess.call([sys.executable, EXPORT] + list(args) +
+                                   [out_dir, GENERATOR], stdout=output,
+                                   stderr=subprocess.STDOUT)
+        finally:
+            output.close()
+
+    def blocks(self, path):
+        """Return the content of the image split into 512-byte blocks."""
+        image = open(path, 'rb')
+        try:
+            data = image.read()
+        finally:
+            image.close()
+        return [data[i:i + 512] for i in xrange(0, len(data), 512)]
+
+    def test_same_images(self):
+        first = os.path.join(self.tmp_dir, 'first')
+        second = os.path.join(self.tmp_dir, 'second')
+        self.assertEqual(self.export(first, '--seeds', '1-3', '-j', '2'), 0)
+        self.assertEqual(self.export(second, '--seeds', '1-3'), 0)
+        for seed in ['1', '2', '3']:
+            self.assertEqual(self.run_runner('-s', seed, '--keep_passed'), 0)
+            test = self.blocks(os.path.join(self.work_dir, 'test-1',
+                                            'test.img'))
+            exported = self.blocks(os.path.join(first, seed + '.img'))
+            again = self.blocks(os.path.join(second, seed + '.img'))
+            self.assertEqual(len(test), len(exported))
+            # Data clusters are filled by os.urandom(), so only blocks
+            # generated by the seed are compared
+            for index in xrange(len(test)):
+                if exported[index] == again[index]:
+                    self.assertEqual(test[index], exported[index])
+            shutil.rmtree(self.work_dir)
+
+    def test_manifest_rewritten(self):
+        out_dir = os.path.join(self.tmp_dir, 'export')
+        self.assertEqual(self.export(out_dir, '--seeds', '1-2'), 0)
+        self.assertEqual(self.export(out_dir, '--seeds', '1-2'), 0)
+        manifest = open(os.path.join(out_dir, 'manifest.jsonl'))
+        try:
+            images = [json.loads(x)['image'] for x in manifest]
+        finally:
+            manifest.close()
+        self.assertEqual(sorted(images), ['1.img', '2.img'])
+
+
+if __name__ == '__main__':
+    unittest.main()